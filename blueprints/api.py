@@ -9,13 +9,14 @@ import json
 import base64
 import logging
 import os
-import fitz  # PyMuPDF
 
 logger = logging.getLogger(__name__)
 
 from models import db, Viaje, User
 from utils.claude import extraer_info_con_claude
 from utils.save_reservation import save_reservation
+from utils.passenger_index import actualizar_visibilidad_usuario
+from utils.airport_timezone import actualizar_instantes_utc
 from blueprints.push import send_flight_change_notification
 
 api_bp = Blueprint('api', __name__)
@@ -56,6 +57,23 @@ def viajes_count():
     return {"count": count}
 
 
+@api_bp.route('/api/airports/suggest')
+def airports_suggest():
+    """
+    Autocompletado de aeropuertos para los campos origen/destino.
+    ?q= código, ciudad o nombre (sin acentos); ?limit= máx 20.
+    Datos estáticos: la respuesta es cacheable por el navegador y el service worker.
+    """
+    from utils.airports import sugerir_aeropuertos
+
+    q = request.args.get('q', '')[:50]
+    limit = min(request.args.get('limit', 8, type=int) or 8, 20)
+
+    response = jsonify(sugerir_aeropuertos(q, limit))
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+
 @api_bp.route('/api/guardar-nombre-pax', methods=['POST'])
 @login_required
 def guardar_nombre_pax():
@@ -67,6 +85,7 @@ def guardar_nombre_pax():
 
         current_user.nombre_pax = nombre_pax
         current_user.apellido_pax = apellido_pax
+        actualizar_visibilidad_usuario(current_user)
         db.session.commit()
 
         return jsonify({'success': True}), 200
@@ -98,19 +117,22 @@ def test_extraction():
 
     # POST - procesar
     email_text = ""
+    aviso_pdf = ""
 
     # Intentar leer PDF
     if 'pdf' in request.files:
         pdf_file = request.files['pdf']
         if pdf_file.filename:
-            try:
-                pdf_bytes = pdf_file.read()
-                doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-                for page in doc:
-                    email_text += page.get_text()
-                doc.close()
-            except Exception as e:
-                return f"<pre>Error leyendo PDF: {e}</pre>"
+            from utils.pdf_extractor import extraer_documento_carga_manual
+            documento = extraer_documento_carga_manual(pdf_file.read())
+            if documento['error']:
+                return f"<pre>Error leyendo PDF: {documento['error']}</pre>"
+            email_text = documento['texto']
+            if documento['corte']:
+                aviso_pdf = (
+                    f"<p>⚠️ PDF cortado por {documento['corte']}: {documento['paginas']} de "
+                    f"{documento['paginas_total']} páginas, {len(email_text)} caracteres</p>"
+                )
 
     # Si no hay PDF, usar texto
     if not email_text.strip():
@@ -132,6 +154,7 @@ def test_extraction():
         <head><title>Resultado</title></head>
         <body style="font-family: system-ui; max-width: 900px; margin: 40px auto; padding: 20px;">
             <h1>✅ {len(reservas)} reserva(s) detectada(s)</h1>
+            {aviso_pdf}
             <a href="/api/test-extraction">← Probar otro</a>
             <hr>
         '''
@@ -234,6 +257,32 @@ def process_microsoft_emails_cron():
         return {'success': False, 'error': str(e)}, 500
 
 
+@api_bp.route('/cron/process-gmail-jobs', methods=['GET', 'POST'])
+def process_gmail_jobs_cron():
+    """
+    Drena la cola de sincronizaciones Gmail (reintentos con backoff y jobs
+    abandonados por workers) - llamado por Cloud Scheduler cada pocos minutos
+    """
+    if not verificar_cron_auth():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        from utils.gmail_jobs import procesar_jobs_gmail, purgar_jobs_completados, get_estadisticas_cola
+
+        stats = procesar_jobs_gmail(max_jobs=request.args.get('max', 50, type=int))
+        stats['purgados'] = purgar_jobs_completados()
+        stats['cola'] = get_estadisticas_cola()
+
+        print(f"📨 Cola Gmail: {stats}")
+        return {'success': True, 'result': stats}, 200
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        db.session.rollback()
+        return {'success': False, 'error': str(e)}, 500
+
+
 @api_bp.route('/cron/check-flights', methods=['GET', 'POST'])
 def cron_check_flights():
     """Chequea vuelos y envía notificaciones de cambios"""
@@ -256,21 +305,18 @@ def cron_check_flights():
         oauth_result = check_expiring_oauth_connections()
         print(f"🔐 OAuth check: {oauth_result['warnings_sent']} avisos enviados de {oauth_result['connections_checked']} conexiones")
 
-        cambios = check_all_upcoming_flights(db.session)
+        # Reprograma la cola y registra el estado notificado; se commitea al final, ya notificado
+        cambios = check_all_upcoming_flights(db.session, persistir=True)
 
         emails_enviados = 0
         push_enviados = 0
 
-        for item in cambios:
-            viaje_id = item.get('vuelo_id')
-            if not viaje_id:
-                continue
-
-            viaje = Viaje.query.get(viaje_id)
-            if not viaje or not viaje.user_id:
-                continue
+        # Prefetch de usuarios (y sus preferencias) en una sola query
+        user_ids = {item.get('user_id') for item in cambios if item.get('user_id')}
+        usuarios = {u.id: u for u in User.query.filter(User.id.in_(user_ids)).all()} if user_ids else {}
 
-            user = User.query.get(viaje.user_id)
+        for item in cambios:
+            user = usuarios.get(item.get('user_id'))
             if not user:
                 continue
 
@@ -367,6 +413,10 @@ def cron_check_flights():
                     except Exception as e:
                         print(f'⚠️ Error enviando push a user {user.id}: {e}')
 
+        # next_check_at y estado notificado (notif_*) recién ahora, con los avisos enviados
+        db.session.commit()
+        print("💾 BD actualizada (cola de checks y estado notificado)")
+
         return {
             'success': True,
             'timestamp': datetime.now().isoformat(),
@@ -475,30 +525,36 @@ def checkin_reminders_cron():
     from email_processor import send_email
 
     try:
-        ahora = datetime.now()
-        # Ventana: vuelos entre 23 y 25 horas desde ahora
-        desde = ahora + timedelta(hours=23)
-        hasta = ahora + timedelta(hours=25)
+        ahora_utc = datetime.utcnow()
+        # Ventana: vuelos que salen entre 23 y 25 horas desde ahora (instante UTC exacto)
+        desde = ahora_utc + timedelta(hours=23)
+        hasta = ahora_utc + timedelta(hours=25)
 
-        # Buscar vuelos en esa ventana
-        vuelos = Viaje.query.filter(
+        # Rango sobre el índice de salida_utc (vuelos sin hora conocida no tienen salida_utc)
+        vuelos_24h = Viaje.query.filter(
             Viaje.tipo == 'vuelo',
-            Viaje.fecha_salida >= desde.date(),
-            Viaje.fecha_salida <= hasta.date()
+            Viaje.salida_utc >= desde,
+            Viaje.salida_utc <= hasta
         ).all()
 
-        # Filtrar por hora exacta (fecha_salida + hora_salida)
-        vuelos_24h = []
-        for v in vuelos:
-            if not v.hora_salida:
-                continue
+        # Fallback: con hora pero sin salida_utc (aeropuerto de origen desconocido),
+        # la hora local se compara contra la hora del servidor como antes
+        ahora = datetime.now()
+        desde_local = ahora + timedelta(hours=23)
+        hasta_local = ahora + timedelta(hours=25)
+        for v in Viaje.query.filter(
+            Viaje.tipo == 'vuelo',
+            Viaje.salida_utc.is_(None),
+            Viaje.hora_salida.isnot(None),
+            Viaje.fecha_salida >= desde_local.replace(hour=0, minute=0, second=0, microsecond=0),
+            Viaje.fecha_salida <= hasta_local
+        ):
             try:
                 hora = datetime.strptime(v.hora_salida, '%H:%M').time()
-                dt_vuelo = datetime.combine(v.fecha_salida, hora)
-                if desde <= dt_vuelo <= hasta:
-                    vuelos_24h.append(v)
-            except:
+            except ValueError:
                 continue
+            if desde_local <= datetime.combine(v.fecha_salida.date(), hora) <= hasta_local:
+                vuelos_24h.append(v)
 
         emails_enviados = 0
         push_enviados = 0
@@ -517,7 +573,7 @@ def checkin_reminders_cron():
             numero_vuelo = datos.get('numero_vuelo') or ''
             origen = datos.get('origen') or vuelo.origen or ''
             destino = datos.get('destino') or vuelo.destino or ''
-            hora_salida = vuelo.hora_salida or ''
+            hora_salida = vuelo.hora_salida or datos.get('hora_salida') or ''
             codigo = datos.get('codigo_reserva') or vuelo.codigo_reserva or ''
 
             # CANAL 1: Enviar EMAIL (si el usuario tiene emails activados)
@@ -602,6 +658,7 @@ def api_check_flights():
     """
     try:
         from flight_monitor import check_all_upcoming_flights
+        # Sin persistir: no consume el estado notificado ni reprograma la cola del cron
         cambios = check_all_upcoming_flights(db.session)
         
         return {
@@ -623,6 +680,7 @@ def check_flights_manual():
     """Página para chequear vuelos manualmente (para testing)"""
     try:
         from flight_monitor import check_all_upcoming_flights
+        # Sin persistir: no consume el estado notificado ni reprograma la cola del cron
         cambios = check_all_upcoming_flights(db.session)
 
         return render_template('check_flights.html',
@@ -741,6 +799,8 @@ def fix_vuelo(vuelo_id):
         # Agregar código alternativo explícitamente
         viaje.add_codigo_alternativo(data['codigo_alternativo'])
 
+    actualizar_instantes_utc(viaje)
+
     # Resetear datos FR24 (solo si no se especifica reset_fr24=false)
     if data.get('reset_fr24', True):
         viaje.status_fr24 = None
@@ -788,6 +848,17 @@ def delete_vuelo(vuelo_id):
     return jsonify({'success': True, 'deleted': info})
 
 
+@api_bp.route('/api/debug/extraccion-cache', methods=['GET'])
+def debug_extraccion_cache():
+    """Hit rate del cache de extracciones con Claude en el mes (admin only)"""
+    if not verificar_admin_auth():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    from utils.extraccion_cache import get_estadisticas_extraccion
+
+    return jsonify(get_estadisticas_extraccion())
+
+
 @api_bp.route('/api/debug/oauth-status', methods=['GET'])
 def debug_oauth_status():
     """
@@ -987,6 +1058,33 @@ def migrate_pasajeros():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@api_bp.route('/migrate-indice-pasajeros')
+def migrate_indice_pasajeros():
+    """
+    Backfill del índice viaje_pasajeros para viajes existentes.
+    Idempotente: reconstruye las filas de cada viaje.
+    """
+    if not verificar_admin_auth():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        from utils.passenger_index import backfill_indice_pasajeros
+        result = backfill_indice_pasajeros()
+
+        return jsonify({
+            'success': True,
+            'viajes_procesados': result['viajes_procesados'],
+            'personas_indexadas': result['personas_indexadas'],
+            'errors': result['errors'][:10]  # Mostrar máximo 10 errores
+        })
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @api_bp.route('/migrate-db')
 def migrate_db():
     """Endpoint para migración de BD - requiere autenticación"""
@@ -1005,6 +1103,8 @@ def migrate_db():
             # Tabla user - campos básicos
             conn.execute(db.text("ALTER TABLE \"user\" ADD COLUMN IF NOT EXISTS nombre_pax VARCHAR(50)"))
             conn.execute(db.text("ALTER TABLE \"user\" ADD COLUMN IF NOT EXISTS apellido_pax VARCHAR(50)"))
+            conn.execute(db.text("ALTER TABLE \"user\" ADD COLUMN IF NOT EXISTS apellido_pax_norm VARCHAR(100)"))
+            conn.execute(db.text("CREATE INDEX IF NOT EXISTS ix_user_apellido_pax_norm ON \"user\"(apellido_pax_norm)"))
             conn.execute(db.text("ALTER TABLE \"user\" ADD COLUMN IF NOT EXISTS calendar_token VARCHAR(36)"))
             
             # MVP11: Campo para toggle de combinación de vuelos
@@ -1065,9 +1165,37 @@ def migrate_db():
             conn.execute(db.text("ALTER TABLE viaje ADD COLUMN IF NOT EXISTS status_fr24 VARCHAR(50)"))
             conn.execute(db.text("ALTER TABLE viaje ADD COLUMN IF NOT EXISTS delay_minutos INTEGER"))
 
+            # Cola de monitoreo FR24: próximo check por vuelo
+            conn.execute(db.text("ALTER TABLE viaje ADD COLUMN IF NOT EXISTS next_check_at TIMESTAMP"))
+            conn.execute(db.text("CREATE INDEX IF NOT EXISTS ix_viaje_next_check_at ON viaje(next_check_at)"))
+
+            # Último estado notificado por vuelo (alertas solo en transiciones)
+            conn.execute(db.text("ALTER TABLE viaje ADD COLUMN IF NOT EXISTS notif_estado VARCHAR(50)"))
+            conn.execute(db.text("ALTER TABLE viaje ADD COLUMN IF NOT EXISTS notif_delay_bucket INTEGER"))
+            conn.execute(db.text("ALTER TABLE viaje ADD COLUMN IF NOT EXISTS notif_destino VARCHAR(10)"))
+
             # Códigos alternativos de reserva (para detectar duplicados con múltiples códigos)
             conn.execute(db.text("ALTER TABLE viaje ADD COLUMN IF NOT EXISTS codigos_alternativos TEXT"))
 
+            # Índice para get_viajes_for_user (owner OR viaje_visible)
+            conn.execute(db.text("CREATE INDEX IF NOT EXISTS ix_viaje_user_id ON viaje(user_id)"))
+
+            # Índice para la ventana temporal del calendar feed (?meses=N)
+            conn.execute(db.text("CREATE INDEX IF NOT EXISTS ix_viaje_fecha_salida ON viaje(fecha_salida)"))
+
+            # Instantes UTC de salida/llegada (ventanas exactas de monitor y recordatorios)
+            conn.execute(db.text("ALTER TABLE viaje ADD COLUMN IF NOT EXISTS salida_utc TIMESTAMP"))
+            conn.execute(db.text("ALTER TABLE viaje ADD COLUMN IF NOT EXISTS llegada_utc TIMESTAMP"))
+            conn.execute(db.text("CREATE INDEX IF NOT EXISTS ix_viaje_salida_utc ON viaje(salida_utc)"))
+            conn.execute(db.text("CREATE INDEX IF NOT EXISTS ix_viaje_llegada_utc ON viaje(llegada_utc)"))
+
+            # Cola de sync Gmail: single-flight (un job pendiente por conexión)
+            conn.execute(db.text("ALTER TABLE gmail_sync_job ADD COLUMN IF NOT EXISTS notificaciones INTEGER NOT NULL DEFAULT 1"))
+            conn.execute(db.text("""
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_gmail_sync_job_pendiente
+                ON gmail_sync_job(connection_id) WHERE estado = 'pendiente'
+            """))
+
             conn.commit()
         
         # ========================================
@@ -1093,6 +1221,23 @@ def migrate_db():
             user.notif_cancelacion = True
             user.notif_gate = True
 
+        # Apellido normalizado para el matching de pasajeros (usuarios anteriores a la columna)
+        from utils.helpers import normalize_name
+        users_sin_apellido_norm = User.query.filter(
+            User.apellido_pax.isnot(None), User.apellido_pax_norm.is_(None)
+        ).all()
+        for user in users_sin_apellido_norm:
+            user.apellido_pax_norm = normalize_name(user.apellido_pax) or None
+
+        # salida_utc/llegada_utc para vuelos futuros cargados antes de estas columnas
+        vuelos_sin_utc = Viaje.query.filter(
+            Viaje.tipo == 'vuelo',
+            Viaje.salida_utc.is_(None),
+            Viaje.fecha_salida >= date.today()
+        ).all()
+        for vuelo in vuelos_sin_utc:
+            actualizar_instantes_utc(vuelo)
+
         db.session.commit()
 
         return {
@@ -1100,7 +1245,9 @@ def migrate_db():
             'message': 'Migración completada (incluye MVP14: EmailConnection)',
             'tokens_generados': len(users_sin_token),
             'combinar_vuelos_seteados': len(users_sin_combinar),
-            'notificaciones_seteadas': len(users_sin_notif)
+            'notificaciones_seteadas': len(users_sin_notif),
+            'apellidos_normalizados': len(users_sin_apellido_norm),
+            'vuelos_utc_calculados': sum(1 for v in vuelos_sin_utc if v.salida_utc)
         }, 200
     except Exception as e:
         import traceback
@@ -1149,7 +1296,9 @@ def scan_gmail_manual():
         from googleapiclient.discovery import build
         from email_processor import email_parece_reserva
         from blueprints.gmail_webhook import get_full_email_content
-        from utils.gmail_scanner import extract_body, extract_pdf_attachments, extract_text_from_pdf
+        from utils.gmail_scanner import (
+            extract_body, get_messages_batch, download_pdf_attachments_batch, filtrar_por_metadata
+        )
         from models import EmailConnection, ProcessedEmail
 
         # Parámetros
@@ -1205,16 +1354,45 @@ def scan_gmail_manual():
         reservas_creadas = 0
         errors = []
 
-        for msg_info in messages[:max_emails]:
-            msg_id = msg_info['id']
+        msg_ids = [msg_info['id'] for msg_info in messages[:max_emails]]
 
+        # Los ya procesados no se vuelven a bajar
+        ya_procesados = {
+            message_id for (message_id,) in db.session.query(ProcessedEmail.message_id).filter(
+                ProcessedEmail.connection_id == connection.id,
+                ProcessedEmail.message_id.in_(msg_ids)
+            )
+        }
+        if ya_procesados:
+            print(f"⏭️ {len(ya_procesados)} emails ya procesados")
+        msg_ids = [msg_id for msg_id in msg_ids if msg_id not in ya_procesados]
+
+        # Primera pasada solo con metadata (subject, remitente, snippet)
+        ids_candidatos, metadata = filtrar_por_metadata(service, msg_ids)
+        for msg_id in msg_ids:
+            if msg_id not in metadata:
+                # Falló la metadata (429, 5xx, red): queda para el próximo scan
+                errors.append(f"{msg_id}: no se pudo obtener metadata")
+            elif msg_id not in ids_candidatos:
+                # Marcar como procesado aunque no tenga reserva
+                db.session.add(ProcessedEmail(
+                    connection_id=connection.id,
+                    message_id=msg_id,
+                    had_reservation=False
+                ))
+        db.session.commit()
+
+        # Emails completos de los candidatos (un batch HTTP en vez de un GET por email)
+        mensajes, errores_fetch = get_messages_batch(service, ids_candidatos)
+
+        # Pre-filtro con el body, para bajar en un solo batch los PDFs de los
+        # que siguen siendo candidatos
+        candidatos = []
+        for msg_id in ids_candidatos:
             try:
-                # Obtener email completo
-                msg = service.users().messages().get(
-                    userId='me',
-                    id=msg_id,
-                    format='full'
-                ).execute()
+                if msg_id not in mensajes:
+                    raise errores_fetch.get(msg_id) or RuntimeError('Email no encontrado')
+                msg = mensajes[msg_id]
 
                 # Extraer headers
                 headers = msg.get('payload', {}).get('headers', [])
@@ -1226,21 +1404,8 @@ def scan_gmail_manual():
                     elif h['name'].lower() == 'from':
                         from_header = h['value']
 
-                # Verificar si ya fue procesado
-                already_processed = ProcessedEmail.query.filter_by(
-                    connection_id=connection.id,
-                    message_id=msg_id
-                ).first()
-
-                if already_processed:
-                    print(f"⏭️ Email ya procesado: {subject[:50] if subject else '(sin subject)'}")
-                    continue
-
-                # Extraer contenido completo
-                payload = msg.get('payload', {})
-                full_content = get_full_email_content(service, msg_id, payload, subject or '')
-
                 # Pre-filtro
+                payload = msg.get('payload', {})
                 body_preview = extract_body(payload)[:2000]
                 attachment_names = []
 
@@ -1267,6 +1432,25 @@ def scan_gmail_manual():
                     db.session.commit()
                     continue
 
+                candidatos.append((msg_id, subject, payload))
+
+            except Exception as e:
+                errors.append(f"Error procesando email {msg_id}: {str(e)}")
+                print(f"❌ Error: {e}")
+                db.session.rollback()
+                continue
+
+        adjuntos = download_pdf_attachments_batch(
+            service, {msg_id: payload for msg_id, _, payload in candidatos}
+        )
+
+        for msg_id, subject, payload in candidatos:
+            try:
+                # Extraer contenido completo
+                full_content = get_full_email_content(
+                    service, msg_id, payload, subject or '', attachments=adjuntos[msg_id]
+                )
+
                 # Extraer con Claude
                 print(f"✅ Procesando: {subject[:50] if subject else '(sin subject)'}")
                 vuelos = extraer_info_con_claude(full_content)
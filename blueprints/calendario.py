@@ -2,16 +2,19 @@
 Blueprint de Calendario - Mi Agente Viajes
 Rutas: /calendar-feed, /export-calendar, /update-calendar, /cancel-calendar, /regenerate-calendar-token
 """
-from flask import Blueprint, make_response, redirect, url_for, flash, jsonify
+from flask import Blueprint, Response, make_response, redirect, url_for, flash, jsonify, request, stream_with_context
 from flask_login import login_required, current_user
 from datetime import datetime, timedelta, date
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from itertools import groupby
+import hashlib
 import json
+import threading
 import pytz
 from icalendar import Calendar, Event, Alarm, Timezone, TimezoneStandard
 
 from models import db, Viaje, User
-from utils.helpers import get_viajes_for_user, deduplicar_vuelos_en_grupo
+from utils.helpers import query_viajes_for_user, deduplicar_vuelos_en_grupo
 
 calendario_bp = Blueprint('calendario', __name__)
 
@@ -62,19 +65,40 @@ def calendar_feed(token):
 
     MVP10: Agrega eventos all-day para viajes con múltiples vuelos
     MVP11: Deduplica vuelos combinados
+
+    Query params:
+        meses: opcional, limita el historial a los últimos N meses
+               (los viajes futuros siempre se incluyen). Sin param: todo.
+
+    El feed lleva un ETag derivado de (id, actualizado) de los viajes visibles:
+    si el cliente ya tiene esa versión responde 304 sin cargar los viajes.
+    Los VEVENT se cachean como bytes por (id, actualizado) y el .ics se
+    streamea grupo por grupo, sin armar el calendario completo en memoria.
     """
     # Buscar usuario por token
     user = User.query.filter_by(calendar_token=token).first()
     if not user:
         return jsonify({'error': 'Invalid calendar token'}), 404
-    
-    # Obtener viajes del usuario (owner + pasajero)
-    viajes = get_viajes_for_user(user, Viaje, User)
-
-    # Ordenar por fecha (incluye pasados y futuros)
-    viajes = sorted(viajes, key=lambda v: v.fecha_salida)
 
-    # Crear calendario
+    combinar = getattr(user, 'combinar_vuelos', True)
+    if combinar is None:
+        combinar = True
+
+    # Ventana temporal: últimos N meses + todo lo futuro
+    desde = None
+    meses = request.args.get('meses', type=int)
+    if meses and meses > 0:
+        desde = datetime.combine(date.today() - timedelta(days=30 * meses), datetime.min.time())
+
+    # Versión del feed: query liviana sin cargar datos JSONB
+    etag, last_modified = _version_feed(user, combinar, desde)
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    # Cabecera del calendario (sin eventos)
     cal = Calendar()
     cal.add('prodid', '-//Mi Agente Viajes//')
     cal.add('version', '2.0')
@@ -86,45 +110,48 @@ def calendar_feed(token):
     # Agregar VTIMEZONE para compatibilidad con iOS Calendar
     cal.add_component(_crear_vtimezone_argentina())
 
-    # Agrupar viajes por grupo_viaje
-    grupos = {}
-    for viaje in viajes:
-        grupo_id = viaje.grupo_viaje or f'solo_{viaje.id}'
-        if grupo_id not in grupos:
-            grupos[grupo_id] = []
-        grupos[grupo_id].append(viaje)
-    
-    # Crear eventos
-    for grupo_id, viajes in grupos.items():
-        # Ordenar viajes por fecha
-        viajes_ordenados = sorted(viajes, key=lambda v: v.fecha_salida)
-
-        # MVP11: Deduplicar si el usuario tiene la preferencia activa (solo para vuelos)
-        combinar = getattr(user, 'combinar_vuelos', True)
-        if combinar is None:
-            combinar = True
-
-        if combinar:
-            viajes_ordenados = deduplicar_vuelos_en_grupo(viajes_ordenados)
-
-        # Crear evento individual para cada reserva
-        for viaje in viajes_ordenados:
-            event = _crear_evento_calendario(viaje)
-            cal.add_component(event)
-
-        # MVP10: Crear evento all-day SOLO si el grupo tiene 2+ items
-        if len(viajes_ordenados) >= 2 and not grupo_id.startswith('solo_'):
-            event_allday = _crear_evento_allday(grupo_id, viajes_ordenados)
-            if event_allday:
-                cal.add_component(event_allday)
-    
+    cierre = b'END:VCALENDAR\r\n'
+    cabecera = cal.to_ical()[:-len(cierre)]
+
+    # Viajes del usuario (owner + pasajero) ordenados por grupo, para streamear grupo a grupo
+    viajes_query = _query_feed(user, desde).order_by(
+        Viaje.grupo_viaje, Viaje.fecha_salida, Viaje.id
+    ).yield_per(FEED_BATCH_SIZE)
+
+    def generar():
+        yield cabecera
+
+        grupos = groupby(viajes_query, key=lambda v: v.grupo_viaje or f'solo_{v.id}')
+        for grupo_id, viajes in grupos:
+            # Ordenar viajes por fecha
+            viajes_ordenados = sorted(viajes, key=lambda v: v.fecha_salida)
+
+            # MVP11: Deduplicar si el usuario tiene la preferencia activa (solo para vuelos)
+            if combinar:
+                viajes_ordenados = deduplicar_vuelos_en_grupo(viajes_ordenados)
+
+            # Crear evento individual para cada reserva
+            fragmentos = [_evento_feed_ical(viaje) for viaje in viajes_ordenados]
+
+            # MVP10: Crear evento all-day SOLO si el grupo tiene 2+ items
+            if len(viajes_ordenados) >= 2 and not grupo_id.startswith('solo_'):
+                event_allday = _crear_evento_allday(grupo_id, viajes_ordenados)
+                if event_allday:
+                    fragmentos.append(event_allday.to_ical())
+
+            yield b''.join(fragmentos)
+
+        yield cierre
+
     # Response con headers correctos para webcal
-    response = make_response(cal.to_ical())
+    response = Response(stream_with_context(generar()), mimetype='text/calendar')
     response.headers['Content-Type'] = 'text/calendar; charset=utf-8'
     response.headers['Content-Disposition'] = 'inline; filename="calendar.ics"'
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+    # no-cache (no no-store): el cliente guarda el feed y revalida con If-None-Match
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
     
     return response
 
@@ -240,6 +267,70 @@ def cancel_calendar(grupo_id):
 # FUNCIONES HELPER PRIVADAS
 # ============================================
 
+# Viajes cargados por round-trip al streamear el feed
+FEED_BATCH_SIZE = 200
+
+# Cache en memoria de VEVENTs serializados del feed: (id, actualizado, combinado) → bytes
+FEED_EVENT_CACHE_MAX = 5000
+_feed_event_cache = OrderedDict()
+_feed_event_cache_lock = threading.Lock()
+
+
+def _query_feed(user, desde=None):
+    """Query de viajes del feed: owner + pasajero, opcionalmente desde una fecha (range sobre fecha_salida)"""
+    query = query_viajes_for_user(user, Viaje)
+    if desde:
+        query = query.filter(Viaje.fecha_salida >= desde)
+    return query
+
+
+def _version_feed(user, combinar, desde=None):
+    """
+    Calcula (etag, last_modified) del feed del usuario a partir de
+    (id, actualizado) de sus viajes visibles, sin cargar los datos.
+    """
+    filas = _query_feed(user, desde).with_entities(
+        Viaje.id, Viaje.actualizado
+    ).order_by(Viaje.id).all()
+
+    h = hashlib.sha1()
+    h.update(f'{user.id}|{user.nombre}|{combinar}|{desde}'.encode('utf-8'))
+    for viaje_id, actualizado in filas:
+        h.update(f'|{viaje_id}:{actualizado.isoformat() if actualizado else ""}'.encode('utf-8'))
+
+    fechas = [actualizado for _, actualizado in filas if actualizado]
+    return h.hexdigest(), (max(fechas) if fechas else None)
+
+
+def _evento_feed_ical(viaje):
+    """
+    Devuelve el VEVENT serializado de un viaje para el feed, usando el cache
+    si el viaje no cambió. Los vuelos combinados (MVP11) incluyen en la clave
+    los pasajeros/códigos agregados de las otras reservas.
+    """
+    combinado = None
+    if getattr(viaje, '_es_combinado', False):
+        combinado = json.dumps(
+            [getattr(viaje, '_pasajeros_combinados', []), getattr(viaje, '_codigos_reserva', [])],
+            sort_keys=True, default=str
+        )
+
+    key = (viaje.id, viaje.actualizado, combinado)
+    with _feed_event_cache_lock:
+        ical = _feed_event_cache.get(key)
+        if ical is not None:
+            _feed_event_cache.move_to_end(key)
+            return ical
+
+    ical = _crear_evento_calendario(viaje).to_ical()
+
+    with _feed_event_cache_lock:
+        _feed_event_cache[key] = ical
+        while len(_feed_event_cache) > FEED_EVENT_CACHE_MAX:
+            _feed_event_cache.popitem(last=False)
+    return ical
+
+
 def _get_vuelos_by_grupo(grupo_id):
     """Obtiene vuelos por grupo_id o viaje individual"""
     if grupo_id.startswith('solo_'):
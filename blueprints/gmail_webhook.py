@@ -6,26 +6,41 @@ MVP14f: Fix multi-cuenta - setup_gmail_watch por email específico
 MVP14g: Extracción de PDFs adjuntos + deduplicación por contenido
 """
 import base64
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import json
+import os
+import threading
 from datetime import datetime
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from googleapiclient.discovery import build
 
 from models import db, EmailConnection, Viaje
 from utils.gmail_scanner import (
     extract_body,
     extract_pdf_attachments,
-    extract_text_from_pdf,
+    download_pdf_attachments_batch,
+    get_messages_batch,
+    filtrar_por_metadata,
+    GMAIL_BATCH_MAX,
     check_duplicate,
     check_duplicate_by_content
 )
-from utils.claude import extraer_info_con_claude
+from utils.claude import extraer_info_con_claude, buscar_extraccion_cacheada, guardar_extraccion_en_cache
 from email_processor import email_parece_reserva
 from utils.save_reservation import save_reservation, merge_reservation_data
+from utils.gmail_jobs import encolar_sync_gmail, despertar_workers
+from utils.email_dedup import normalizar_message_id, hash_contenido, reclamar_email
+from utils.pdf_extractor import armar_contenido_email
 
 gmail_webhook_bp = Blueprint('gmail_webhook', __name__)
 PUBSUB_TOPIC = 'projects/mi-agente-viajes/topics/gmail-notifications'
 
+# Concurrencia del pipeline de process_new_emails (configurable por env)
+GMAIL_FETCH_WORKERS = int(os.getenv('GMAIL_FETCH_WORKERS', '4'))
+GMAIL_EXTRACT_WORKERS = int(os.getenv('GMAIL_EXTRACT_WORKERS', '3'))
+
+_servicios_thread = threading.local()
+
 
 def setup_gmail_watch(user_id, gmail_email=None):
     """
@@ -118,9 +133,10 @@ def renew_expired_watches():
     }
 
 
-def get_full_email_content(service, msg_id, payload, subject=''):
+def get_full_email_content(service, msg_id, payload, subject='', attachments=None):
     """
     Extrae todo el contenido del email: body + PDFs adjuntos.
+    attachments: PDFs ya descargados en batch; si es None se descargan acá.
     
     Returns:
         str: Texto combinado listo para Claude
@@ -128,31 +144,304 @@ def get_full_email_content(service, msg_id, payload, subject=''):
     # Extraer body
     body_text = extract_body(payload)
     
-    # Extraer texto de PDFs adjuntos
-    pdf_texts = []
-    attachments = extract_pdf_attachments(service, msg_id, payload)
+    if attachments is None:
+        attachments = extract_pdf_attachments(service, msg_id, payload)
+    
+    # Body + texto de PDFs, hasta el presupuesto de Claude (los PDFs que no entran ni se abren)
+    return armar_contenido_email(subject, body_text, attachments)
+
+
+def _get_service_thread(credentials):
+    """Cliente Gmail del thread actual (googleapiclient/httplib2 no es thread-safe)"""
+    service = getattr(_servicios_thread, 'service', None)
+    if service is None or getattr(_servicios_thread, 'credentials', None) is not credentials:
+        service = build('gmail', 'v1', credentials=credentials)
+        _servicios_thread.service = service
+        _servicios_thread.credentials = credentials
+    return service
+
+
+def _descargar_lote(credentials, msg_ids):
+    """
+    Etapa fetch (corre en el pool), en dos pasadas para no bajar lo que el
+    pre-filtro va a descartar:
+    1. metadata del lote en un batch HTTP + pre-filtro por subject,
+       remitente, snippet y Content-Type
+    2. mensaje completo de los candidatos en otro batch + pre-filtro con el body
+    Los adjuntos se bajan después (_descargar_adjuntos), una vez que el
+    thread de la BD descartó los ya procesados por otra cuenta.
+    No toca la BD.
+
+    Returns:
+        list de dicts con msg_id, subject, rfc_message_id, content_hash,
+        payload (None si el pre-filtro lo descartó) y error (excepción si
+        falló la descarga del mensaje)
+    """
+    service = _get_service_thread(credentials)
+    ids_candidatos, metadata = filtrar_por_metadata(service, msg_ids)
+    mensajes, errores = get_messages_batch(service, ids_candidatos)
+
+    resultados = []
+    for msg_id in ids_candidatos:
+        resultado = {
+            'msg_id': msg_id, 'subject': metadata[msg_id]['subject'], 'rfc_message_id': None,
+            'content_hash': None, 'payload': None, 'error': None
+        }
+        resultados.append(resultado)
+        if msg_id not in mensajes:
+            resultado['error'] = errores.get(msg_id)
+            continue
+
+        msg = mensajes[msg_id]
+        headers = msg.get('payload', {}).get('headers', [])
+        from_header = subject = rfc_message_id = None
+        
+        for h in headers:
+            if h['name'].lower() == 'from':
+                from_header = h['value']
+            elif h['name'].lower() == 'subject':
+                subject = h['value']
+            elif h['name'].lower() == 'message-id':
+                rfc_message_id = h['value']
+        
+        # MVP14g: Extraer body para pre-filtro
+        payload = msg.get('payload', {})
+        body = extract_body(payload)
+        body_preview = body[:2000]
+
+        # Extraer nombres de adjuntos del payload (sin descargar contenido)
+        attachment_names = []
+        def get_attachment_names(parts):
+            for part in parts:
+                filename = part.get('filename', '')
+                if filename:
+                    attachment_names.append(filename)
+                if 'parts' in part:
+                    get_attachment_names(part['parts'])
+
+        if 'parts' in payload:
+            get_attachment_names(payload['parts'])
+
+        resultado['subject'] = subject
+
+        # Filtro por keywords (incluye nombres de adjuntos)
+        if not email_parece_reserva(subject or '', body_preview, attachment_names):
+            print(f"⏭️ Email descartado por pre-filtro (no parece reserva): {subject[:50] if subject else '(sin subject)'}")
+            continue
+
+        print(f"✅ Email parece reserva, procesando: {subject[:50] if subject else '(sin subject)'}")
+        resultado['payload'] = payload
+        resultado['rfc_message_id'] = normalizar_message_id(rfc_message_id)
+        resultado['content_hash'] = hash_contenido(subject, body)
+
+    return resultados
+
+
+def _descargar_adjuntos(credentials, mensajes):
+    """
+    Etapa adjuntos (corre en el pool): PDFs de todos los mensajes en un solo
+    batch y contenido completo (body + PDFs) de cada uno. No toca la BD.
+
+    Returns:
+        la misma lista de mensajes, con full_content
+    """
+    service = _get_service_thread(credentials)
+
+    # MVP14g: PDFs adjuntos de todos los candidatos en un solo batch
+    adjuntos = download_pdf_attachments_batch(
+        service, {mensaje['msg_id']: mensaje['payload'] for mensaje in mensajes}
+    )
+    for mensaje in mensajes:
+        full_content = get_full_email_content(
+            service, mensaje['msg_id'], mensaje['payload'], mensaje['subject'],
+            attachments=adjuntos[mensaje['msg_id']]
+        )
+
+        # DEBUG: Log muestra del contenido para diagnóstico
+        print(f"📄 Contenido total: {len(full_content)} chars")
+        # Buscar años en el contenido
+        import re
+        years_found = set(re.findall(r'20[2-3][0-9]', full_content))
+        print(f"📅 Años encontrados en contenido: {sorted(years_found)}")
+        mensaje['full_content'] = full_content
+
+    return mensajes
+
+
+def _reclamar_mensaje(connection, mensaje):
+    """
+    Lock del mensaje antes de bajar adjuntos y llamar a Claude: primero por
+    conexión (ProcessedEmail) y después por usuario entre cuentas y
+    proveedores (EmailVisto, por Message-ID, o hash de contenido si no tiene).
+
+    Returns:
+        (ProcessedEmail, EmailVisto o None), o None si hay que saltearlo
+    """
+    subject = mensaje['subject']
+    processed_record = _marcar_procesado(connection, mensaje['msg_id'], subject)
+    if processed_record is None:
+        return None
+
+    visto, nuevo = reclamar_email(
+        connection.user_id, connection.id, mensaje['rfc_message_id'], mensaje['content_hash']
+    )
+    if not nuevo:
+        print(f"⏭️ Email ya procesado desde otra cuenta: {subject[:50] if subject else '(sin subject)'}")
+        processed_record.had_reservation = bool(visto.had_reservation)
+        db.session.commit()
+        return None
+
+    return processed_record, visto
+
+
+def _marcar_procesado(connection, msg_id, subject):
+    """
+    Marca el email como procesado ANTES de llamar a Claude (lock optimista).
+    Esto previene race conditions cuando Gmail envía múltiples notificaciones.
+
+    Returns:
+        ProcessedEmail, o None si otro request ya lo está procesando
+    """
+    from models import ProcessedEmail
+    from sqlalchemy.exc import IntegrityError
+
+    try:
+        # Intentar crear el registro inmediatamente
+        processed_record = ProcessedEmail(
+            connection_id=connection.id,
+            message_id=msg_id,
+            had_reservation=False  # Se actualizará después si hay reservas
+        )
+        db.session.add(processed_record)
+        db.session.commit()
+        print(f"🔒 Email marcado como en procesamiento: {subject[:50] if subject else '(sin subject)'}")
+        return processed_record
+    except IntegrityError:
+        # Otro request ya está procesando o procesó este email
+        db.session.rollback()
+        print(f"⏭️ Email ya está siendo procesado por otro request: {subject[:50] if subject else '(sin subject)'}")
+        return None
+
+
+def _registrar_extraccion(connection, subject, processed_record, visto, vuelos):
+    """
+    Etapa persist: registra el resultado de la extracción en el ProcessedEmail
+    y en el EmailVisto, y guarda las reservas.
+
+    Returns:
+        int: viajes creados
+    """
+    # Actualizar el registro con el resultado
+    if vuelos:
+        processed_record.had_reservation = True
+        if visto:
+            visto.had_reservation = True
+        db.session.commit()
     
-    for att in attachments:
-        pdf_text = extract_text_from_pdf(att['data'])
-        if pdf_text:
-            pdf_texts.append(pdf_text)
-            print(f"    ✅ PDF procesado: {att['filename']} ({len(pdf_text)} chars)")
+    if not vuelos:
+        print(f"No se encontraron vuelos en: {subject}")
+        return 0
     
-    # Combinar
-    full_content = f"Subject: {subject}\n\n{body_text}"
+    return _persistir_reservas(connection, subject, vuelos)
+
+
+def _persistir_reservas(connection, subject, vuelos):
+    """
+    Etapa persist (thread del worker, única sesión de BD): deduplica contra
+    lo existente, hace merge o crea los viajes.
+
+    Returns:
+        int: viajes creados
+    """
+    import uuid
+
+    viajes_creados = 0
+
+    # MVP14g: Deduplicación mejorada - ahora con merge de datos
+    # 1. Por código de reserva - buscar TODOS los viajes (ida y vuelta)
+    codigo = vuelos[0].get('codigo_reserva')
+    if codigo:
+        existing_viajes = Viaje.query.filter_by(
+            user_id=connection.user_id,
+            codigo_reserva=codigo
+        ).all()
+        if existing_viajes:
+            # Intentar actualizar cada viaje existente con datos correspondientes
+            hubo_actualizacion = False
+            for existing in existing_viajes:
+                # Buscar vuelo correspondiente por fecha
+                fecha_existing = existing.fecha_salida
+                for vuelo in vuelos:
+                    fecha_vuelo = vuelo.get('fecha_salida')
+                    if fecha_existing and fecha_vuelo and str(fecha_existing.date()) == fecha_vuelo[:10]:
+                        if merge_reservation_data(existing, vuelo):
+                            hubo_actualizacion = True
+                            print(f"🔄 Reserva actualizada: {codigo} ({fecha_vuelo})")
+            if hubo_actualizacion:
+                db.session.commit()
+            else:
+                print(f"Duplicado sin cambios: {codigo}")
+            return 0
+
+    # 2. Por contenido (vuelo + fecha + ruta)
+    primer_vuelo = vuelos[0]
+    existing_by_content = check_duplicate_by_content(
+        connection.user_id,
+        primer_vuelo.get('numero_vuelo'),
+        primer_vuelo.get('fecha_salida'),
+        primer_vuelo.get('origen'),
+        primer_vuelo.get('destino')
+    )
+    if existing_by_content:
+        # Hacer merge de datos (actualizar info adicional como pasajeros)
+        if merge_reservation_data(existing_by_content, primer_vuelo):
+            db.session.commit()
+            print(f"🔄 Duplicado actualizado: {primer_vuelo.get('numero_vuelo')} {primer_vuelo.get('fecha_salida')}")
+        else:
+            print(f"Duplicado por contenido: {primer_vuelo.get('numero_vuelo')} {primer_vuelo.get('fecha_salida')}")
+        return 0
     
-    if pdf_texts:
-        full_content += "\n\n--- CONTENIDO DE PDFs ADJUNTOS ---\n\n"
-        full_content += "\n\n---\n\n".join(pdf_texts)
-        print(f"    📄 Contenido total: body + {len(pdf_texts)} PDF(s)")
+    grupo = str(uuid.uuid4())[:8]
+
+    for v in vuelos:
+        # Truncar codigo_reserva si es muy largo
+        codigo = v.get('codigo_reserva', '')
+        if codigo and len(codigo) > 250:
+            print(f"⚠️ Código reserva muy largo ({len(codigo)} chars), truncando: {codigo[:50]}...")
+            v['codigo_reserva'] = codigo[:250]
+
+        try:
+            viaje = save_reservation(
+                user_id=connection.user_id,
+                datos_dict=v,
+                grupo_id=grupo,
+                nombre_viaje=None,
+                source='gmail'
+            )
+            viajes_creados += 1
+            print(f"✅ Viaje creado: {v.get('origen', '')} → {v.get('destino', '')}")
+        except ValueError as e:
+            print(f"⚠️ {e}")
+            continue
     
-    return full_content[:15000]  # Limitar para Claude
+    db.session.commit()
+    return viajes_creados
 
 
 def process_new_emails(connection, history_id):
-    """Procesa emails nuevos desde el ultimo historyId."""
+    """
+    Procesa emails nuevos desde el ultimo historyId.
+    Lo corren los workers de utils/gmail_jobs.py: los errores de la History
+    API o de credenciales se propagan para que el job se reintente.
+
+    Pipeline por mensaje con etapas que se solapan entre mensajes:
+    fetch (metadata y mensajes candidatos por lotes en batch HTTP de Gmail)
+    → lock y dedup entre cuentas → adjuntos (PDFs del lote en batch) →
+    extract (Claude) → persist. fetch y adjuntos usan GMAIL_FETCH_WORKERS
+    threads y extract GMAIL_EXTRACT_WORKERS; todo lo que toca la BD corre
+    serializado en este thread con su única sesión, en orden de llegada.
+    """
     from blueprints.gmail_oauth import get_gmail_credentials
-    import uuid
     
     if not connection.history_id:
         print(f"Sin history_id para {connection.email}")
@@ -161,8 +450,7 @@ def process_new_emails(connection, history_id):
     # Usar credenciales de la conexión específica
     credentials = get_gmail_credentials(connection.user_id, gmail_email=connection.email)
     if not credentials:
-        print(f"Sin credenciales para {connection.email}")
-        return 0
+        raise RuntimeError(f"Sin credenciales para {connection.email}")
     
     try:
         service = build('gmail', 'v1', credentials=credentials)
@@ -177,169 +465,110 @@ def process_new_emails(connection, history_id):
         history_list = history_response.get('history', [])
         print(f"Procesando {len(history_list)} cambios para {connection.email}")
         
+        msg_ids = []
         for history in history_list:
             for msg_info in history.get('messagesAdded', []):
                 msg_id = msg_info.get('message', {}).get('id')
-                if not msg_id:
-                    continue
+                if msg_id and msg_id not in msg_ids:
+                    msg_ids.append(msg_id)
+        
+        if msg_ids:
+            fetch_pool = ThreadPoolExecutor(max_workers=GMAIL_FETCH_WORKERS, thread_name_prefix='gmail-fetch')
+            extract_pool = ThreadPoolExecutor(max_workers=GMAIL_EXTRACT_WORKERS, thread_name_prefix='gmail-extract')
+            try:
+                # Lotes para el batch HTTP: repartidos entre los workers de fetch
+                tam_lote = min(GMAIL_BATCH_MAX, -(-len(msg_ids) // GMAIL_FETCH_WORKERS))
+                lotes = [msg_ids[i:i + tam_lote] for i in range(0, len(msg_ids), tam_lote)]
+                etapas = {
+                    fetch_pool.submit(_descargar_lote, credentials, lote): ('fetch', lote, None)
+                    for lote in lotes
+                }
+                pendientes = set(etapas)
                 
-                try:
-                    msg = service.users().messages().get(
-                        userId='me', id=msg_id, format='full'
-                    ).execute()
-                    
-                    headers = msg.get('payload', {}).get('headers', [])
-                    from_header = subject = None
-                    
-                    for h in headers:
-                        if h['name'].lower() == 'from':
-                            from_header = h['value']
-                        elif h['name'].lower() == 'subject':
-                            subject = h['value']
-                    
-                    # MVP14g: Extraer body para pre-filtro
-                    payload = msg.get('payload', {})
-                    body_preview = extract_body(payload)[:2000]
-
-                    # Extraer nombres de adjuntos del payload (sin descargar contenido)
-                    attachment_names = []
-                    def get_attachment_names(parts):
-                        for part in parts:
-                            filename = part.get('filename', '')
-                            if filename:
-                                attachment_names.append(filename)
-                            if 'parts' in part:
-                                get_attachment_names(part['parts'])
-
-                    if 'parts' in payload:
-                        get_attachment_names(payload['parts'])
-
-                    # Filtro por keywords (incluye nombres de adjuntos)
-                    if not email_parece_reserva(subject or '', body_preview, attachment_names):
-                        print(f"⏭️ Email descartado por pre-filtro (no parece reserva): {subject[:50] if subject else '(sin subject)'}")
-                        continue
-
-                    print(f"✅ Email parece reserva, procesando: {subject[:50] if subject else '(sin subject)'}")
-                    
-                    # MVP14g: Extraer body + PDFs adjuntos
-                    full_content = get_full_email_content(
-                        service, msg_id, msg.get('payload', {}), subject
-                    )
-
-                    # DEBUG: Log muestra del contenido para diagnóstico
-                    print(f"📄 Contenido total: {len(full_content)} chars")
-                    # Buscar años en el contenido
-                    import re
-                    years_found = set(re.findall(r'20[2-3][0-9]', full_content))
-                    print(f"📅 Años encontrados en contenido: {sorted(years_found)}")
-
-                    # Marcar email como procesado ANTES de procesarlo (lock optimista)
-                    # Esto previene race conditions cuando Gmail envía múltiples notificaciones
-                    from models import ProcessedEmail
-                    from sqlalchemy.exc import IntegrityError
-
-                    try:
-                        # Intentar crear el registro inmediatamente
-                        processed_record = ProcessedEmail(
-                            connection_id=connection.id,
-                            message_id=msg_id,
-                            had_reservation=False  # Se actualizará después si hay reservas
-                        )
-                        db.session.add(processed_record)
-                        db.session.commit()
-                        print(f"🔒 Email marcado como en procesamiento: {subject[:50] if subject else '(sin subject)'}")
-                    except IntegrityError:
-                        # Otro request ya está procesando o procesó este email
-                        db.session.rollback()
-                        print(f"⏭️ Email ya está siendo procesado por otro request: {subject[:50] if subject else '(sin subject)'}")
-                        continue
-
-                    # Ahora sí, procesar con Claude
-                    vuelos = extraer_info_con_claude(full_content)
-
-                    # Actualizar el registro con el resultado
-                    if vuelos:
-                        processed_record.had_reservation = True
-                        db.session.commit()
-                    
-                    if not vuelos:
-                        print(f"No se encontraron vuelos en: {subject}")
-                        continue
-                    
-                    # MVP14g: Deduplicación mejorada - ahora con merge de datos
-                    # 1. Por código de reserva - buscar TODOS los viajes (ida y vuelta)
-                    codigo = vuelos[0].get('codigo_reserva')
-                    if codigo:
-                        existing_viajes = Viaje.query.filter_by(
-                            user_id=connection.user_id,
-                            codigo_reserva=codigo
-                        ).all()
-                        if existing_viajes:
-                            # Intentar actualizar cada viaje existente con datos correspondientes
-                            hubo_actualizacion = False
-                            for existing in existing_viajes:
-                                # Buscar vuelo correspondiente por fecha
-                                fecha_existing = existing.fecha_salida
-                                for vuelo in vuelos:
-                                    fecha_vuelo = vuelo.get('fecha_salida')
-                                    if fecha_existing and fecha_vuelo and str(fecha_existing.date()) == fecha_vuelo[:10]:
-                                        if merge_reservation_data(existing, vuelo):
-                                            hubo_actualizacion = True
-                                            print(f"🔄 Reserva actualizada: {codigo} ({fecha_vuelo})")
-                            if hubo_actualizacion:
-                                db.session.commit()
-                            else:
-                                print(f"Duplicado sin cambios: {codigo}")
+                while pendientes:
+                    listos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+                    for futuro in listos:
+                        etapa, clave, contexto = etapas.pop(futuro)
+                        if etapa == 'fetch':
+                            try:
+                                mensajes = futuro.result()
+                            except Exception as e:
+                                print(f"Error descargando lote {clave}: {e}")
+                                continue
+                            
+                            reclamados = []
+                            for mensaje in mensajes:
+                                msg_id = mensaje['msg_id']
+                                try:
+                                    if mensaje['error'] is not None:
+                                        print(f"Error procesando mensaje {msg_id} (fetch): {mensaje['error']}")
+                                        continue
+                                    if mensaje['payload'] is None:
+                                        continue
+                                    
+                                    locks = _reclamar_mensaje(connection, mensaje)
+                                    if locks is None:
+                                        continue
+                                    mensaje['locks'] = locks
+                                    reclamados.append(mensaje)
+                                except Exception as e:
+                                    print(f"Error procesando mensaje {msg_id} (fetch): {e}")
+                                    db.session.rollback()
+                            
+                            if reclamados:
+                                descarga = fetch_pool.submit(_descargar_adjuntos, credentials, reclamados)
+                                etapas[descarga] = ('adjuntos', [m['msg_id'] for m in reclamados], None)
+                                pendientes.add(descarga)
                             continue
-
-                    # 2. Por contenido (vuelo + fecha + ruta)
-                    primer_vuelo = vuelos[0]
-                    existing_by_content = check_duplicate_by_content(
-                        connection.user_id,
-                        primer_vuelo.get('numero_vuelo'),
-                        primer_vuelo.get('fecha_salida'),
-                        primer_vuelo.get('origen'),
-                        primer_vuelo.get('destino')
-                    )
-                    if existing_by_content:
-                        # Hacer merge de datos (actualizar info adicional como pasajeros)
-                        if merge_reservation_data(existing_by_content, primer_vuelo):
-                            db.session.commit()
-                            print(f"🔄 Duplicado actualizado: {primer_vuelo.get('numero_vuelo')} {primer_vuelo.get('fecha_salida')}")
-                        else:
-                            print(f"Duplicado por contenido: {primer_vuelo.get('numero_vuelo')} {primer_vuelo.get('fecha_salida')}")
-                        continue
-                    
-                    grupo = str(uuid.uuid4())[:8]
-
-                    for v in vuelos:
-                        # Truncar codigo_reserva si es muy largo
-                        codigo = v.get('codigo_reserva', '')
-                        if codigo and len(codigo) > 250:
-                            print(f"⚠️ Código reserva muy largo ({len(codigo)} chars), truncando: {codigo[:50]}...")
-                            v['codigo_reserva'] = codigo[:250]
-
+                        
+                        if etapa == 'adjuntos':
+                            try:
+                                mensajes = futuro.result()
+                            except Exception as e:
+                                print(f"Error descargando adjuntos de {clave}: {e}")
+                                continue
+                            
+                            for mensaje in mensajes:
+                                msg_id = mensaje['msg_id']
+                                try:
+                                    processed_record, visto = mensaje['locks']
+                                    
+                                    # Mismo contenido ya extraído (reenvío, otra cuenta): sin pasar por Claude
+                                    cacheadas = buscar_extraccion_cacheada(mensaje['full_content'])
+                                    if cacheadas is not None:
+                                        viajes_creados += _registrar_extraccion(
+                                            connection, mensaje['subject'], processed_record, visto, cacheadas
+                                        )
+                                        continue
+                                    
+                                    # Ahora sí, procesar con Claude (el cache se escribe desde este thread)
+                                    extraccion = extract_pool.submit(
+                                        extraer_info_con_claude, mensaje['full_content'], usar_cache=False
+                                    )
+                                    etapas[extraccion] = ('extract', msg_id, mensaje)
+                                    pendientes.add(extraccion)
+                                except Exception as e:
+                                    print(f"Error procesando mensaje {msg_id} (adjuntos): {e}")
+                                    db.session.rollback()
+                            continue
+                        
+                        msg_id = clave
                         try:
-                            viaje = save_reservation(
-                                user_id=connection.user_id,
-                                datos_dict=v,
-                                grupo_id=grupo,
-                                nombre_viaje=None,
-                                source='gmail'
+                            mensaje = contexto
+                            processed_record, visto = mensaje['locks']
+                            vuelos = futuro.result()
+                            guardar_extraccion_en_cache(mensaje['full_content'], vuelos)
+                            viajes_creados += _registrar_extraccion(
+                                connection, mensaje['subject'], processed_record, visto, vuelos
                             )
-                            viajes_creados += 1
-                            print(f"✅ Viaje creado: {v.get('origen', '')} → {v.get('destino', '')}")
-                        except ValueError as e:
-                            print(f"⚠️ {e}")
-                            continue
-                    
-                    db.session.commit()
-                    
-                except Exception as e:
-                    print(f"Error procesando mensaje: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    db.session.rollback()
+                        except Exception as e:
+                            print(f"Error procesando mensaje {msg_id} (extract): {e}")
+                            import traceback
+                            traceback.print_exc()
+                            db.session.rollback()
+            finally:
+                fetch_pool.shutdown(wait=False, cancel_futures=True)
+                extract_pool.shutdown(wait=False, cancel_futures=True)
         
         # Actualizar history_id para próxima vez
         new_history_id = history_response.get('historyId', history_id)
@@ -354,12 +583,17 @@ def process_new_emails(connection, history_id):
         print(f"Error history API: {e}")
         import traceback
         traceback.print_exc()
-        return 0
+        db.session.rollback()
+        raise
 
 
 @gmail_webhook_bp.route('/api/gmail-webhook', methods=['POST'])
 def gmail_webhook():
-    """Recibe notificaciones de Gmail via Pub/Sub."""
+    """
+    Recibe notificaciones de Gmail via Pub/Sub.
+    Solo encola la sincronización y responde enseguida (ver utils/gmail_jobs.py);
+    si no se pudo encolar responde 500 para que Pub/Sub reintente la entrega.
+    """
     try:
         envelope = request.get_json()
         if not envelope:
@@ -384,13 +618,23 @@ def gmail_webhook():
             email=email_address, provider='gmail', is_active=True
         ).first()
         
-        if connection:
-            viajes = process_new_emails(connection, history_id)
-            if viajes:
-                print(f"🎉 Creados {viajes} viajes automáticamente")
-        else:
+        if not connection:
             print(f"No se encontró conexión para: {email_address}")
+            return '', 200
         
+        try:
+            job, nuevo = encolar_sync_gmail(connection.id, history_id)
+        except Exception as e:
+            print(f"❌ No se pudo encolar sync Gmail para {email_address}: {e}")
+            db.session.rollback()
+            return '', 500
+        
+        if nuevo:
+            print(f"📥 Sync Gmail encolada (job {job.id})")
+            despertar_workers(current_app._get_current_object())
+        else:
+            # Ya hay una sync pendiente para la conexión: solo se subió su watermark
+            print(f"🔁 Notificación coalescida en job {job.id} ({job.notificaciones} notificaciones)")
         return '', 200
         
     except Exception as e:
@@ -13,6 +13,8 @@ from utils.iata import get_ciudad_nombre
 from utils.claude import extraer_info_con_claude
 from utils.helpers import calcular_ciudad_principal, normalize_name, get_viajes_for_user, get_hora_salida_display
 from utils.save_reservation import save_reservation
+from utils.passenger_index import actualizar_indice_pasajeros, actualizar_visibilidad_usuario
+from utils.airport_timezone import actualizar_instantes_utc
 from utils.schema_helpers import get_dato, get_titulo_card, get_subtitulo_card
 from config.schemas import RESERVATION_SCHEMAS, get_schema
 
@@ -496,14 +498,18 @@ def carga_rapida():
         if 'pdf_file' in request.files:
             pdf_file = request.files['pdf_file']
             if pdf_file and pdf_file.filename.endswith('.pdf'):
-                try:
-                    from PyPDF2 import PdfReader
-                    reader = PdfReader(pdf_file)
-                    for page in reader.pages:
-                        email_text += page.extract_text() + "\n"
-                except Exception as e:
-                    flash(f"Error leyendo PDF: {str(e)}", "error")
+                from utils.pdf_extractor import extraer_documento_carga_manual
+                documento = extraer_documento_carga_manual(pdf_file.read())
+                if documento['error']:
+                    flash(f"Error leyendo PDF: {documento['error']}", "error")
                     return render_template('carga_rapida.html')
+                email_text = documento['texto']
+                if documento['corte']:
+                    flash(
+                        f"El PDF es muy largo: se leyeron {documento['paginas']} de "
+                        f"{documento['paginas_total']} páginas. Revisá que estén todos los tramos.",
+                        "warning"
+                    )
         
         # Si no hay PDF, usar el texto pegado
         if not email_text.strip():
@@ -766,6 +772,9 @@ def editar(id):
             viaje.numero_vuelo = nuevos_datos.get('numero_vuelo', '')
             viaje.codigo_reserva = nuevos_datos.get('codigo_reserva', '')
 
+            actualizar_instantes_utc(viaje)
+            actualizar_indice_pasajeros(viaje)
+
             db.session.commit()
             grupo_id = viaje.grupo_viaje or f"solo_{viaje.id}"
             flash("✓ Reserva actualizada", "success")
@@ -941,7 +950,9 @@ def guardar_vuelos():
                     precio=precio,
                     raw_data=json.dumps(vuelo_data, ensure_ascii=False)
                 )
-                
+
+                actualizar_instantes_utc(nuevo_viaje)
+                actualizar_indice_pasajeros(nuevo_viaje)
                 db.session.add(nuevo_viaje)
                 vuelos_guardados += 1
             
@@ -1291,6 +1302,7 @@ def update_profile():
     current_user.nombre = request.form.get('nombre', '').strip().title()
     current_user.nombre_pax = request.form.get('nombre_pax', '').strip().title() or None
     current_user.apellido_pax = request.form.get('apellido_pax', '').strip().title() or None
+    actualizar_visibilidad_usuario(current_user)
     # MVP11: Toggle combinar vuelos
     current_user.combinar_vuelos = request.form.get('combinar_vuelos') == 'on'
     # Preferencias de notificaciones
@@ -10,8 +10,8 @@ RESERVATION_SCHEMAS = {
         'campos': [
             {'key': 'aerolinea', 'label': 'Aerolínea', 'type': 'text', 'card': True},
             {'key': 'numero_vuelo', 'label': 'Número de vuelo', 'type': 'text', 'card': True, 'placeholder': 'Ej: AR1234'},
-            {'key': 'origen', 'label': 'Origen (código IATA)', 'type': 'text', 'card': True, 'required': True, 'placeholder': 'Ej: EZE'},
-            {'key': 'destino', 'label': 'Destino (código IATA)', 'type': 'text', 'card': True, 'required': True, 'placeholder': 'Ej: BCN'},
+            {'key': 'origen', 'label': 'Origen (código IATA)', 'type': 'text', 'card': True, 'required': True, 'placeholder': 'Ej: EZE', 'autocomplete': 'airport'},
+            {'key': 'destino', 'label': 'Destino (código IATA)', 'type': 'text', 'card': True, 'required': True, 'placeholder': 'Ej: BCN', 'autocomplete': 'airport'},
             {'key': 'fecha_salida', 'label': 'Fecha salida', 'type': 'date', 'required': True},
             {'key': 'hora_salida', 'label': 'Hora salida', 'type': 'time', 'card': True},
             {'key': 'fecha_llegada', 'label': 'Fecha llegada', 'type': 'date'},
@@ -195,28 +195,9 @@ def get_attachments(service, message_id, payload):
     return attachments
 
 def extract_text_from_pdf(pdf_data):
-    """Extrae texto de un PDF en memoria"""
-    try:
-        import io
-        # Intentar con PyPDF2
-        try:
-            from PyPDF2 import PdfReader
-            reader = PdfReader(io.BytesIO(pdf_data))
-            text = ''
-            for page in reader.pages:
-                text += page.extract_text() + '\n'
-            return text
-        except ImportError:
-            # Intentar con pdfplumber
-            import pdfplumber
-            with pdfplumber.open(io.BytesIO(pdf_data)) as pdf:
-                text = ''
-                for page in pdf.pages:
-                    text += page.extract_text() + '\n'
-                return text
-    except Exception as e:
-        print(f'    ⚠️ Error extrayendo PDF: {e}')
-        return ''
+    """Extrae texto de un PDF en memoria (motor de utils/pdf_extractor.py)"""
+    from utils.pdf_extractor import extraer_texto_pdf
+    return extraer_texto_pdf(pdf_data)
 
 # Keywords que indican que un email puede contener reservas de viaje
 TRAVEL_KEYWORDS = [
@@ -1,8 +1,321 @@
 from fr24sdk.client import Client
-from fr24sdk.exceptions import ApiError, AuthenticationError, Fr24SdkError
+from fr24sdk.exceptions import ApiError, AuthenticationError, Fr24SdkError, TransportError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
 import json
+import threading
+import time
+
+from sqlalchemy.orm.attributes import flag_modified
+
+from utils.airports import get_airport, icao_to_iata
+from utils.airport_timezone import actualizar_instantes_utc
+from scheduler import (
+    get_vuelos_to_check, calcular_proximo_check, proximo_check_para_fecha,
+    registrar_uso_fr24, factor_presupuesto_fr24, filtro_ventana_salida, filtro_no_terminado
+)
+
+# Máximo de números de vuelo por request a flight_summary (límite de la API FR24)
+FR24_MAX_VUELOS_POR_REQUEST = 15
+
+# Concurrencia y rate limit de requests a FR24 (configurables por env)
+FR24_MAX_WORKERS = int(os.getenv('FR24_MAX_WORKERS', '4'))
+FR24_REQUESTS_POR_SEGUNDO = float(os.getenv('FR24_REQUESTS_POR_SEGUNDO', '5'))
+FR24_TIMEOUT_SEGUNDOS = float(os.getenv('FR24_TIMEOUT_SEGUNDOS', '20'))
+
+# Se sigue monitoreando un vuelo hasta estas horas después de la salida (cubre aterrizaje de vuelos largos)
+HORAS_SEGUIMIENTO_POST_SALIDA = 20
+
+
+class _RateLimiter:
+    """Limita requests/segundo entre threads espaciando las llamadas"""
+
+    def __init__(self, por_segundo):
+        self.intervalo = 1.0 / por_segundo if por_segundo > 0 else 0
+        self.lock = threading.Lock()
+        self.proximo = time.monotonic()
+
+    def esperar(self):
+        with self.lock:
+            ahora = time.monotonic()
+            turno = max(ahora, self.proximo)
+            self.proximo = turno + self.intervalo
+        if turno > ahora:
+            time.sleep(turno - ahora)
+
+
+def get_numero_vuelo(vuelo):
+    """Número de vuelo de la columna o de datos JSON"""
+    numero = vuelo.numero_vuelo
+    if not numero and vuelo.datos:
+        datos = vuelo.datos if isinstance(vuelo.datos, dict) else json.loads(vuelo.datos)
+        numero = datos.get('numero_vuelo')
+    return numero
+
+
+def clave_vuelo(numero, fecha_salida):
+    """
+    Clave canónica de un vuelo físico: (número normalizado, fecha de salida).
+    Normaliza formato (quitar espacios: "G3 7680" -> "G37680").
+    """
+    return (numero.replace(' ', '').upper(), fecha_salida.date())
+
+
+# Umbrales (minutos, en valor absoluto) de los buckets de delay notificados
+UMBRALES_DELAY_BUCKET = (5, 15, 30, 60, 120, 240, 480)
+
+
+def _delay_bucket(delay_min):
+    """
+    Bucket del delay para detectar transiciones: 0 = en horario (+/- 5 min),
+    positivo = atrasado, negativo = adelantado; crece con cada umbral superado.
+    """
+    if not delay_min:
+        return 0
+    nivel = sum(1 for umbral in UMBRALES_DELAY_BUCKET if abs(delay_min) > umbral)
+    return nivel if delay_min > 0 else -nivel
+
+
+def _preservar_actualizado(vuelo):
+    """
+    Incluye actualizado con su valor actual en el UPDATE para que no corra
+    el onupdate: los datos de monitoreo no cambian la reserva.
+    """
+    flag_modified(vuelo, 'actualizado')
+
+
+def _ventana_busqueda(fecha_salida):
+    """Rango de búsqueda +/- 1 día por si cambió fecha (datetime sin microsegundos)"""
+    fecha_desde = (fecha_salida - timedelta(days=1)).replace(microsecond=0, second=0, minute=0, hour=0)
+    fecha_hasta = (fecha_salida + timedelta(days=1)).replace(microsecond=0, second=59, minute=59, hour=23)
+    return fecha_desde, fecha_hasta
+
+
+def _numero_fr24(v):
+    """Número de vuelo normalizado de un resultado FR24 (ej: 'AR1303')"""
+    return (getattr(v, 'flight', None) or '').replace(' ', '').upper()
+
+
+def _evaluar_resultado_fr24(candidatos, fecha_salida, salida_utc=None):
+    """
+    Elige entre los resultados FR24 de un número de vuelo el más cercano a
+    la salida programada y arma el dict de estado (ver check_flight_status).
+    salida_utc (naive UTC, ver Viaje.salida_utc) es la referencia exacta;
+    sin ella se usa fecha_salida.
+    """
+    if not candidatos:
+        return {
+            'encontrado': False,
+            'estado': 'no_found',
+            'cambios': []
+        }
+
+    # Seleccionar el vuelo más cercano a la fecha original
+    # (puede haber múltiples vuelos con el mismo número en días consecutivos)
+    referencia = salida_utc or (fecha_salida.replace(tzinfo=None) if fecha_salida.tzinfo else fecha_salida)
+    vuelo = None
+    min_diff = float('inf')
+
+    for v in candidatos:
+        if v.datetime_takeoff:
+            try:
+                takeoff = datetime.fromisoformat(v.datetime_takeoff.replace('Z', '+00:00'))
+                # Comparar con fecha_salida (hacer naive para comparación)
+                takeoff_naive = takeoff.replace(tzinfo=None)
+                fecha_naive = referencia
+                diff = abs((takeoff_naive - fecha_naive).total_seconds())
+                if diff < min_diff:
+                    min_diff = diff
+                    vuelo = v
+            except Exception:
+                continue
+
+    # Si no encontramos por takeoff, usar el primero
+    if vuelo is None:
+        vuelo = candidatos[0]
+
+    print(f"   📊 FR24: {len(candidatos)} vuelos encontrados, seleccionado el más cercano a {fecha_salida}")
+
+    # Verificar que el vuelo encontrado es del mismo día (tolerancia de 12 horas)
+    if vuelo.datetime_takeoff:
+        try:
+            takeoff_check = datetime.fromisoformat(vuelo.datetime_takeoff.replace('Z', '+00:00'))
+            takeoff_naive = takeoff_check.replace(tzinfo=None)
+            fecha_naive = referencia
+            diff_hours = abs((takeoff_naive - fecha_naive).total_seconds()) / 3600
+
+            if diff_hours > 12:
+                print(f"   ⚠️  Vuelo FR24 es de otro día (diferencia: {diff_hours:.1f}h), ignorando")
+                return {
+                    'encontrado': False,
+                    'estado': 'wrong_day',
+                    'cambios': []
+                }
+        except Exception:
+            pass
+
+    # Parsear fechas
+    takeoff_actual = datetime.fromisoformat(vuelo.datetime_takeoff.replace('Z', '+00:00')) if vuelo.datetime_takeoff else None
+    landed_actual = datetime.fromisoformat(vuelo.datetime_landed.replace('Z', '+00:00')) if vuelo.datetime_landed else None
+    
+    # Determinar estado
+    if vuelo.flight_ended:
+        estado = 'landed'
+    elif landed_actual:
+        estado = 'landed'
+    elif takeoff_actual and takeoff_actual < datetime.now(takeoff_actual.tzinfo):
+        estado = 'in_flight'
+    else:
+        estado = 'on_time'  # Por defecto, calcularemos delay después
+    
+    # Calcular delay (comparar con hora programada)
+    delay_minutos = _calcular_delay(takeoff_actual, fecha_salida, salida_utc)
+    if delay_minutos > 15:  # Más de 15 min = delayed
+        estado = 'delayed'
+    
+    return {
+        'encontrado': True,
+        'estado': estado,
+        'delay_minutos': delay_minutos,
+        'datetime_takeoff_actual': takeoff_actual,
+        'datetime_landed_actual': landed_actual,
+        'flight_ended': vuelo.flight_ended,
+        'dest_icao_actual': vuelo.dest_icao_actual,
+        'cambios': []  # Se detectarán comparando con BD
+    }
+
+
+def _calcular_delay(takeoff_actual, fecha_salida, salida_utc=None):
+    """
+    Minutos de diferencia entre el despegue real y la hora programada.
+    Con salida_utc (hora local del aeropuerto de origen ya pasada a UTC) el
+    cálculo es exacto; si no, se asume fecha_salida en hora de Buenos Aires.
+    """
+    if not takeoff_actual:
+        return 0
+
+    import pytz
+    if salida_utc:
+        fecha_salida = pytz.UTC.localize(salida_utc)
+    elif fecha_salida.tzinfo is None:
+        # Convertir fecha_salida a timezone-aware si no lo es
+        tz_arg = pytz.timezone('America/Argentina/Buenos_Aires')
+        fecha_salida = tz_arg.localize(fecha_salida)
+
+    diferencia = (takeoff_actual - fecha_salida).total_seconds() / 60
+    return int(diferencia)
+
+
+# ============================================
+# CACHE COMPARTIDO DE ESTADOS FR24
+# ============================================
+
+_CAMPOS_FECHA_STATUS = ('datetime_takeoff_actual', 'datetime_landed_actual')
+
+
+def _leer_cache_status(consultas, ahora, salidas_utc=None):
+    """
+    Busca en flight_status_cache los estados vigentes de las consultas.
+    Si la hora programada difiere de la usada al cachear (o se conoce la
+    salida UTC de la consulta), recalcula el delay.
+
+    Returns:
+        dict (numero_vuelo, fecha_salida) → dict de estado (solo hits)
+    """
+    from models import FlightStatusCache
+
+    claves = {}
+    for numero, fecha_salida in consultas:
+        claves.setdefault(clave_vuelo(numero, fecha_salida), []).append((numero, fecha_salida))
+    if not claves:
+        return {}
+
+    filas = FlightStatusCache.query.filter(
+        FlightStatusCache.numero_vuelo.in_({numero for numero, _ in claves}),
+        FlightStatusCache.fecha.in_({fecha for _, fecha in claves}),
+        FlightStatusCache.expira > ahora
+    ).all()
+
+    hits = {}
+    for fila in filas:
+        for consulta in claves.get((fila.numero_vuelo, fila.fecha), []):
+            status = dict(fila.status or {})
+            for campo in _CAMPOS_FECHA_STATUS:
+                if status.get(campo):
+                    status[campo] = datetime.fromisoformat(status[campo])
+
+            fecha_salida = consulta[1]
+            salida_utc = salidas_utc.get(consulta) if salidas_utc else None
+            if status.get('encontrado') and (salida_utc or fila.fecha_salida_consulta != fecha_salida):
+                status['delay_minutos'] = _calcular_delay(status.get('datetime_takeoff_actual'), fecha_salida, salida_utc)
+                if status.get('estado') in ('on_time', 'delayed'):
+                    status['estado'] = 'delayed' if status['delay_minutos'] > 15 else 'on_time'
+
+            status['cache'] = True
+            hits[consulta] = status
+    return hits
+
+
+def _guardar_cache_status(resultados, ahora):
+    """
+    Guarda en flight_status_cache los estados obtenidos (no los errores).
+    Las filas existentes se cargan en una sola consulta. No hace commit.
+    """
+    from models import db, FlightStatusCache
+
+    por_clave = {}
+    for (numero, fecha_salida), status in resultados.items():
+        if status.get('estado') != 'error':
+            por_clave[clave_vuelo(numero, fecha_salida)] = (fecha_salida, status)
+    if not por_clave:
+        return
+
+    existentes = {
+        (fila.numero_vuelo, fila.fecha): fila
+        for fila in FlightStatusCache.query.filter(
+            FlightStatusCache.numero_vuelo.in_({numero for numero, _ in por_clave}),
+            FlightStatusCache.fecha.in_({fecha for _, fecha in por_clave})
+        )
+    }
+
+    for (numero_norm, fecha), (fecha_salida, status) in por_clave.items():
+        datos = dict(status)
+        for campo in _CAMPOS_FECHA_STATUS:
+            if datos.get(campo):
+                datos[campo] = datos[campo].isoformat()
+
+        fila = existentes.get((numero_norm, fecha))
+        if not fila:
+            fila = FlightStatusCache(numero_vuelo=numero_norm, fecha=fecha)
+            db.session.add(fila)
+
+        fila.status = datos
+        fila.fecha_salida_consulta = fecha_salida
+        fila.consultado = ahora
+        # TTL según tramo de proximidad (mismo criterio que next_check_at)
+        fila.expira = proximo_check_para_fecha(fecha_salida, ahora)
+
+
+def _es_timeout(e):
+    """True si la excepción es un TransportError de FR24 por timeout de httpx"""
+    import httpx
+    return isinstance(e, TransportError) and isinstance(e.__cause__, httpx.TimeoutException)
+
+
+def _status_error(e):
+    """Dict de estado para un error de la API FR24"""
+    if isinstance(e, AuthenticationError):
+        print(f"❌ Error de autenticación FR24: {e}")
+        return {'encontrado': False, 'estado': 'error', 'error': 'auth_error'}
+    if isinstance(e, ApiError):
+        print(f"❌ API Error FR24: {e.status} - {e.message}")
+        return {'encontrado': False, 'estado': 'error', 'error': f'api_error_{e.status}'}
+    print(f"❌ Error inesperado: {e}")
+    import traceback
+    traceback.print_exc()
+    return {'encontrado': False, 'estado': 'error', 'error': str(e)}
+
 
 def check_flight_status(numero_vuelo, fecha_salida):
     """
@@ -22,215 +335,331 @@ def check_flight_status(numero_vuelo, fecha_salida):
             'cambios': list  # Lista de cambios detectados
         }
     """
+    return check_flights_status_batch([(numero_vuelo, fecha_salida)])[(numero_vuelo, fecha_salida)]
+
+
+def check_flights_status_batch(consultas, salidas_utc=None):
+    """
+    Chequea varios vuelos con la menor cantidad de requests a FR24:
+    agrupa por ventana de fechas (+/- 1 día) y manda hasta
+    FR24_MAX_VUELOS_POR_REQUEST números por llamada a get_light. Los números
+    sin resultado exacto en un request compartido se reintentan solos, así
+    el resultado no depende de con qué otros vuelos tocó el batch.
+
+    Los requests corren en paralelo (FR24_MAX_WORKERS threads) sobre un único
+    Client, limitados a FR24_REQUESTS_POR_SEGUNDO y con timeout por request
+    (FR24_TIMEOUT_SEGUNDOS, en el cliente HTTP).
+
+    Args:
+        consultas: lista de (numero_vuelo, fecha_salida)
+        salidas_utc: dict opcional consulta → salida programada en UTC
+            (Viaje.salida_utc), para elegir el vuelo y calcular el delay exactos
+
+    Returns:
+        dict (numero_vuelo, fecha_salida) → dict de estado (ver check_flight_status)
+    """
+    from models import db
+
+    ahora = datetime.now()
+
+    # Estados vigentes en el cache compartido: no gastan créditos FR24.
+    # Savepoint: si el cache falla, la transacción del caller sigue usable
     try:
-        with Client() as client:
-            # Buscar vuelo en rango de +/- 1 día por si cambió fecha
-            # FORMATO CORRECTO: datetime object sin microsegundos
-            fecha_desde = (fecha_salida - timedelta(days=1)).replace(microsecond=0, second=0, minute=0, hour=0)
-            fecha_hasta = (fecha_salida + timedelta(days=1)).replace(microsecond=0, second=59, minute=59, hour=23)
-            
-            result = client.flight_summary.get_light(
-                flights=[numero_vuelo],
-                flight_datetime_from=fecha_desde,
-                flight_datetime_to=fecha_hasta
-            )
-            
-            if not result.data or len(result.data) == 0:
-                return {
-                    'encontrado': False,
-                    'estado': 'no_found',
-                    'cambios': []
-                }
+        with db.session.begin_nested():
+            resultados = _leer_cache_status(consultas, ahora, salidas_utc)
+    except Exception as e:
+        print(f"   ⚠️  Cache FR24 no disponible: {e}")
+        resultados = {}
+
+    if resultados:
+        print(f"   💾 FR24 cache: {len(resultados)}/{len(consultas)} vuelos sin consultar")
+
+    # Agrupar por ventana: vuelos del mismo día comparten request
+    por_ventana = {}
+    for numero, fecha_salida in consultas:
+        if (numero, fecha_salida) in resultados:
+            continue
+        por_ventana.setdefault(_ventana_busqueda(fecha_salida), []).append((numero, fecha_salida))
+
+    # Armar requests: (ventana, números del chunk, consultas que resuelve)
+    requests_fr24 = []
+    for (fecha_desde, fecha_hasta), items in por_ventana.items():
+        numeros = sorted({numero for numero, _ in items})
+        for i in range(0, len(numeros), FR24_MAX_VUELOS_POR_REQUEST):
+            chunk = numeros[i:i + FR24_MAX_VUELOS_POR_REQUEST]
+            chunk_set = set(chunk)
+            requests_fr24.append((fecha_desde, fecha_hasta, chunk, [c for c in items if c[0] in chunk_set]))
+
+    if not requests_fr24:
+        return resultados
+    consultados = {}
+
+    limiter = _RateLimiter(FR24_REQUESTS_POR_SEGUNDO)
+
+    enviados = []
+
+    def consultar(client, fecha_desde, fecha_hasta, chunk):
+        limiter.esperar()
+        enviados.append(chunk)
+        return client.flight_summary.get_light(
+            flights=chunk,
+            flight_datetime_from=fecha_desde,
+            flight_datetime_to=fecha_hasta
+        )
+
+    try:
+        # Timeout por request en el cliente HTTP (httpx): la espera en la cola
+        # del pool o del rate limiter no cuenta
+        with Client(timeout=FR24_TIMEOUT_SEGUNDOS) as client:
+            # El with del executor espera a los requests en curso antes de cerrar el Client
+            with ThreadPoolExecutor(max_workers=min(FR24_MAX_WORKERS, len(requests_fr24))) as executor:
+                pendientes = requests_fr24
+                while pendientes:
+                    futuros = [
+                        (executor.submit(consultar, client, fecha_desde, fecha_hasta, chunk), fecha_desde, fecha_hasta, chunk, items)
+                        for fecha_desde, fecha_hasta, chunk, items in pendientes
+                    ]
+                    pendientes = []
+
+                    for futuro, fecha_desde, fecha_hasta, chunk, items in futuros:
+                        try:
+                            result = futuro.result()
+                        except Exception as e:
+                            if _es_timeout(e):
+                                print(f"   ⏱️  Timeout FR24 para {', '.join(chunk)}")
+                                status = {'encontrado': False, 'estado': 'error', 'error': 'timeout'}
+                            else:
+                                status = _status_error(e)
+                            for consulta in items:
+                                resultados[consulta] = status
+                            continue
+
+                        # Repartir resultados por número de vuelo
+                        por_numero = {}
+                        for v in (result.data or []):
+                            por_numero.setdefault(_numero_fr24(v), []).append(v)
+
+                        print(f"   📡 FR24: {len(chunk)} vuelos en 1 request ({fecha_desde.date()} a {fecha_hasta.date()})")
+
+                        sin_match = {}
+                        for numero, fecha_salida in items:
+                            if len(chunk) == 1:
+                                # Request de un solo número: todo el resultado es suyo (codeshares)
+                                candidatos = result.data or []
+                            else:
+                                candidatos = por_numero.get(numero.replace(' ', '').upper(), [])
+                                if not candidatos:
+                                    # Puede venir con otro número (codeshare): se reintenta solo,
+                                    # igual que si no hubiera compartido request
+                                    sin_match.setdefault(numero, []).append((numero, fecha_salida))
+                                    continue
+                            consultados[(numero, fecha_salida)] = _evaluar_resultado_fr24(
+                                candidatos, fecha_salida, (salidas_utc or {}).get((numero, fecha_salida))
+                            )
+                        pendientes.extend(
+                            (fecha_desde, fecha_hasta, [numero], items_numero)
+                            for numero, items_numero in sin_match.items()
+                        )
 
-            # Seleccionar el vuelo más cercano a la fecha original
-            # (puede haber múltiples vuelos con el mismo número en días consecutivos)
-            vuelo = None
-            min_diff = float('inf')
-
-            for v in result.data:
-                if v.datetime_takeoff:
-                    try:
-                        takeoff = datetime.fromisoformat(v.datetime_takeoff.replace('Z', '+00:00'))
-                        # Comparar con fecha_salida (hacer naive para comparación)
-                        takeoff_naive = takeoff.replace(tzinfo=None)
-                        fecha_naive = fecha_salida.replace(tzinfo=None) if fecha_salida.tzinfo else fecha_salida
-                        diff = abs((takeoff_naive - fecha_naive).total_seconds())
-                        if diff < min_diff:
-                            min_diff = diff
-                            vuelo = v
-                    except Exception:
-                        continue
-
-            # Si no encontramos por takeoff, usar el primero
-            if vuelo is None:
-                vuelo = result.data[0]
-
-            print(f"   📊 FR24: {len(result.data)} vuelos encontrados, seleccionado el más cercano a {fecha_salida}")
-
-            # Verificar que el vuelo encontrado es del mismo día (tolerancia de 12 horas)
-            if vuelo.datetime_takeoff:
-                try:
-                    takeoff_check = datetime.fromisoformat(vuelo.datetime_takeoff.replace('Z', '+00:00'))
-                    takeoff_naive = takeoff_check.replace(tzinfo=None)
-                    fecha_naive = fecha_salida.replace(tzinfo=None) if fecha_salida.tzinfo else fecha_salida
-                    diff_hours = abs((takeoff_naive - fecha_naive).total_seconds()) / 3600
-
-                    if diff_hours > 12:
-                        print(f"   ⚠️  Vuelo FR24 es de otro día (diferencia: {diff_hours:.1f}h), ignorando")
-                        return {
-                            'encontrado': False,
-                            'estado': 'wrong_day',
-                            'cambios': []
-                        }
-                except Exception:
-                    pass
-
-            # Parsear fechas
-            takeoff_actual = datetime.fromisoformat(vuelo.datetime_takeoff.replace('Z', '+00:00')) if vuelo.datetime_takeoff else None
-            landed_actual = datetime.fromisoformat(vuelo.datetime_landed.replace('Z', '+00:00')) if vuelo.datetime_landed else None
-            
-            # Determinar estado
-            if vuelo.flight_ended:
-                estado = 'landed'
-            elif landed_actual:
-                estado = 'landed'
-            elif takeoff_actual and takeoff_actual < datetime.now(takeoff_actual.tzinfo):
-                estado = 'in_flight'
-            else:
-                estado = 'on_time'  # Por defecto, calcularemos delay después
-            
-            # Calcular delay (comparar con hora programada)
-            delay_minutos = 0
-            if takeoff_actual:
-                # Convertir fecha_salida a timezone-aware si no lo es
-                if fecha_salida.tzinfo is None:
-                    import pytz
-                    tz_arg = pytz.timezone('America/Argentina/Buenos_Aires')
-                    fecha_salida = tz_arg.localize(fecha_salida)
-                
-                diferencia = (takeoff_actual - fecha_salida).total_seconds() / 60
-                delay_minutos = int(diferencia)
-                
-                if delay_minutos > 15:  # Más de 15 min = delayed
-                    estado = 'delayed'
-            
-            return {
-                'encontrado': True,
-                'estado': estado,
-                'delay_minutos': delay_minutos,
-                'datetime_takeoff_actual': takeoff_actual,
-                'datetime_landed_actual': landed_actual,
-                'flight_ended': vuelo.flight_ended,
-                'dest_icao_actual': vuelo.dest_icao_actual,
-                'cambios': []  # Se detectarán comparando con BD
-            }
-            
-    except AuthenticationError as e:
-        print(f"❌ Error de autenticación FR24: {e}")
-        return {'encontrado': False, 'estado': 'error', 'error': 'auth_error'}
-    except ApiError as e:
-        print(f"❌ API Error FR24: {e.status} - {e.message}")
-        return {'encontrado': False, 'estado': 'error', 'error': f'api_error_{e.status}'}
     except Exception as e:
-        print(f"❌ Error inesperado: {e}")
-        import traceback
-        traceback.print_exc()
-        return {'encontrado': False, 'estado': 'error', 'error': str(e)}
+        # Error abriendo el Client: todos los pendientes quedan con error
+        status = _status_error(e)
+        for consulta in consultas:
+            resultados.setdefault(consulta, status)
 
+    # Medidor de créditos: cada request enviado a FR24 cuenta
+    try:
+        registrar_uso_fr24(len(enviados), ahora)
+    except Exception as e:
+        print(f"   ⚠️  No se pudo registrar uso FR24: {e}")
+
+    try:
+        with db.session.begin_nested():
+            _guardar_cache_status(consultados, ahora)
+    except Exception as e:
+        print(f"   ⚠️  No se pudo guardar cache FR24: {e}")
+    resultados.update(consultados)
 
-def check_all_upcoming_flights(db_session):
+    return resultados
+
+
+def check_all_upcoming_flights(db_session, persistir=False):
     """
-    Chequea todos los vuelos próximos (dentro de 48 horas)
+    Chequea los vuelos próximos (dentro de 48 horas) cuyo check está vencido
+    según la política de frecuencia de scheduler.py (cola por next_check_at)
     
     Args:
         db_session: Sesión de SQLAlchemy
+        persistir: solo el cron que notifica (True) reprograma next_check_at y
+            registra el estado notificado (notif_*), y NO hace commit: lo hace
+            el caller después de enviar las notificaciones. Sin persistir
+            (/api/check-flights, /check-flights-manual) se detectan los
+            cambios contra lo último notificado sin consumirlos y solo se
+            guarda el tracking FR24 (status, delay, horas).
     
     Returns:
         list de dicts con cambios detectados
     """
-    from models import Viaje
-    
+    from models import db, Viaje
+
     now = datetime.now()
     limite = now + timedelta(hours=48)
 
     # Para vuelos sin hora, incluir todo el día actual (desde 00:00)
     inicio_hoy = now.replace(hour=0, minute=0, second=0, microsecond=0)
 
-    print(f"📅 Buscando vuelos entre {inicio_hoy} y {limite}")
+    # Vuelos con salida_utc: ventana exacta (incluye los que ya despegaron y pueden seguir en el aire;
+    # los aterrizados o con llegada_utc pasada se excluyen, ver filtro_no_terminado)
+    now_utc = datetime.utcnow()
+    desde_utc = now_utc - timedelta(hours=HORAS_SEGUIMIENTO_POST_SALIDA)
+    limite_utc = now_utc + timedelta(hours=48)
 
-    # Obtener vuelos próximos (incluye vuelos de hoy aunque hora sea 00:00)
-    vuelos_proximos = db_session.query(Viaje).filter(
-        Viaje.tipo == 'vuelo',
-        Viaje.fecha_salida >= inicio_hoy,
-        Viaje.fecha_salida <= limite
-    ).all()
+    print(f"📅 Buscando vuelos vencidos entre {desde_utc} y {limite_utc} UTC (sin hora: desde {inicio_hoy})")
+
+    # Solo vuelos cuyo next_check_at venció (incluye vuelos de hoy aunque hora sea 00:00)
+    vuelos_proximos = get_vuelos_to_check(
+        db_session, desde=inicio_hoy, hasta=limite, ahora=now,
+        desde_utc=desde_utc, hasta_utc=limite_utc
+    )
+
+    print(f"✈️  Encontrados {len(vuelos_proximos)} vuelos a chequear")
 
-    print(f"✈️  Encontrados {len(vuelos_proximos)} vuelos en rango")
+    # Governor de presupuesto: estira intervalos de vuelos lejanos si la proyección no alcanza
+    factor = factor_presupuesto_fr24(now)
+    if factor > 1:
+        print(f"💳 Proyección FR24 sobre presupuesto: intervalos x{factor:.2f} (salvo vuelos < 12h)")
 
     cambios_detectados = []
-    
+
+    # Primera pasada: reprogramar y agrupar por vuelo físico (número + fecha).
+    # Familias/grupos con el mismo vuelo comparten una sola consulta FR24.
+    por_clave = {}
     for vuelo in vuelos_proximos:
-        # Obtener numero_vuelo de columna o de datos JSON
-        numero = vuelo.numero_vuelo
-        if not numero and vuelo.datos:
-            datos = vuelo.datos if isinstance(vuelo.datos, dict) else json.loads(vuelo.datos)
-            numero = datos.get('numero_vuelo')
+        # Reprogramar según el tramo de la política (se persiste con el commit)
+        if persistir:
+            vuelo.next_check_at = calcular_proximo_check(vuelo, now, factor)
+        if vuelo.salida_utc is None:
+            # Vuelos cargados antes de salida_utc (o por flujos legacy)
+            actualizar_instantes_utc(vuelo)
+        _preservar_actualizado(vuelo)
 
+        numero = get_numero_vuelo(vuelo)
         if not numero:
             continue
 
-        # Normalizar formato (quitar espacios: "G3 7680" -> "G37680")
-        numero_normalizado = numero.replace(' ', '')
+        por_clave.setdefault(clave_vuelo(numero, vuelo.fecha_salida), []).append(vuelo)
+
+    # Sumar las otras reservas del mismo vuelo aunque todavía no estén vencidas:
+    # reciben el mismo resultado y quedan reprogramadas en sincronía
+    if por_clave:
+        ids_vencidos = {v.id for v in vuelos_proximos}
+        numeros = {numero for numero, _ in por_clave}
+        companeros = db_session.query(Viaje).filter(
+            Viaje.tipo == 'vuelo',
+            filtro_ventana_salida(inicio_hoy, limite, desde_utc, limite_utc),
+            filtro_no_terminado(now_utc),
+            db.func.upper(db.func.replace(Viaje.numero_vuelo, ' ', '')).in_(numeros)
+        ).all()
+        for vuelo in companeros:
+            if vuelo.id in ids_vencidos:
+                continue
+            clave = clave_vuelo(get_numero_vuelo(vuelo), vuelo.fecha_salida)
+            if clave in por_clave:
+                if persistir:
+                    vuelo.next_check_at = calcular_proximo_check(vuelo, now, factor)
+                if vuelo.salida_utc is None:
+                    actualizar_instantes_utc(vuelo)
+                _preservar_actualizado(vuelo)
+                por_clave[clave].append(vuelo)
+
+    total_reservas = sum(len(vuelos) for vuelos in por_clave.values())
+    print(f"🧩 {total_reservas} reservas → {len(por_clave)} vuelos únicos a consultar")
+
+    # Una consulta por vuelo único, con la fecha más precisa del grupo
+    # (preferir la que tiene hora sobre las cargadas a las 00:00)
+    # y su salida programada en UTC si alguna reserva la tiene
+    consultas = {}
+    salidas_utc = {}
+    for clave, vuelos in por_clave.items():
+        con_hora = [v.fecha_salida for v in vuelos if v.fecha_salida.time() != datetime.min.time()]
+        consultas[clave] = (clave[0], con_hora[0] if con_hora else vuelos[0].fecha_salida)
+        con_utc = [v.salida_utc for v in vuelos if v.salida_utc]
+        if con_utc:
+            salidas_utc[consultas[clave]] = con_utc[0]
+
+    # Consultas FR24 agrupadas (varios vuelos por request)
+    estados = check_flights_status_batch(list(consultas.values()), salidas_utc)
 
+    # Repartir el resultado a cada reserva (y usuario) del vuelo
+    a_procesar = [
+        (vuelo, clave[0], estados[consultas[clave]])
+        for clave, vuelos in por_clave.items()
+        for vuelo in vuelos
+    ]
+
+    for vuelo, numero_normalizado, status in a_procesar:
         print(f"🔍 Chequeando {numero_normalizado} - {vuelo.origen}→{vuelo.destino}...")
 
-        status = check_flight_status(numero_normalizado, vuelo.fecha_salida)
-        
         if not status['encontrado']:
             print(f"   ⚠️  No encontrado en FR24")
             continue
         
-        # Detectar cambios
+        # Detectar cambios: solo transiciones respecto de lo último notificado
         cambios = []
         delay_min = status['delay_minutos']
+        bucket = _delay_bucket(delay_min)
+        # FR24 reporta destino en ICAO; vuelo.destino es IATA
+        dest_icao = status.get('dest_icao_actual')
+        dest_actual = (icao_to_iata(dest_icao) or dest_icao) if dest_icao else None
 
-        # 1. Delay o adelanto (cualquier cambio de +/- 5 min es significativo)
-        if abs(delay_min) > 5:
+        # 1. Delay o adelanto: avisar solo si cambió de bucket (no en cada corrida)
+        if bucket != (vuelo.notif_delay_bucket or 0) and bucket != 0:
+            anterior = 'On time'
+            if vuelo.notif_delay_bucket and vuelo.delay_minutos is not None:
+                anterior = f"{vuelo.delay_minutos:+d} min"
             if delay_min > 0:
                 cambios.append({
                     'tipo': 'delay',
-                    'valor_anterior': 'On time',
+                    'valor_anterior': anterior,
                     'valor_nuevo': f"+{delay_min} min",
                     'severidad': 'alta' if delay_min > 120 else 'media'
                 })
             else:
                 cambios.append({
                     'tipo': 'adelanto',
-                    'valor_anterior': 'On time',
+                    'valor_anterior': anterior,
                     'valor_nuevo': f"{delay_min} min",
                     'severidad': 'media'
                 })
 
         # 2. Cancelación (muy raro en API, pero posible)
-        if status['estado'] == 'cancelled':
+        if status['estado'] == 'cancelled' and vuelo.notif_estado != 'cancelled':
             cambios.append({
                 'tipo': 'cancelacion',
                 'severidad': 'critica'
             })
 
         # 3. Cambio de aeropuerto destino
-        if status['dest_icao_actual'] and vuelo.destino:
-            if status['dest_icao_actual'] != vuelo.destino:
+        destino_programado = (vuelo.destino or '').upper().strip()
+        if dest_actual and get_airport(destino_programado):
+            if dest_actual != destino_programado and dest_actual != vuelo.notif_destino:
                 cambios.append({
                     'tipo': 'destino_cambiado',
                     'valor_anterior': vuelo.destino,
-                    'valor_nuevo': status['dest_icao_actual'],
+                    'valor_nuevo': dest_actual,
                     'severidad': 'alta'
                 })
 
+        # Estado notificado (también registra la vuelta a horario, sin avisar)
+        if persistir:
+            vuelo.notif_estado = status.get('estado')
+            vuelo.notif_delay_bucket = bucket
+            vuelo.notif_destino = dest_actual
+
         if cambios:
             cambios_detectados.append({
                 'vuelo_id': vuelo.id,
+                'user_id': vuelo.user_id,
                 'numero_vuelo': numero_normalizado,
                 'ruta': f"{vuelo.origen}→{vuelo.destino}",
                 'fecha_salida': vuelo.fecha_salida,
@@ -238,40 +667,52 @@ def check_all_upcoming_flights(db_session):
                 'cambios': cambios
             })
             print(f"   ⚠️  {len(cambios)} cambio(s) detectado(s)")
+        else:
+            print(f"   ✅ Sin cambios nuevos ({status.get('estado')}, {delay_min:+d} min)")
+
+        # Actualizar campos FR24 para badges y tracking
+        vuelo.ultima_actualizacion_fr24 = datetime.now()
+        vuelo.status_fr24 = status.get('estado', 'unknown')
+        vuelo.delay_minutos = delay_min
+        horas_cambiaron = False
 
-            # Actualizar campos FR24 para badges y tracking
-            vuelo.ultima_actualizacion_fr24 = datetime.now()
-            vuelo.status_fr24 = status.get('estado', 'unknown')
-            vuelo.delay_minutos = delay_min
-
-            # Actualizar hora de salida con conversión a hora local del aeropuerto
-            from utils.airport_timezone import utc_to_airport_local
-
-            takeoff_utc = status.get('datetime_takeoff_actual')
-            if takeoff_utc and vuelo.origen:
-                takeoff_local = utc_to_airport_local(takeoff_utc, vuelo.origen)
-                if takeoff_local:
-                    nueva_hora = takeoff_local.strftime('%H:%M')
-                    hora_anterior = vuelo.hora_salida
-                    if nueva_hora != hora_anterior:
-                        vuelo.hora_salida = nueva_hora
-                        print(f"   🕐 Hora salida: {hora_anterior} → {nueva_hora} (local {vuelo.origen})")
-
-            # Actualizar hora de llegada con conversión a hora local del aeropuerto destino
-            landed_utc = status.get('datetime_landed_actual')
-            if landed_utc and vuelo.destino:
-                landed_local = utc_to_airport_local(landed_utc, vuelo.destino)
-                if landed_local:
-                    nueva_hora_llegada = landed_local.strftime('%H:%M')
-                    hora_llegada_anterior = vuelo.hora_llegada
-                    if nueva_hora_llegada != hora_llegada_anterior:
-                        vuelo.hora_llegada = nueva_hora_llegada
-                        print(f"   🕐 Hora llegada: {hora_llegada_anterior} → {nueva_hora_llegada} (local {vuelo.destino})")
-
-            db_session.commit()
-            print(f"   💾 BD actualizada")
+        # Actualizar hora de salida con conversión a hora local del aeropuerto
+        from utils.airport_timezone import utc_to_airport_local
+
+        takeoff_utc = status.get('datetime_takeoff_actual')
+        if takeoff_utc and vuelo.origen:
+            takeoff_local = utc_to_airport_local(takeoff_utc, vuelo.origen)
+            if takeoff_local:
+                nueva_hora = takeoff_local.strftime('%H:%M')
+                hora_anterior = vuelo.hora_salida
+                if nueva_hora != hora_anterior:
+                    vuelo.hora_salida = nueva_hora
+                    horas_cambiaron = True
+                    print(f"   🕐 Hora salida: {hora_anterior} → {nueva_hora} (local {vuelo.origen})")
+
+        # Actualizar hora de llegada con conversión a hora local del aeropuerto destino
+        landed_utc = status.get('datetime_landed_actual')
+        if landed_utc and vuelo.destino:
+            landed_local = utc_to_airport_local(landed_utc, vuelo.destino)
+            if landed_local:
+                nueva_hora_llegada = landed_local.strftime('%H:%M')
+                hora_llegada_anterior = vuelo.hora_llegada
+                if nueva_hora_llegada != hora_llegada_anterior:
+                    vuelo.hora_llegada = nueva_hora_llegada
+                    horas_cambiaron = True
+                    print(f"   🕐 Hora llegada: {hora_llegada_anterior} → {nueva_hora_llegada} (local {vuelo.destino})")
+
+        if horas_cambiaron:
+            vuelo.actualizado = datetime.utcnow()
         else:
-            print(f"   ✅ On time")
+            # Solo tracking FR24: no invalidar el feed de calendario (ETag por actualizado)
+            _preservar_actualizado(vuelo)
+
+    # Una sola escritura por corrida: next_check_at, tracking FR24, estado notificado y horas.
+    # Con persistir, el commit lo hace el cron después de notificar
+    if not persistir:
+        db_session.commit()
+        print(f"💾 BD actualizada ({total_reservas} vuelos)")
     
     return cambios_detectados
 
@@ -12,6 +12,8 @@ from utils import extraer_info_con_claude, get_ciudad_nombre
 from models import db, Viaje, User, UserEmail
 from datetime import datetime
 from utils.save_reservation import save_reservation, update_reservation
+from utils.helpers import nombres_coinciden
+from utils.passenger_index import get_indice_usuarios
 
 
 def normalize_name(name):
@@ -52,9 +54,9 @@ def find_user_by_passenger(pasajeros):
     if not isinstance(pasajeros, list):
         return None
 
-    # Obtener todos los usuarios con apellido configurado
-    users = User.query.filter(User.apellido_pax.isnot(None)).all()
-    if not users:
+    # Índice en memoria apellido → usuarios (nombres ya normalizados)
+    indice = get_indice_usuarios()
+    if not indice:
         return None
 
     for pax in pasajeros:
@@ -79,32 +81,18 @@ def find_user_by_passenger(pasajeros):
         if not apellido_reserva:
             continue
         
-        # Buscar match con usuarios
-        for user in users:
-            user_apellido = normalize_name(user.apellido_pax)
-            user_nombres = normalize_name(user.nombre_pax).split() if user.nombre_pax else []
-            
-            # 1. Apellido debe coincidir exactamente
-            if apellido_reserva != user_apellido:
-                continue
-            
+        # 1. Apellido debe coincidir exactamente (lookup en el índice)
+        for user_id, user_nombres, user_nombre in indice.get(apellido_reserva, []):
             # 2. Al menos un nombre debe coincidir
             if not user_nombres:
                 # Si el usuario no tiene nombres configurados, match solo por apellido
-                print(f'  👤 Usuario encontrado por apellido: {user.nombre} (match: {nombre_pax})')
-                return user.id
+                print(f'  👤 Usuario encontrado por apellido: {user_nombre} (match: {nombre_pax})')
+                return user_id
             
             # Buscar si algún nombre del usuario aparece en la reserva
-            nombres_match = any(
-                user_nombre in nombres_reserva or 
-                any(user_nombre in reserva_nombre or reserva_nombre in user_nombre 
-                    for reserva_nombre in nombres_reserva)
-                for user_nombre in user_nombres
-            )
-            
-            if nombres_match:
-                print(f'  👤 Usuario encontrado: {user.nombre} (match: {nombre_pax})')
-                return user.id
+            if nombres_coinciden(user_nombres, nombres_reserva):
+                print(f'  👤 Usuario encontrado: {user_nombre} (match: {nombre_pax})')
+                return user_id
     
     return None
 
@@ -5,6 +5,7 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from sqlalchemy import event
 from sqlalchemy.dialects.postgresql import JSONB
 import uuid
 
@@ -24,6 +25,7 @@ class User(UserMixin, db.Model):
     nombre = db.Column(db.String(100), nullable=False)
     nombre_pax = db.Column(db.String(50))  # Nombre para match en reservas
     apellido_pax = db.Column(db.String(50))  # Apellido para match en reservas
+    apellido_pax_norm = db.Column(db.String(100), index=True)  # normalize_name(apellido_pax), lo mantiene un listener
     calendar_token = db.Column(db.String(36), unique=True, default=generate_calendar_token)  # MVP9: Token único para calendar feed
     combinar_vuelos = db.Column(db.Boolean, default=True)  # MVP11: Deduplicar vuelos idénticos
     formato_hora = db.Column(db.String(4), nullable=True)  # null=auto, '24h', '12h'
@@ -175,22 +177,88 @@ class ProcessedEmail(db.Model):
         return f'<ProcessedEmail {self.message_id[:20]}...>'
 
 
+class EmailVisto(db.Model):
+    """
+    Índice por usuario de emails ya procesados, independiente de la cuenta y
+    del proveedor (ProcessedEmail usa el id interno de cada conexión): el
+    mismo email que llega a Gmail y a Outlook, o a dos Gmail, se extrae una
+    sola vez. Se reconoce por el header RFC 822 Message-ID o, si falta o
+    cambió (reenvíos), por el hash del contenido normalizado.
+    """
+    __tablename__ = 'email_visto'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    rfc_message_id = db.Column(db.String(512))  # Message-ID normalizado (sin <>, minúsculas)
+    content_hash = db.Column(db.String(64))     # sha256 de subject + body normalizados
+    connection_id = db.Column(db.Integer, db.ForeignKey('email_connection.id', ondelete='SET NULL'))
+    had_reservation = db.Column(db.Boolean, default=False)
+    creado = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'rfc_message_id', name='uq_email_visto_message_id'),
+        db.Index('ix_email_visto_user_hash', 'user_id', 'content_hash'),
+    )
+
+    def __repr__(self):
+        return f'<EmailVisto user={self.user_id} {self.rfc_message_id or self.content_hash[:12]}>'
+
+
+class GmailSyncJob(db.Model):
+    """
+    Cola durable de sincronizaciones Gmail (una por notificación Pub/Sub).
+    El webhook encola y responde; los workers de utils/gmail_jobs.py la drenan
+    con reintentos y backoff. Estados: pendiente, procesando, completado, dead.
+    Single-flight: a lo sumo un job pendiente por conexión; las notificaciones
+    siguientes solo suben su history_id (watermark).
+    """
+    __tablename__ = 'gmail_sync_job'
+
+    id = db.Column(db.Integer, primary_key=True)
+    connection_id = db.Column(db.Integer, db.ForeignKey('email_connection.id', ondelete='CASCADE'), nullable=False, index=True)
+    history_id = db.Column(db.String(50))  # mayor historyId notificado (watermark)
+    notificaciones = db.Column(db.Integer, nullable=False, default=1)  # notificaciones coalescidas en este job
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    disponible_en = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # próximo intento (backoff)
+    tomado_en = db.Column(db.DateTime)  # lease del worker que lo está procesando
+    ultimo_error = db.Column(db.Text)
+    viajes_creados = db.Column(db.Integer, default=0)
+    creado = db.Column(db.DateTime, default=datetime.utcnow)
+    actualizado = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_gmail_sync_job_estado_disponible', 'estado', 'disponible_en'),
+        db.Index(
+            'uq_gmail_sync_job_pendiente', 'connection_id', unique=True,
+            postgresql_where=db.text("estado = 'pendiente'"),
+            sqlite_where=db.text("estado = 'pendiente'")
+        ),
+    )
+
+    def __repr__(self):
+        return f'<GmailSyncJob {self.id} conn={self.connection_id} {self.estado}>'
+
+
 class Viaje(db.Model):
     """Modelo de viaje/vuelo"""
     id = db.Column(db.Integer, primary_key=True)
     
     # Relación con usuario
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # nullable=True para migración
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)  # nullable=True para migración
     
     # Campos existentes
     tipo = db.Column(db.String(50), nullable=False)
     descripcion = db.Column(db.String(200), nullable=False, default='')
     origen = db.Column(db.String(100))
     destino = db.Column(db.String(100))
-    fecha_salida = db.Column(db.DateTime, nullable=False)
+    fecha_salida = db.Column(db.DateTime, nullable=False, index=True)
     fecha_llegada = db.Column(db.DateTime)
     hora_salida = db.Column(db.String(10))
     hora_llegada = db.Column(db.String(10))
+    # Instantes programados en UTC (hora local + timezone del aeropuerto), ver actualizar_instantes_utc
+    salida_utc = db.Column(db.DateTime, index=True)
+    llegada_utc = db.Column(db.DateTime, index=True)
     aerolinea = db.Column(db.String(100))
     numero_vuelo = db.Column(db.String(50))
     codigo_reserva = db.Column(db.String(255))  # Aumentado para expediciones/charters
@@ -225,6 +293,17 @@ class Viaje(db.Model):
     delay_minutos = db.Column(db.Integer)
     datetime_takeoff_actual = db.Column(db.DateTime)
     datetime_landed_actual = db.Column(db.DateTime)
+    # Cola de monitoreo: próximo check FR24 según la política de scheduler.py (NULL = chequear ya)
+    next_check_at = db.Column(db.DateTime, index=True)
+    # Último estado notificado al usuario (alertas solo en transiciones)
+    notif_estado = db.Column(db.String(50))
+    notif_delay_bucket = db.Column(db.Integer)
+    notif_destino = db.Column(db.String(10))
+
+    # Índice normalizado de personas (pasajeros/huéspedes/participantes) para matching
+    personas_index = db.relationship('ViajePasajero', backref='viaje', cascade='all, delete-orphan')
+    # Usuarios (no owners) que ven este viaje por aparecer como pasajeros - materializado
+    visible_para = db.relationship('ViajeVisible', backref='viaje', cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Viaje {self.origen}->{self.destino} {self.fecha_salida}>'
@@ -260,6 +339,122 @@ class Viaje(db.Model):
         return codigo in self.get_codigos_alternativos()
 
 
+@event.listens_for(User.apellido_pax, 'set')
+def _normalizar_apellido_pax(target, value, oldvalue, initiator):
+    """apellido_pax_norm con el mismo normalize_name que usa el índice de pasajeros"""
+    from utils.helpers import normalize_name
+    target.apellido_pax_norm = normalize_name(value) or None
+
+
+@event.listens_for(Viaje.fecha_salida, 'set')
+def _reprogramar_check_vuelo(target, value, oldvalue, initiator):
+    """Si cambia la fecha de salida, el próximo check FR24 programado ya no vale"""
+    if value != oldvalue:
+        target.next_check_at = None
+
+
+class ViajePasajero(db.Model):
+    """
+    Personas de una reserva con nombre normalizado.
+    Permite encontrar viajes donde un usuario es pasajero con un join indexado por apellido,
+    en vez de recorrer y parsear todos los viajes.
+    """
+    __tablename__ = 'viaje_pasajeros'
+
+    id = db.Column(db.Integer, primary_key=True)
+    viaje_id = db.Column(db.Integer, db.ForeignKey('viaje.id', ondelete='CASCADE'), nullable=False, index=True)
+    nombre = db.Column(db.String(200))  # Nombre tal como viene en la reserva
+    apellido = db.Column(db.String(100), nullable=False, index=True)  # Normalizado: GAMBERG
+    nombres = db.Column(db.String(200))  # Normalizados separados por espacio: ANDRES GUILLERMO
+
+    def __repr__(self):
+        return f'<ViajePasajero {self.apellido}/{self.nombres} viaje={self.viaje_id}>'
+
+
+class ViajeVisible(db.Model):
+    """
+    Asociación materializada usuario ↔ viaje por matching de pasajero.
+    Se recalcula solo cuando cambian las personas de una reserva o el
+    nombre_pax/apellido_pax de un usuario (ver utils/passenger_index.py).
+    """
+    __tablename__ = 'viaje_visible'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    viaje_id = db.Column(db.Integer, db.ForeignKey('viaje.id', ondelete='CASCADE'), primary_key=True, index=True)
+    creado = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ViajeVisible user={self.user_id} viaje={self.viaje_id}>'
+
+
+class FlightStatusCache(db.Model):
+    """
+    Cache compartido de estados FR24 por vuelo físico (número + fecha).
+    El TTL sigue los tramos de scheduler.py: largo a una semana, corto cerca de la salida.
+    """
+    __tablename__ = 'flight_status_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    numero_vuelo = db.Column(db.String(20), nullable=False)
+    fecha = db.Column(db.Date, nullable=False)
+    fecha_salida_consulta = db.Column(db.DateTime)  # hora usada para calcular el delay
+    status = db.Column(JSONB)
+    consultado = db.Column(db.DateTime, default=datetime.utcnow)
+    expira = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (db.UniqueConstraint('numero_vuelo', 'fecha', name='uq_flight_status_cache_vuelo'),)
+
+    def __repr__(self):
+        return f'<FlightStatusCache {self.numero_vuelo} {self.fecha}>'
+
+
+class Fr24Uso(db.Model):
+    """Medidor de consumo FR24 por período de facturación (mes calendario)"""
+    __tablename__ = 'fr24_uso'
+
+    periodo = db.Column(db.String(7), primary_key=True)  # 'YYYY-MM'
+    requests = db.Column(db.Integer, default=0, nullable=False)
+    creditos = db.Column(db.Integer, default=0, nullable=False)
+    actualizado = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Fr24Uso {self.periodo}: {self.creditos} créditos>'
+
+
+class ExtraccionCache(db.Model):
+    """
+    Cache de extracciones de Claude direccionado por contenido: la clave es el
+    hash del texto normalizado + versión del prompt + modelo, así el mismo
+    email/PDF (reenvíos, varias cuentas, re-subidas) se extrae una sola vez.
+    """
+    __tablename__ = 'extraccion_cache'
+
+    clave = db.Column(db.String(64), primary_key=True)  # sha256 hex
+    modelo = db.Column(db.String(50), nullable=False)
+    prompt_version = db.Column(db.String(20), nullable=False)
+    reservas = db.Column(JSONB)                         # lista parseada (puede ser [])
+    chars = db.Column(db.Integer)                       # largo del texto normalizado
+    hits = db.Column(db.Integer, default=0, nullable=False)
+    creado = db.Column(db.DateTime, default=datetime.utcnow)
+    ultimo_hit = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<ExtraccionCache {self.clave[:12]} hits={self.hits}>'
+
+
+class ExtraccionUso(db.Model):
+    """Medidor de extracciones por mes: llamadas a Claude vs hits del cache"""
+    __tablename__ = 'extraccion_uso'
+
+    periodo = db.Column(db.String(7), primary_key=True)  # 'YYYY-MM'
+    llamadas = db.Column(db.Integer, default=0, nullable=False)
+    hits = db.Column(db.Integer, default=0, nullable=False)
+    actualizado = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ExtraccionUso {self.periodo}: {self.hits}/{self.llamadas + self.hits} hits>'
+
+
 class UserEmail(db.Model):
     """Emails adicionales asociados a un usuario (para matching de pasajeros)"""
     id = db.Column(db.Integer, primary_key=True)
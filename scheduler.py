@@ -3,10 +3,34 @@ Scheduler inteligente para monitoreo de vuelos
 Ajusta frecuencia según proximidad del vuelo
 """
 from datetime import datetime, timedelta
-from flight_monitor import check_all_upcoming_flights
 import os
+from sqlalchemy import and_ as db_and, or_ as db_or
 
-def get_check_frequency_minutes(vuelo):
+# Presupuesto FR24 (configurable por env)
+FR24_CREDITOS_POR_REQUEST = int(os.getenv('FR24_CREDITOS_POR_REQUEST', '10'))
+FR24_CREDITOS_MES = int(os.getenv('FR24_CREDITOS_MES', '60000'))  # con promo
+
+# Governor: vuelos a menos de estas horas mantienen su frecuencia aunque el presupuesto no alcance
+HORAS_PRIORIDAD = 12
+FACTOR_PRESUPUESTO_MAX = 4.0
+
+# El cron de /cron/check-flights corre cada 15 min (docs/SCHEDULER_SETUP.md). Los
+# checks se programan con medio intervalo de margen: una corrida que arranca unos
+# segundos antes igual encuentra vencido al vuelo, en vez de dejarlo para la siguiente.
+CRON_INTERVALO_MIN = 15
+MARGEN_CRON_MIN = CRON_INTERVALO_MIN / 2
+
+# Umbrales de la política (horas antes de la salida) y frecuencia dentro de cada tramo
+TRAMOS_FRECUENCIA = [
+    (168, 1440),  # >7 días: 1x por día
+    (48, 720),    # 7-2 días: 2x por día
+    (24, 360),    # 48-24h: cada 6h
+    (12, 60),     # 24-12h: cada 1h
+    (2, 30),      # 12-2h: cada 30 min
+    (0, 15),      # <2h: cada 15 min
+]
+
+def get_check_frequency_minutes(vuelo, ahora=None):
     """
     Retorna minutos hasta próximo check según proximidad del vuelo
     
@@ -18,21 +42,124 @@ def get_check_frequency_minutes(vuelo):
     - 12-2h: cada 30 min
     - Menos de 2h: cada 15 min
     """
-    ahora = datetime.now()
-    tiempo_hasta = (vuelo.fecha_salida - ahora).total_seconds() / 3600  # en horas
-    
-    if tiempo_hasta > 168:      # >7 días
-        return 1440  # 24 horas
-    elif tiempo_hasta > 48:     # 7-2 días  
-        return 720   # 12 horas
-    elif tiempo_hasta > 24:     # 48-24 horas
-        return 360   # 6 horas
-    elif tiempo_hasta > 12:     # 24-12 horas
-        return 60    # 1 hora
-    elif tiempo_hasta > 2:      # 12-2 horas
-        return 30    # 30 minutos
-    else:                       # <2 horas
-        return 15    # 15 minutos
+    return frecuencia_para_fecha(vuelo.fecha_salida, ahora)
+
+def frecuencia_para_fecha(fecha_salida, ahora=None):
+    """Minutos entre checks para un vuelo que sale en fecha_salida (ver TRAMOS_FRECUENCIA)"""
+    ahora = ahora or datetime.now()
+    tiempo_hasta = (fecha_salida - ahora).total_seconds() / 3600  # en horas
+    
+    for umbral_horas, frecuencia_min in TRAMOS_FRECUENCIA:
+        if tiempo_hasta > umbral_horas:
+            return frecuencia_min
+    return TRAMOS_FRECUENCIA[-1][1]
+
+def calcular_proximo_check(vuelo, ahora=None, factor=1.0):
+    """
+    Calcula next_check_at del vuelo según la política de frecuencia.
+    Nunca salta por encima del inicio del tramo siguiente (más frecuente):
+    un vuelo a 49h se vuelve a chequear al entrar en el tramo de 48h,
+    no 12h después.
+
+    factor (ver factor_presupuesto_fr24) estira el intervalo de los vuelos
+    a más de HORAS_PRIORIDAD de la salida. El intervalo se acorta en
+    MARGEN_CRON_MIN para que la corrida del cron que cae en el vencimiento
+    no lo encuentre un poco antes de tiempo.
+    """
+    return proximo_check_para_fecha(vuelo.fecha_salida, ahora, factor)
+
+def proximo_check_para_fecha(fecha_salida, ahora=None, factor=1.0):
+    """Próximo check para un vuelo que sale en fecha_salida (ver calcular_proximo_check)"""
+    ahora = ahora or datetime.now()
+    tiempo_hasta = (fecha_salida - ahora).total_seconds() / 3600
+
+    frecuencia_min = frecuencia_para_fecha(fecha_salida, ahora)
+    if tiempo_hasta > HORAS_PRIORIDAD:
+        frecuencia_min *= factor
+    proximo = ahora + timedelta(minutes=frecuencia_min - MARGEN_CRON_MIN)
+
+    for umbral_horas, _ in TRAMOS_FRECUENCIA:
+        if tiempo_hasta > umbral_horas:
+            inicio_tramo_siguiente = fecha_salida - timedelta(hours=umbral_horas)
+            return min(proximo, inicio_tramo_siguiente)
+    return proximo
+
+def _periodo_actual(ahora=None):
+    """Período de facturación FR24 ('YYYY-MM')"""
+    return (ahora or datetime.now()).strftime('%Y-%m')
+
+def registrar_uso_fr24(requests, ahora=None):
+    """
+    Suma requests (y sus créditos) al medidor del período actual.
+    Va en una transacción propia (no toca la sesión del caller) para que el
+    consumo quede registrado aunque el resto de la corrida falle, y es un
+    upsert atómico: dos corridas concurrentes el primer día del mes no chocan.
+    """
+    from sqlalchemy.dialects.postgresql import insert
+    from models import db, Fr24Uso
+
+    if not requests:
+        return
+    
+    creditos = requests * FR24_CREDITOS_POR_REQUEST
+    stmt = insert(Fr24Uso.__table__).values(
+        periodo=_periodo_actual(ahora),
+        requests=requests,
+        creditos=creditos,
+        actualizado=datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['periodo'],
+        set_={
+            'requests': Fr24Uso.__table__.c.requests + stmt.excluded.requests,
+            'creditos': Fr24Uso.__table__.c.creditos + stmt.excluded.creditos,
+            'actualizado': stmt.excluded.actualizado
+        }
+    )
+    with db.engine.begin() as conn:
+        conn.execute(stmt)
+
+def get_uso_fr24(ahora=None):
+    """
+    Consumo del período actual y proyección a fin de mes.
+
+    Returns:
+        dict con creditos_usados, creditos_proyectados, presupuesto, factor
+    """
+    from models import Fr24Uso
+    
+    ahora = ahora or datetime.now()
+    uso = Fr24Uso.query.get(_periodo_actual(ahora))
+    usados = uso.creditos if uso else 0
+
+    inicio_mes = ahora.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    inicio_mes_siguiente = (inicio_mes + timedelta(days=32)).replace(day=1)
+    # Al menos un día transcurrido para que la proyección no explote el día 1
+    transcurrido = max((ahora - inicio_mes).total_seconds(), 86400)
+    proyectados = int(usados * (inicio_mes_siguiente - inicio_mes).total_seconds() / transcurrido)
+
+    factor = 1.0
+    if FR24_CREDITOS_MES > 0 and proyectados > FR24_CREDITOS_MES:
+        factor = min(proyectados / FR24_CREDITOS_MES, FACTOR_PRESUPUESTO_MAX)
+    
+    return {
+        'periodo': _periodo_actual(ahora),
+        'creditos_usados': usados,
+        'creditos_proyectados': proyectados,
+        'presupuesto': FR24_CREDITOS_MES,
+        'factor': factor
+    }
+
+def factor_presupuesto_fr24(ahora=None):
+    """
+    Governor: factor (>= 1) para estirar los intervalos de polling si la
+    proyección de consumo del mes supera el presupuesto. 1.0 si no hay datos.
+    """
+    try:
+        return get_uso_fr24(ahora)['factor']
+    except Exception as e:
+        print(f"   ⚠️  No se pudo leer el medidor FR24: {e}")
+        return 1.0
 
 def should_check_now(vuelo):
     """
@@ -47,26 +174,58 @@ def should_check_now(vuelo):
     
     return tiempo_desde_ultima >= frecuencia_min
 
-def get_vuelos_to_check(db_session):
+def filtro_ventana_salida(desde, hasta, desde_utc=None, hasta_utc=None):
     """
-    Retorna lista de vuelos que deben chequearse ahora
-    según estrategia de frecuencia dinámica
+    Condición SQL "el vuelo sale en la ventana". Con desde_utc/hasta_utc, los
+    vuelos con salida_utc se filtran por el instante exacto (rango indexado);
+    los que no lo tienen (sin hora o aeropuerto desconocido) por fecha_salida.
+    """
+    from models import Viaje
+
+    por_fecha = db_and(Viaje.fecha_salida >= desde, Viaje.fecha_salida <= hasta)
+    if desde_utc is None or hasta_utc is None:
+        return por_fecha
+
+    return db_or(
+        Viaje.salida_utc.between(desde_utc, hasta_utc),
+        db_and(Viaje.salida_utc.is_(None), por_fecha)
+    )
+
+def filtro_no_terminado(ahora_utc=None):
+    """
+    Condición SQL "el vuelo todavía no terminó": ni aterrizado según FR24 ni
+    con llegada_utc ya pasada. La ventana del monitor llega hasta horas
+    después de la salida y esos vuelos no necesitan más consultas.
+    """
+    from models import Viaje
+
+    ahora_utc = ahora_utc or datetime.utcnow()
+    return db_and(
+        db_or(Viaje.status_fr24.is_(None), Viaje.status_fr24 != 'landed'),
+        db_or(Viaje.llegada_utc.is_(None), Viaje.llegada_utc > ahora_utc)
+    )
+
+def get_vuelos_to_check(db_session, desde=None, hasta=None, ahora=None, desde_utc=None, hasta_utc=None):
+    """
+    Retorna lista de vuelos que deben chequearse ahora: los de la ventana
+    [desde, hasta] cuyo next_check_at ya venció (o nunca fueron programados)
+    y que no terminaron (ver filtro_no_terminado).
+    Usa el índice de next_check_at, así que el costo escala con los vuelos
+    vencidos y no con todos los próximos. Ver filtro_ventana_salida para
+    desde_utc/hasta_utc.
     """
     from models import Viaje
     
-    # Vuelos próximos (dentro de 30 días hacia adelante)
-    ahora = datetime.now()
-    fecha_limite = ahora + timedelta(days=30)
-    
-    vuelos = db_session.query(Viaje).filter(
-        Viaje.fecha_salida >= ahora,
-        Viaje.fecha_salida <= fecha_limite
-    ).all()
-    
-    # Filtrar según estrategia
-    vuelos_to_check = [v for v in vuelos if should_check_now(v)]
+    ahora = ahora or datetime.now()
+    desde = desde or ahora
+    hasta = hasta or ahora + timedelta(days=30)
     
-    return vuelos_to_check
+    return db_session.query(Viaje).filter(
+        Viaje.tipo == 'vuelo',
+        filtro_ventana_salida(desde, hasta, desde_utc, hasta_utc),
+        filtro_no_terminado(),
+        db_or(Viaje.next_check_at.is_(None), Viaje.next_check_at <= ahora)
+    ).order_by(Viaje.next_check_at.asc().nullsfirst()).all()
 
 def calcular_estadisticas_creditos(db_session):
     """
@@ -82,9 +241,17 @@ def calcular_estadisticas_creditos(db_session):
         Viaje.fecha_salida <= fin_mes
     ).all()
     
+    # El monitor consulta una vez por vuelo físico (número + fecha), no por reserva
+    from flight_monitor import get_numero_vuelo, clave_vuelo
+    unicos = {}
+    for vuelo in vuelos:
+        numero = get_numero_vuelo(vuelo)
+        clave = clave_vuelo(numero, vuelo.fecha_salida) if numero else vuelo.id
+        unicos.setdefault(clave, vuelo)
+    
     total_checks = 0
     
-    for vuelo in vuelos:
+    for vuelo in unicos.values():
         dias_hasta = (vuelo.fecha_salida - ahora).days
         horas_hasta = (vuelo.fecha_salida - ahora).total_seconds() / 3600
         
@@ -116,14 +283,19 @@ def calcular_estadisticas_creditos(db_session):
             
         total_checks += checks
     
-    creditos_estimados = total_checks * 10  # asumiendo 10 créditos por check
+    creditos_estimados = total_checks * FR24_CREDITOS_POR_REQUEST
+    uso = get_uso_fr24(ahora)
     
     return {
         'total_vuelos': len(vuelos),
+        'vuelos_unicos': len(unicos),
         'checks_estimados': total_checks,
         'creditos_estimados': creditos_estimados,
-        'creditos_disponibles': 60000,  # con promo
-        'margen': 60000 - creditos_estimados
+        'creditos_disponibles': FR24_CREDITOS_MES,
+        'margen': FR24_CREDITOS_MES - creditos_estimados,
+        'creditos_usados_mes': uso['creditos_usados'],
+        'creditos_proyectados_mes': uso['creditos_proyectados'],
+        'factor_presupuesto': uso['factor']
     }
 
 if __name__ == '__main__':
@@ -133,8 +305,10 @@ if __name__ == '__main__':
     with app.app_context():
         stats = calcular_estadisticas_creditos(db.session)
         print(f"\n📊 Estadísticas de uso de créditos FR24:")
-        print(f"  Vuelos próximos (30 días): {stats['total_vuelos']}")
+        print(f"  Vuelos próximos (30 días): {stats['total_vuelos']} ({stats['vuelos_unicos']} únicos)")
         print(f"  Checks estimados: {stats['checks_estimados']}")
         print(f"  Créditos estimados: {stats['creditos_estimados']:,}")
         print(f"  Créditos disponibles: {stats['creditos_disponibles']:,}")
         print(f"  Margen: {stats['margen']:,} ({stats['margen']/stats['creditos_disponibles']*100:.1f}%)")
+        print(f"  Usados este mes: {stats['creditos_usados_mes']:,} (proyección: {stats['creditos_proyectados_mes']:,})")
+        print(f"  Factor governor: {stats['factor_presupuesto']:.2f}x")
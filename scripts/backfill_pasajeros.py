@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""
+Backfill del índice de pasajeros (tabla viaje_pasajeros).
+Ejecutar una vez después de deployar, o cuando se sospeche que el índice quedó desactualizado.
+Equivalente al endpoint /migrate-indice-pasajeros.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from utils.passenger_index import backfill_indice_pasajeros
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        print("📇 Reconstruyendo índice de pasajeros...")
+        result = backfill_indice_pasajeros()
+        print(f"✅ {result['viajes_procesados']} viajes, {result['personas_indexadas']} personas indexadas")
+        for error in result['errors']:
+            print(f"  ⚠️ {error}")
@@ -5,12 +5,17 @@
  * Estrategias de cache:
  * - Assets estáticos: Cache First
  * - API calls: Network First con fallback a cache
+ * - Sugerencias de aeropuertos: Stale While Revalidate (cache chico, acotado)
  * - Navegación: Network First con offline fallback
  */
 
-const CACHE_VERSION = 'v6-no-home-cache';
+const CACHE_VERSION = 'v7-airports-swr';
 const STATIC_CACHE = `static-${CACHE_VERSION}`;
 const DATA_CACHE = `data-${CACHE_VERSION}`;
+const AIRPORTS_CACHE = `airports-${CACHE_VERSION}`;
+
+// Máximo de búsquedas de aeropuertos cacheadas (una URL por texto tipeado)
+const AIRPORTS_CACHE_MAX = 50;
 
 // Assets estáticos para precachear al instalar
 const STATIC_ASSETS = [
@@ -86,7 +91,7 @@ self.addEventListener('install', (event) => {
 self.addEventListener('activate', (event) => {
   console.log('[SW] Activating v2...');
   
-  const currentCaches = [STATIC_CACHE, DATA_CACHE];
+  const currentCaches = [STATIC_CACHE, DATA_CACHE, AIRPORTS_CACHE];
   
   event.waitUntil(
     caches.keys()
@@ -131,6 +136,38 @@ async function cacheFirst(request, cacheName) {
   }
 }
 
+// Borra las entradas más viejas hasta dejar maxEntries (keys() respeta el orden de inserción)
+async function trimCache(cacheName, maxEntries) {
+  const cache = await caches.open(cacheName);
+  const keys = await cache.keys();
+  for (let i = 0; i < keys.length - maxEntries; i++) {
+    await cache.delete(keys[i]);
+  }
+}
+
+// Stale While Revalidate: responder con cache si hay y actualizarlo en segundo plano,
+// así las correcciones del dataset llegan en la próxima búsqueda
+async function staleWhileRevalidate(event, cacheName, maxEntries) {
+  const { request } = event;
+  const cache = await caches.open(cacheName);
+  const cached = await cache.match(request);
+
+  const network = fetch(request).then(async (response) => {
+    if (response.ok) {
+      await cache.delete(request); // reinsertar al final (más reciente)
+      await cache.put(request, response.clone());
+      await trimCache(cacheName, maxEntries);
+    }
+    return response;
+  });
+
+  if (cached) {
+    event.waitUntil(network.catch(() => {}));
+    return cached;
+  }
+  return network;
+}
+
 // Network First: Ir a network, si falla usar cache
 async function networkFirst(request, cacheName) {
   try {
@@ -242,6 +279,12 @@ self.addEventListener('fetch', (event) => {
     return;
   }
   
+  // Sugerencias de aeropuertos: Stale While Revalidate en un cache acotado
+  if (url.pathname.startsWith('/api/airports/')) {
+    event.respondWith(staleWhileRevalidate(event, AIRPORTS_CACHE, AIRPORTS_CACHE_MAX));
+    return;
+  }
+
   // API requests: Network First con cache especial
   if (isApiRequest(url.pathname)) {
     event.respondWith(networkFirstAPI(request));
@@ -1,9 +1,11 @@
 """
 Utilidad para obtener timezone de aeropuertos y convertir horas UTC a local.
 """
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
+from utils.airports import get_tz_name, get_timezone
+
 # Mapeo de aeropuertos IATA -> timezone
 # Incluye los aeropuertos más comunes de Latinoamérica y destinos frecuentes
 AIRPORT_TIMEZONES = {
@@ -125,7 +127,9 @@ AIRPORT_TIMEZONES = {
 
 def get_airport_timezone(iata_code):
     """
-    Obtiene la timezone de un aeropuerto por su código IATA.
+    Obtiene la timezone de un aeropuerto por su código IATA (o ICAO).
+    AIRPORT_TIMEZONES tiene prioridad; si no está, usa la base completa
+    de aeropuertos. Los objetos pytz quedan cacheados.
 
     Args:
         iata_code: Código IATA del aeropuerto (ej: 'EZE', 'MIA')
@@ -137,15 +141,9 @@ def get_airport_timezone(iata_code):
         return None
 
     iata_code = iata_code.upper().strip()
-    tz_name = AIRPORT_TIMEZONES.get(iata_code)
-
-    if tz_name:
-        try:
-            return pytz.timezone(tz_name)
-        except:
-            return None
+    tz_name = AIRPORT_TIMEZONES.get(iata_code) or get_tz_name(iata_code)
 
-    return None
+    return get_timezone(tz_name)
 
 
 def utc_to_airport_local(utc_datetime, iata_code, fallback_tz='America/Argentina/Buenos_Aires'):
@@ -172,7 +170,8 @@ def utc_to_airport_local(utc_datetime, iata_code, fallback_tz='America/Argentina
     # Obtener timezone del aeropuerto
     airport_tz = get_airport_timezone(iata_code)
     if not airport_tz:
-        airport_tz = pytz.timezone(fallback_tz)
+        print(f"   ⚠️  Aeropuerto {iata_code} sin timezone conocida, usando {fallback_tz}")
+        airport_tz = get_timezone(fallback_tz)
 
     # Convertir
     return utc_datetime.astimezone(airport_tz)
@@ -194,3 +193,71 @@ def format_local_time(utc_datetime, iata_code, format_str='%H:%M'):
     if local_dt:
         return local_dt.strftime(format_str)
     return None
+
+
+def local_to_utc(fecha, hora, iata_code):
+    """
+    Convierte fecha + hora local de un aeropuerto a datetime UTC naive.
+
+    Args:
+        fecha: date o datetime (se usa solo la fecha)
+        hora: string 'HH:MM' (acepta 'HH:MM:SS') o time
+        iata_code: Código IATA del aeropuerto
+
+    Returns:
+        datetime UTC sin tzinfo, o None si falta la hora o no se conoce el aeropuerto
+    """
+    if not fecha or not hora:
+        return None
+
+    if isinstance(hora, str):
+        try:
+            hora = datetime.strptime(hora.strip()[:5], '%H:%M').time()
+        except ValueError:
+            return None
+
+    airport_tz = get_airport_timezone(iata_code)
+    if not airport_tz:
+        return None
+
+    fecha = fecha.date() if isinstance(fecha, datetime) else fecha
+    local_dt = airport_tz.localize(datetime.combine(fecha, hora))
+    return local_dt.astimezone(pytz.UTC).replace(tzinfo=None)
+
+
+def actualizar_instantes_utc(viaje):
+    """
+    Recalcula viaje.salida_utc / llegada_utc (instantes programados en UTC)
+    a partir de fecha + hora local y la timezone de origen/destino.
+    Solo vuelos: en otros tipos origen/destino no son aeropuertos.
+    Quedan en None si falta la hora o el aeropuerto no se conoce. No hace commit.
+    """
+    if viaje.tipo != 'vuelo' or not viaje.fecha_salida:
+        viaje.salida_utc = None
+        viaje.llegada_utc = None
+        return
+
+    datos = viaje.datos or {}
+
+    def hora_programada(campo, fecha, hora_legacy):
+        # La de la reserva primero; la columna legacy la pisa el monitor con la hora real
+        if datos.get(campo):
+            return datos[campo]
+        if fecha and fecha.time() != datetime.min.time():
+            return fecha.time()
+        return hora_legacy
+
+    salida_utc = local_to_utc(
+        viaje.fecha_salida, hora_programada('hora_salida', viaje.fecha_salida, viaje.hora_salida), viaje.origen
+    )
+    llegada_utc = local_to_utc(
+        viaje.fecha_llegada or viaje.fecha_salida,
+        hora_programada('hora_llegada', viaje.fecha_llegada, viaje.hora_llegada),
+        viaje.destino
+    )
+    # Sin fecha de llegada explícita: si "llega antes de salir", es al día siguiente
+    if llegada_utc and salida_utc and not viaje.fecha_llegada and llegada_utc < salida_utc:
+        llegada_utc += timedelta(days=1)
+
+    viaje.salida_utc = salida_utc
+    viaje.llegada_utc = llegada_utc
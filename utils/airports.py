@@ -0,0 +1,233 @@
+"""
+Base de aeropuertos offline - Mi Agente Viajes
+IATA, ICAO, nombre, ciudad, país, timezone y coordenadas de ~7900 aeropuertos
+(utils/data/airports.csv, generado desde airportsdata - licencia MIT).
+
+Se carga la primera vez que se usa, en columnas (listas/arrays) con índices
+dict por código para lookups O(1). Las timezones pytz se construyen una vez
+por nombre y quedan cacheadas.
+
+Para autocompletar (sugerir_aeropuertos) hay un índice de prefijos: arrays
+ordenados de claves normalizadas sobre los que se hace bisect.
+"""
+from array import array
+from bisect import bisect_left
+import csv
+import os
+import re
+import threading
+import unicodedata
+
+import pytz
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data', 'airports.csv')
+
+_datos = None
+_lock = threading.Lock()
+_tz_cache = {}
+_prefijos = None
+
+# Niveles del índice de prefijos, en orden de relevancia para sugerir
+NIVELES_SUGERENCIA = ('iata', 'icao', 'ciudad', 'ciudad_palabra', 'nombre', 'nombre_palabra')
+
+
+def _cargar():
+    """Carga el CSV en columnas + índices por IATA e ICAO (una sola vez por proceso)"""
+    global _datos
+    if _datos is not None:
+        return _datos
+
+    with _lock:
+        if _datos is not None:
+            return _datos
+
+        columnas = {
+            'iata': [], 'icao': [], 'name': [], 'city': [], 'country': [], 'tz': [],
+            'lat': array('f'), 'lon': array('f')
+        }
+        with open(DATA_PATH, newline='', encoding='utf-8') as f:
+            for fila in csv.DictReader(f):
+                columnas['iata'].append(fila['iata'])
+                columnas['icao'].append(fila['icao'])
+                columnas['name'].append(fila['name'])
+                columnas['city'].append(fila['city'])
+                columnas['country'].append(fila['country'])
+                columnas['tz'].append(fila['tz'])
+                columnas['lat'].append(float(fila['lat']))
+                columnas['lon'].append(float(fila['lon']))
+
+        por_iata = {codigo: i for i, codigo in enumerate(columnas['iata'])}
+        por_icao = {}
+        for i, codigo in enumerate(columnas['icao']):
+            if codigo:
+                por_icao.setdefault(codigo, i)
+
+        _datos = (columnas, por_iata, por_icao)
+        print(f"🛫 Base de aeropuertos cargada: {len(por_iata)} aeropuertos")
+        return _datos
+
+
+def _indice(codigo):
+    """Índice del aeropuerto por código IATA (3 letras) o ICAO (4 letras)"""
+    if not codigo:
+        return None
+    codigo = codigo.upper().strip()
+    _, por_iata, por_icao = _cargar()
+    if len(codigo) == 4:
+        return por_icao.get(codigo)
+    return por_iata.get(codigo)
+
+
+def get_airport(codigo):
+    """
+    Datos de un aeropuerto por código IATA o ICAO.
+
+    Returns:
+        dict con iata, icao, name, city, country, tz, lat, lon; o None si no existe
+    """
+    i = _indice(codigo)
+    if i is None:
+        return None
+    columnas = _datos[0]
+    aeropuerto = {campo: columnas[campo][i] for campo in columnas}
+    # array('f') es float32: redondear a la precisión del CSV
+    aeropuerto['lat'] = round(aeropuerto['lat'], 4)
+    aeropuerto['lon'] = round(aeropuerto['lon'], 4)
+    return aeropuerto
+
+
+def icao_to_iata(codigo_icao):
+    """Convierte ICAO → IATA (ej: 'KMIA' → 'MIA'). Devuelve None si no se conoce."""
+    i = _indice(codigo_icao) if codigo_icao and len(codigo_icao.strip()) == 4 else None
+    return _datos[0]['iata'][i] if i is not None else None
+
+
+def iata_to_icao(codigo_iata):
+    """Convierte IATA → ICAO (ej: 'EZE' → 'SAEZ'). Devuelve None si no se conoce."""
+    i = _indice(codigo_iata) if codigo_iata and len(codigo_iata.strip()) == 3 else None
+    return (_datos[0]['icao'][i] or None) if i is not None else None
+
+
+def get_ciudad(codigo):
+    """Ciudad del aeropuerto, o None"""
+    i = _indice(codigo)
+    return _datos[0]['city'][i] if i is not None else None
+
+
+def get_tz_name(codigo):
+    """Nombre de timezone del aeropuerto (ej: 'America/New_York'), o None"""
+    i = _indice(codigo)
+    return _datos[0]['tz'][i] if i is not None else None
+
+
+def get_timezone(tz_name):
+    """Objeto pytz cacheado por nombre (evita construirlo en cada llamada)"""
+    if not tz_name:
+        return None
+    tz = _tz_cache.get(tz_name)
+    if tz is None:
+        try:
+            tz = pytz.timezone(tz_name)
+        except pytz.UnknownTimeZoneError:
+            return None
+        _tz_cache[tz_name] = tz
+    return tz
+
+
+def _normalizar(texto):
+    """Clave de búsqueda: sin acentos, mayúsculas, solo letras/dígitos separados por un espacio"""
+    if not texto:
+        return ''
+    sin_acentos = ''.join(
+        c for c in unicodedata.normalize('NFD', texto) if unicodedata.category(c) != 'Mn'
+    )
+    return ' '.join(re.sub(r'[^A-Z0-9]+', ' ', sin_acentos.upper()).split())
+
+
+def _cargar_prefijos():
+    """
+    Construye el índice de prefijos (una sola vez por proceso): por cada
+    nivel de NIVELES_SUGERENCIA, un array ordenado de claves y otro paralelo
+    con el índice del aeropuerto.
+    """
+    global _prefijos
+    if _prefijos is not None:
+        return _prefijos
+
+    columnas = _cargar()[0]
+    with _lock:
+        if _prefijos is not None:
+            return _prefijos
+
+        entradas = {nivel: [] for nivel in NIVELES_SUGERENCIA}
+        for i in range(len(columnas['iata'])):
+            entradas['iata'].append((columnas['iata'][i], i))
+            if columnas['icao'][i]:
+                entradas['icao'].append((columnas['icao'][i], i))
+            for campo, nivel in (('city', 'ciudad'), ('name', 'nombre')):
+                texto = _normalizar(columnas[campo][i])
+                if not texto:
+                    continue
+                entradas[nivel].append((texto, i))
+                # Palabras internas ("PISTARINI", "AIRES"); la primera ya la cubre el texto completo
+                for palabra in set(texto.split()[1:]):
+                    entradas[f'{nivel}_palabra'].append((palabra, i))
+
+        prefijos = {}
+        for nivel, lista in entradas.items():
+            lista.sort()
+            prefijos[nivel] = ([clave for clave, _ in lista], array('i', (i for _, i in lista)))
+
+        _prefijos = prefijos
+        return _prefijos
+
+
+def sugerir_aeropuertos(q, limit=10):
+    """
+    Autocompletado de aeropuertos por prefijo de código IATA/ICAO, ciudad o
+    nombre (sin distinguir acentos ni mayúsculas). Ej: 'eze', 'sao pa', 'pistar'.
+
+    Recorre los niveles en orden de relevancia (código exacto primero) y corta
+    al llegar a limit, así que el costo es O(niveles · log n + limit).
+
+    Returns:
+        list de dicts con iata, icao, name, city, country
+    """
+    clave = _normalizar(q)
+    if not clave or limit <= 0:
+        return []
+
+    prefijos = _cargar_prefijos()
+    columnas = _datos[0]
+    encontrados = []
+    vistos = set()
+
+    def agregar(i):
+        if i not in vistos:
+            vistos.add(i)
+            encontrados.append(i)
+
+    # Código exacto antes que cualquier prefijo (ej: 'MAD' → Madrid antes que 'MADANG')
+    i = _indice(clave) if len(clave) in (3, 4) else None
+    if i is not None:
+        agregar(i)
+
+    for nivel in NIVELES_SUGERENCIA:
+        claves, indices = prefijos[nivel]
+        pos = bisect_left(claves, clave)
+        while pos < len(claves) and len(encontrados) < limit and claves[pos].startswith(clave):
+            agregar(indices[pos])
+            pos += 1
+        if len(encontrados) >= limit:
+            break
+
+    return [
+        {
+            'iata': columnas['iata'][i],
+            'icao': columnas['icao'][i] or None,
+            'name': columnas['name'][i],
+            'city': columnas['city'][i] or None,
+            'country': columnas['country'][i]
+        }
+        for i in encontrados[:limit]
+    ]
@@ -8,10 +8,100 @@ import re
 import logging
 from datetime import datetime
 import anthropic
+from flask import has_app_context
 
 
-def extraer_info_con_claude(email_text):
-    """Extrae información de TODAS las reservas del email/PDF"""
+# Modelo de extracción y versión del prompt: ambos son parte de la clave del
+# cache de extracciones. Subir PROMPT_VERSION al cambiar el prompt.
+MODELO_EXTRACCION = "claude-haiku-4-5-20251001"
+PROMPT_VERSION = '1'
+
+
+def _anio_objetivo(email_text):
+    """
+    Año de contexto para el prompt y la corrección de fechas.
+
+    Returns:
+        (target_year, bool detectado en el documento)
+    """
+    years = re.findall(r'20[2-9][0-9]', email_text)
+    current_year = datetime.now().year
+
+    if years:
+        # Solo considerar años razonables (máximo 3 años en el futuro)
+        # Esto evita que números como PNR "2049" se interpreten como años
+        max_reasonable_year = current_year + 3
+        reasonable_years = [int(y) for y in years
+                            if current_year <= int(y) <= max_reasonable_year]
+        if reasonable_years:
+            return min(reasonable_years), True
+        # Si no hay años razonables, asumir próximo año para viajes futuros
+        return current_year + 1, False
+
+    return current_year, False
+
+
+def _clave_cache(email_text):
+    from utils.extraccion_cache import clave_extraccion
+    return clave_extraccion(email_text, MODELO_EXTRACCION, PROMPT_VERSION, contexto=str(_anio_objetivo(email_text)[0]))
+
+
+def buscar_extraccion_cacheada(email_text):
+    """
+    Reservas ya extraídas de este mismo contenido (cache por hash), o None.
+    Requiere app context; si el cache falla se trata como miss.
+    """
+    from models import db
+    from utils.extraccion_cache import buscar_extraccion
+    try:
+        reservas = buscar_extraccion(_clave_cache(email_text))
+    except Exception as e:
+        print(f"⚠️ Cache de extracciones no disponible: {e}")
+        db.session.rollback()
+        return None
+    if reservas is not None:
+        print(f"♻️ Extracción desde cache ({len(reservas)} reservas), sin llamar a Claude")
+    return reservas
+
+
+def guardar_extraccion_en_cache(email_text, reservas):
+    """Guarda el resultado de una llamada a Claude (no guarda errores: reservas None)"""
+    from models import db
+    from utils.extraccion_cache import guardar_extraccion, normalizar_texto
+    if reservas is None:
+        return
+    try:
+        guardar_extraccion(
+            _clave_cache(email_text), reservas, MODELO_EXTRACCION, PROMPT_VERSION,
+            chars=len(normalizar_texto(email_text))
+        )
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar la extracción en cache: {e}")
+        db.session.rollback()
+
+
+def extraer_info_con_claude(email_text, usar_cache=True):
+    """
+    Extrae información de TODAS las reservas del email/PDF.
+    Con usar_cache (y app context) un contenido ya extraído con el mismo
+    prompt y modelo sale del cache sin llamar a la API. Sin cache es seguro
+    llamarla desde threads sin app context.
+    """
+    usar_cache = usar_cache and has_app_context()
+    if usar_cache:
+        reservas = buscar_extraccion_cacheada(email_text)
+        if reservas is not None:
+            return reservas
+
+    reservas = _extraer_con_api(email_text)
+
+    if usar_cache:
+        guardar_extraccion_en_cache(email_text, reservas)
+    return reservas
+
+
+def _extraer_con_api(email_text):
+    """Llama a Claude para extraer las reservas. Returns: list, o None si falló"""
 
     api_key = os.getenv('ANTHROPIC_API_KEY')
     if not api_key:
@@ -25,24 +115,11 @@ def extraer_info_con_claude(email_text):
         return None
 
     # Detectar año del contexto
-    years = re.findall(r'20[2-9][0-9]', email_text)
-    now = datetime.now()
-    current_year = now.year
-
-    target_year = current_year
-    if years:
-        # Solo considerar años razonables (máximo 3 años en el futuro)
-        # Esto evita que números como PNR "2049" se interpreten como años
-        max_reasonable_year = current_year + 3
-        reasonable_years = [int(y) for y in years
-                            if current_year <= int(y) <= max_reasonable_year]
-        if reasonable_years:
-            target_year = min(reasonable_years)
-            print(f"  📅 Año detectado en documento: {target_year}")
-        else:
-            # Si no hay años razonables, asumir próximo año para viajes futuros
-            target_year = current_year + 1
-            print(f"  📅 Sin año válido detectado, usando: {target_year}")
+    target_year, detectado = _anio_objetivo(email_text)
+    if detectado:
+        print(f"  📅 Año detectado en documento: {target_year}")
+    elif re.search(r'20[2-9][0-9]', email_text):
+        print(f"  📅 Sin año válido detectado, usando: {target_year}")
 
     prompt = f"""Analiza este email/PDF de confirmación de reserva (cualquier idioma).
 
@@ -306,7 +383,7 @@ IMPORTANTE: Devuelve SOLO el array JSON, sin markdown ni explicaciones."""
 
     try:
         message = client.messages.create(
-            model="claude-haiku-4-5-20251001",
+            model=MODELO_EXTRACCION,
             max_tokens=8192,
             messages=[{"role": "user", "content": prompt}]
         )
@@ -0,0 +1,90 @@
+"""
+Dedup de emails entre cuentas y proveedores - Mi Agente Viajes
+Antes de bajar adjuntos o llamar a Claude, cada scanner "reclama" el email
+para el usuario en email_visto. Si otra conexión (u otro proveedor) ya lo
+procesó, por Message-ID (o hash de contenido si no tiene), se saltea.
+"""
+import hashlib
+import html
+import re
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, EmailVisto
+
+
+def normalizar_message_id(valor):
+    """Header Message-ID sin <> ni espacios, en minúsculas (None si falta)"""
+    if not valor:
+        return None
+    valor = valor.strip().strip('<>').strip().lower()
+    return valor[:512] or None
+
+
+def hash_contenido(subject, body):
+    """
+    sha256 de subject + body normalizados: sin HTML, entidades, signos ni
+    diferencias de mayúsculas/espacios, para que la versión texto y la HTML
+    del mismo email coincidan lo más posible. None si no hay texto.
+    """
+    texto = f"{subject or ''} {body or ''}"
+    texto = html.unescape(re.sub(r'<[^>]+>', ' ', texto)).lower()
+    texto = ' '.join(re.findall(r'\w+', texto))
+    if not texto:
+        return None
+    return hashlib.sha256(texto.encode('utf-8')).hexdigest()
+
+
+def buscar_email_visto(user_id, rfc_message_id=None, content_hash=None):
+    """
+    EmailVisto del usuario con ese Message-ID, o None. El hash de contenido
+    solo se usa si el email no trae Message-ID: dos emails distintos pueden
+    tener el mismo subject y body (p.ej. "adjuntamos su e-ticket", con la
+    reserva solo en el PDF).
+    """
+    if rfc_message_id:
+        condicion = EmailVisto.rfc_message_id == rfc_message_id
+    elif content_hash:
+        condicion = EmailVisto.content_hash == content_hash
+    else:
+        return None
+    return EmailVisto.query.filter(EmailVisto.user_id == user_id, condicion).first()
+
+
+def reclamar_email(user_id, connection_id, rfc_message_id=None, content_hash=None):
+    """
+    Registra el email para el usuario si nadie lo procesó antes (lock
+    optimista, hace commit). Dos conexiones que reciben el mismo email a la
+    vez chocan en el índice único de Message-ID y solo una lo reclama.
+
+    La conexión dueña del registro lo puede volver a reclamar: si un scan
+    falló después del reclamo (los scanners no llegaron a guardar su
+    ProcessedEmail), el siguiente lo reintenta.
+
+    Returns:
+        (EmailVisto, bool nuevo): si nuevo es False, el registro es el de la
+        conexión que lo procesó primero. Sin Message-ID ni hash: (None, True)
+    """
+    if not rfc_message_id and not content_hash:
+        return None, True
+
+    existente = buscar_email_visto(user_id, rfc_message_id, content_hash)
+    if existente:
+        return existente, existente.connection_id == connection_id
+
+    visto = EmailVisto(
+        user_id=user_id,
+        connection_id=connection_id,
+        rfc_message_id=rfc_message_id,
+        content_hash=content_hash
+    )
+    try:
+        db.session.add(visto)
+        db.session.commit()
+        return visto, True
+    except IntegrityError:
+        db.session.rollback()
+        existente = buscar_email_visto(user_id, rfc_message_id, content_hash)
+        if existente is None:
+            raise
+        return existente, existente.connection_id == connection_id
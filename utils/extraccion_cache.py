@@ -0,0 +1,123 @@
+"""
+Cache de extracciones con Claude - Mi Agente Viajes
+El mismo texto de confirmación llega muchas veces: reenvíos al inbox
+compartido, el mismo PDF en varias cuentas conectadas, re-subidas en
+/carga-rapida. La clave es sha256(texto normalizado + versión del prompt +
+modelo + contexto), así un cambio de prompt o de modelo invalida solo.
+
+El medidor mensual (extraccion_uso) cuenta llamadas reales a la API vs
+hits del cache, para ver el ahorro.
+"""
+from datetime import datetime
+import copy
+import hashlib
+import unicodedata
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from models import db, ExtraccionCache, ExtraccionUso
+
+
+def normalizar_texto(texto):
+    """Unicode NFC y whitespace colapsado: cambios de formato no cambian la clave"""
+    return ' '.join(unicodedata.normalize('NFC', texto or '').split())
+
+
+def clave_extraccion(texto, modelo, prompt_version, contexto=''):
+    """sha256 hex del texto normalizado + versión del prompt + modelo + contexto"""
+    base = '\x1f'.join([prompt_version, modelo, contexto, normalizar_texto(texto)])
+    return hashlib.sha256(base.encode('utf-8')).hexdigest()
+
+
+def _periodo_actual(ahora=None):
+    return (ahora or datetime.now()).strftime('%Y-%m')
+
+
+def registrar_uso_extraccion(llamadas=0, hits=0, ahora=None):
+    """
+    Suma llamadas a la API y/o hits del cache al medidor del mes (sin commit).
+    Upsert atómico: dos procesos que arrancan el mes a la vez no chocan.
+    """
+    tabla = ExtraccionUso.__table__
+    stmt = insert(tabla).values(
+        periodo=_periodo_actual(ahora),
+        llamadas=llamadas,
+        hits=hits,
+        actualizado=datetime.utcnow()
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['periodo'],
+        set_={
+            'llamadas': tabla.c.llamadas + stmt.excluded.llamadas,
+            'hits': tabla.c.hits + stmt.excluded.hits,
+            'actualizado': stmt.excluded.actualizado
+        }
+    ))
+
+
+def buscar_extraccion(clave):
+    """
+    Reservas cacheadas para la clave, o None si no está. Un hit se cuenta
+    en la entrada y en el medidor (hace commit).
+
+    Returns:
+        list (copia, el caller puede modificarla) o None
+    """
+    entrada = ExtraccionCache.query.get(clave)
+    if entrada is None:
+        return None
+
+    reservas = copy.deepcopy(entrada.reservas)
+    ExtraccionCache.query.filter_by(clave=clave).update({
+        ExtraccionCache.hits: ExtraccionCache.hits + 1,
+        ExtraccionCache.ultimo_hit: datetime.utcnow()
+    }, synchronize_session=False)
+    registrar_uso_extraccion(hits=1)
+    db.session.commit()
+    return reservas
+
+
+def guardar_extraccion(clave, reservas, modelo, prompt_version, chars=None):
+    """
+    Guarda el resultado de una llamada a la API y la cuenta en el medidor
+    (hace commit). Si otro proceso ya guardó la misma clave, queda la suya.
+    """
+    if ExtraccionCache.query.get(clave) is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(ExtraccionCache(
+                    clave=clave,
+                    modelo=modelo,
+                    prompt_version=prompt_version,
+                    reservas=reservas,
+                    chars=chars
+                ))
+        except IntegrityError:
+            pass  # otro proceso la guardó entre la consulta y el insert
+    registrar_uso_extraccion(llamadas=1)
+    db.session.commit()
+
+
+def get_estadisticas_extraccion(ahora=None):
+    """
+    Hit rate del mes y totales del cache.
+
+    Returns:
+        dict con periodo, llamadas, hits, hit_rate, entradas, hits_totales
+    """
+    uso = ExtraccionUso.query.get(_periodo_actual(ahora))
+    llamadas = uso.llamadas if uso else 0
+    hits = uso.hits if uso else 0
+    entradas, hits_totales = db.session.query(
+        db.func.count(ExtraccionCache.clave), db.func.coalesce(db.func.sum(ExtraccionCache.hits), 0)
+    ).one()
+
+    return {
+        'periodo': _periodo_actual(ahora),
+        'llamadas': llamadas,
+        'hits': hits,
+        'hit_rate': round(hits / (llamadas + hits), 3) if llamadas + hits else None,
+        'entradas': entradas,
+        'hits_totales': int(hits_totales)
+    }
@@ -0,0 +1,303 @@
+"""
+Cola de sincronizaciones Gmail - Mi Agente Viajes
+El webhook de Pub/Sub solo encola (connection, historyId) en gmail_sync_job y
+responde; el trabajo pesado (history, mensajes, PDFs, Claude, BD) lo hacen
+workers en threads del proceso y, como red de seguridad, /cron/process-gmail-jobs
+(reintentos con backoff y jobs de workers que murieron a mitad).
+
+Estados: pendiente → procesando → completado, o de vuelta a pendiente con
+backoff si falla; después de GMAIL_JOBS_MAX_INTENTOS queda en 'dead'.
+
+Single-flight por conexión: mientras una sync corre, las notificaciones
+nuevas se juntan en un único job pendiente (solo suben su watermark de
+history_id) que corre una vez al terminar la actual, desde el history_id
+más reciente. Una ráfaga de N notificaciones cuesta a lo sumo 2 syncs.
+"""
+from datetime import datetime, timedelta
+import os
+import threading
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, GmailSyncJob, EmailConnection
+
+GMAIL_JOBS_WORKERS = int(os.getenv('GMAIL_JOBS_WORKERS', '2'))
+GMAIL_JOBS_MAX_INTENTOS = int(os.getenv('GMAIL_JOBS_MAX_INTENTOS', '5'))
+BACKOFF_BASE_SEGUNDOS = 30
+BACKOFF_MAX_SEGUNDOS = 3600
+# Un job 'procesando' sin terminar después de esto se considera abandonado
+LEASE_MINUTOS = 15
+# Jobs completados se borran después de estos días (los 'dead' se conservan)
+DIAS_RETENCION_COMPLETADOS = 7
+
+_workers_lock = threading.Lock()
+_workers_activos = 0
+_hay_trabajo_nuevo = False
+
+
+def _history_int(history_id):
+    """historyId de Gmail como int (None si falta o no es numérico)"""
+    try:
+        return int(history_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _job_pendiente(connection_id):
+    return GmailSyncJob.query.filter_by(connection_id=connection_id, estado='pendiente').first()
+
+
+def _subir_watermark(job, history_id):
+    """Deja en job.history_id el mayor historyId notificado"""
+    nuevo = _history_int(history_id)
+    actual = _history_int(job.history_id)
+    if nuevo is not None and (actual is None or nuevo > actual):
+        job.history_id = str(nuevo)
+
+
+def _coalescer_en_pendiente(connection_id, history_id):
+    """
+    Suma la notificación al job pendiente de la conexión con un único UPDATE
+    condicionado a estado='pendiente' (sube el watermark en SQL). Si un
+    worker lo tomó entre medio, no actualiza nada. No hace commit.
+
+    Returns:
+        id del job pendiente actualizado, o None si no había
+    """
+    valores = {GmailSyncJob.notificaciones: db.func.coalesce(GmailSyncJob.notificaciones, 1) + 1}
+    nuevo = _history_int(history_id)
+    if nuevo is not None:
+        valores[GmailSyncJob.history_id] = db.case(
+            (db.or_(
+                GmailSyncJob.history_id.is_(None),
+                db.cast(GmailSyncJob.history_id, db.BigInteger) < nuevo
+            ), str(nuevo)),
+            else_=GmailSyncJob.history_id
+        )
+
+    fila = db.session.execute(
+        db.update(GmailSyncJob)
+        .where(GmailSyncJob.connection_id == connection_id, GmailSyncJob.estado == 'pendiente')
+        .values(valores)
+        .returning(GmailSyncJob.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    return fila[0] if fila else None
+
+
+def encolar_sync_gmail(connection_id, history_id):
+    """
+    Encola una sincronización y hace commit. Si la conexión ya tiene un job
+    pendiente, no crea otro: sube su watermark y cuenta la notificación.
+    Ese UPDATE es atómico: si un worker tomó el pendiente entre medio, se
+    crea uno nuevo en vez de sumarse a una sync que ya arrancó.
+
+    Returns:
+        (GmailSyncJob, bool nuevo)
+    """
+    nuevo = _history_int(history_id)
+    # Dos vueltas: si el INSERT choca con un pendiente creado por otra notificación, se suma a ese
+    for _ in range(2):
+        job_id = _coalescer_en_pendiente(connection_id, history_id)
+        if job_id is not None:
+            db.session.commit()
+            return GmailSyncJob.query.get(job_id), False
+
+        try:
+            job = GmailSyncJob(connection_id=connection_id, history_id=str(nuevo) if nuevo is not None else None)
+            db.session.add(job)
+            db.session.commit()
+            return job, True
+        except IntegrityError:
+            # Otra notificación concurrente creó el pendiente (índice único parcial)
+            db.session.rollback()
+
+    raise RuntimeError(f'No se pudo encolar la sync de la conexión {connection_id}')
+
+
+def _backoff(intentos):
+    """Espera antes del próximo intento: 30s, 60s, 120s... hasta 1h"""
+    return timedelta(seconds=min(BACKOFF_BASE_SEGUNDOS * 2 ** max(intentos - 1, 0), BACKOFF_MAX_SEGUNDOS))
+
+
+def tomar_job(ahora=None):
+    """
+    Reserva el próximo job disponible (pendiente y vencido su backoff, o
+    abandonado por un worker). Un pendiente no se toma mientras su conexión
+    tenga una sync en curso (single-flight). En Postgres usa SKIP LOCKED
+    para que varios workers no tomen el mismo. Hace commit.
+
+    Returns:
+        GmailSyncJob o None si la cola está vacía
+    """
+    ahora = ahora or datetime.utcnow()
+
+    en_curso = db.session.query(GmailSyncJob.connection_id).filter(GmailSyncJob.estado == 'procesando')
+
+    job = GmailSyncJob.query.filter(
+        db.or_(
+            db.and_(
+                GmailSyncJob.estado == 'pendiente',
+                GmailSyncJob.disponible_en <= ahora,
+                ~GmailSyncJob.connection_id.in_(en_curso)
+            ),
+            db.and_(GmailSyncJob.estado == 'procesando', GmailSyncJob.tomado_en < ahora - timedelta(minutes=LEASE_MINUTOS))
+        )
+    ).order_by(GmailSyncJob.disponible_en).with_for_update(skip_locked=True).first()
+
+    if not job:
+        db.session.commit()  # liberar la transacción
+        return None
+
+    job.estado = 'procesando'
+    job.tomado_en = ahora
+    job.intentos = (job.intentos or 0) + 1
+    db.session.commit()
+    return job
+
+
+def ejecutar_job(job):
+    """
+    Corre la sincronización de un job tomado y registra el resultado.
+    Si falla, vuelve a 'pendiente' con backoff o pasa a 'dead'.
+
+    Returns:
+        str: estado final del job
+    """
+    from blueprints.gmail_webhook import process_new_emails
+
+    job_id = job.id
+    try:
+        connection = EmailConnection.query.get(job.connection_id)
+        hasta = _history_int(job.history_id)
+        desde = _history_int(connection.history_id) if connection else None
+        if not connection or not connection.is_active:
+            job.ultimo_error = 'Conexión inexistente o inactiva'
+            job.viajes_creados = 0
+        elif hasta is not None and desde is not None and desde >= hasta:
+            # La sync anterior ya avanzó más allá de lo notificado: nada nuevo
+            print(f"⏭️ Job Gmail {job_id}: history {hasta} ya cubierto ({connection.email} en {desde})")
+            job.viajes_creados = 0
+        else:
+            job.viajes_creados = process_new_emails(connection, job.history_id)
+            job.ultimo_error = None
+        job.estado = 'completado'
+        job.tomado_en = None
+        db.session.commit()
+        return job.estado
+
+    except Exception as e:
+        print(f"❌ Job Gmail {job_id} falló (intento {job.intentos}): {e}")
+        db.session.rollback()
+
+        job = GmailSyncJob.query.get(job_id)
+        job.ultimo_error = str(e)[:2000]
+        job.tomado_en = None
+        if job.intentos >= GMAIL_JOBS_MAX_INTENTOS:
+            job.estado = 'dead'
+            print(f"💀 Job Gmail {job_id} en dead-letter después de {job.intentos} intentos")
+            db.session.commit()
+            return job.estado
+
+        disponible_en = datetime.utcnow() + _backoff(job.intentos)
+        pendiente = _job_pendiente(job.connection_id)
+        if pendiente:
+            # Llegaron notificaciones durante la sync: el reintento es ese job
+            # (hereda intentos y backoff para no esquivar el dead-letter)
+            _subir_watermark(pendiente, job.history_id)
+            pendiente.notificaciones = (pendiente.notificaciones or 1) + (job.notificaciones or 1)
+            pendiente.intentos = max(pendiente.intentos or 0, job.intentos)
+            pendiente.disponible_en = max(pendiente.disponible_en, disponible_en)
+            pendiente.ultimo_error = job.ultimo_error
+            db.session.delete(job)
+        else:
+            job.estado = 'pendiente'
+            job.disponible_en = disponible_en
+        db.session.commit()
+        return 'pendiente'
+
+
+def procesar_jobs_gmail(max_jobs=None):
+    """
+    Drena la cola hasta vaciarla (o hasta max_jobs).
+
+    Returns:
+        dict con estadísticas
+    """
+    stats = {'procesados': 0, 'completados': 0, 'reintentos': 0, 'dead': 0}
+
+    while max_jobs is None or stats['procesados'] < max_jobs:
+        job = tomar_job()
+        if not job:
+            break
+
+        estado = ejecutar_job(job)
+        stats['procesados'] += 1
+        if estado == 'completado':
+            stats['completados'] += 1
+        elif estado == 'dead':
+            stats['dead'] += 1
+        else:
+            stats['reintentos'] += 1
+
+    return stats
+
+
+def purgar_jobs_completados(ahora=None):
+    """Borra jobs completados viejos. Hace commit. Returns: cantidad borrada"""
+    limite = (ahora or datetime.utcnow()) - timedelta(days=DIAS_RETENCION_COMPLETADOS)
+    borrados = GmailSyncJob.query.filter(
+        GmailSyncJob.estado == 'completado',
+        GmailSyncJob.actualizado < limite
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return borrados
+
+
+def get_estadisticas_cola():
+    """Cantidad de jobs por estado"""
+    return dict(
+        db.session.query(GmailSyncJob.estado, db.func.count(GmailSyncJob.id)).group_by(GmailSyncJob.estado).all()
+    )
+
+
+def despertar_workers(app):
+    """
+    Avisa que hay jobs nuevos: arranca un worker (thread daemon) si hay
+    menos de GMAIL_JOBS_WORKERS corriendo. Un worker que está por terminar
+    ve el aviso y vuelve a drenar, así que ningún job queda esperando al cron.
+    """
+    global _workers_activos, _hay_trabajo_nuevo
+
+    with _workers_lock:
+        _hay_trabajo_nuevo = True
+        if _workers_activos >= GMAIL_JOBS_WORKERS:
+            return False
+        _workers_activos += 1
+
+    threading.Thread(target=_worker_loop, args=(app,), name='gmail-sync-worker', daemon=True).start()
+    return True
+
+
+def _worker_loop(app):
+    """Drena la cola con su propia sesión hasta que no quede trabajo"""
+    global _workers_activos, _hay_trabajo_nuevo
+
+    with app.app_context():
+        while True:
+            with _workers_lock:
+                _hay_trabajo_nuevo = False
+            try:
+                stats = procesar_jobs_gmail()
+                if stats['procesados']:
+                    print(f"📨 Worker Gmail: {stats}")
+            except Exception as e:
+                print(f"❌ Worker Gmail: {e}")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+            with _workers_lock:
+                if not _hay_trabajo_nuevo:
+                    _workers_activos -= 1
+                    return
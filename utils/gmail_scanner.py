@@ -6,10 +6,12 @@ MVP14g: Extracción de PDFs adjuntos + deduplicación por contenido
 """
 import base64
 import re
-import io
+import time
 from datetime import datetime, timedelta
 
 from models import db, EmailConnection, Viaje
+from utils.airport_timezone import actualizar_instantes_utc
+from utils.email_dedup import normalizar_message_id, hash_contenido, reclamar_email
 
 # Whitelist de dominios de aerolíneas y OTAs
 WHITELIST_DOMAINS = [
@@ -137,6 +139,12 @@ WHITELIST_DOMAINS = [
 
 MAX_EMAILS_PER_SCAN = 5
 
+# Llamadas por batch HTTP de Gmail (la API acepta 100, pero con más de 50 empieza a devolver 429)
+GMAIL_BATCH_MAX = 50
+
+# Headers que pide la primera pasada con format='metadata'
+METADATA_HEADERS = ['From', 'Subject', 'Content-Type']
+
 
 def is_whitelisted_sender(email_from, user_id=None):
     """
@@ -206,15 +214,150 @@ def extract_body(payload):
     return text.strip()
 
 
-def extract_pdf_attachments(service, message_id, payload):
+def _ejecutar_batch(service, requests_por_clave):
     """
-    Extrae PDFs adjuntos del email.
-    
+    Ejecuta llamadas a la API de Gmail agrupadas en batch HTTP (hasta
+    GMAIL_BATCH_MAX por round-trip) con manejo de error por ítem: una
+    llamada que falla no afecta a las demás del batch. Las que fallan por
+    rate limit o 5xx se reintentan una vez.
+
+    Args:
+        requests_por_clave: dict clave → función que arma el HttpRequest (sin execute)
+
     Returns:
-        list: Lista de dicts con 'filename' y 'data' (bytes)
+        (resultados, errores): dicts clave → respuesta / clave → excepción
     """
-    attachments = []
-    
+    resultados = {}
+    errores = {}
+    pendientes = list(requests_por_clave)
+
+    for intento in range(2):
+        for inicio in range(0, len(pendientes), GMAIL_BATCH_MAX):
+            lote = pendientes[inicio:inicio + GMAIL_BATCH_MAX]
+
+            def callback(request_id, response, exception, lote=lote):
+                clave = lote[int(request_id)]
+                if exception is not None:
+                    errores[clave] = exception
+                else:
+                    resultados[clave] = response
+                    errores.pop(clave, None)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for n, clave in enumerate(lote):
+                batch.add(requests_por_clave[clave](), request_id=str(n))
+            try:
+                batch.execute()
+            except Exception as e:
+                # Falló el batch entero (red, auth): el error queda en cada ítem
+                for clave in lote:
+                    if clave not in resultados:
+                        errores[clave] = e
+
+        pendientes = [clave for clave, error in errores.items() if _es_reintentable(error)]
+        if not pendientes or intento:
+            break
+        print(f"    🔁 Reintentando {len(pendientes)} llamadas Gmail del batch")
+        time.sleep(1)
+
+    return resultados, errores
+
+
+def _es_reintentable(error):
+    """HttpError de rate limit o error temporal del servidor"""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return status in (429, 500, 502, 503)
+
+
+def get_messages_batch(service, msg_ids, format='full'):
+    """
+    messages().get de varios mensajes en batch. Con format='metadata' solo
+    pide los headers de METADATA_HEADERS.
+
+    Returns:
+        (dict msg_id → mensaje, dict msg_id → excepción)
+    """
+    extra = {'metadataHeaders': METADATA_HEADERS} if format == 'metadata' else {}
+    return _ejecutar_batch(service, {
+        msg_id: (lambda msg_id=msg_id: service.users().messages().get(userId='me', id=msg_id, format=format, **extra))
+        for msg_id in dict.fromkeys(msg_ids)
+    })
+
+
+def _nombres_adjuntos(payload):
+    """Nombres de archivos adjuntos del payload, recorriendo parts anidados"""
+    nombres = []
+
+    def get_attachment_names(parts):
+        for part in parts:
+            filename = part.get('filename', '')
+            if filename:
+                nombres.append(filename)
+            if 'parts' in part:
+                get_attachment_names(part['parts'])
+
+    if 'parts' in payload:
+        get_attachment_names(payload['parts'])
+
+    return nombres
+
+
+def parsear_metadata(msg):
+    """
+    Datos de la primera pasada (format='metadata'): remitente, subject,
+    snippet y Content-Type. Con ese formato la API no trae los parts, así
+    que los nombres de adjuntos no se conocen hasta bajar el mensaje.
+    """
+    payload = msg.get('payload', {})
+    data = {'from': None, 'subject': None, 'content_type': '', 'snippet': msg.get('snippet', '')}
+    for h in payload.get('headers', []):
+        nombre = h['name'].lower()
+        if nombre == 'from':
+            data['from'] = h['value']
+        elif nombre == 'subject':
+            data['subject'] = h['value']
+        elif nombre == 'content-type':
+            data['content_type'] = h['value'].lower()
+    return data
+
+
+def metadata_parece_reserva(meta):
+    """
+    Pre-filtro de la primera pasada, solo con metadata. Descarta lo que
+    seguro no es reserva sin bajar el body ni los adjuntos; los candidatos
+    se bajan completos y pasan igual por email_parece_reserva.
+
+    El snippet son ~200 chars del body: si no aparece ninguna keyword pero
+    el mensaje es multipart (adjuntos o body largo en otra parte), la duda
+    se resuelve bajándolo completo en vez de descartarlo.
+
+    Args:
+        meta: dict de parsear_metadata
+    """
+    from email_processor import TRAVEL_KEYWORDS, EXCLUDE_KEYWORDS
+
+    # Mismo texto que mira email_parece_reserva (el snippet es el comienzo del body)
+    contenido = ' '.join([meta['subject'] or '', meta['snippet']]).lower()
+
+    if any(kw.lower() in contenido for kw in EXCLUDE_KEYWORDS):
+        return False
+
+    if any(kw.lower() in contenido for kw in TRAVEL_KEYWORDS):
+        return True
+
+    # Remitente de aerolínea/OTA/hotel conocido (whitelist global, sin consultar la BD)
+    if is_whitelisted_sender(meta['from']):
+        return True
+
+    # Sin keywords en subject/snippet no alcanza para descartar un multipart:
+    # la reserva puede estar más abajo en el body o solo en el PDF
+    return meta['content_type'].startswith('multipart/')
+
+
+def _partes_pdf(payload):
+    """(filename, attachmentId) de los PDFs adjuntos del payload, recorriendo parts anidados"""
+    partes = []
+
     def process_parts(parts):
         for part in parts:
             filename = part.get('filename', '')
@@ -223,22 +366,7 @@ def extract_pdf_attachments(service, message_id, payload):
             # Si es PDF
             if mime_type == 'application/pdf' or filename.lower().endswith('.pdf'):
                 if 'body' in part and 'attachmentId' in part['body']:
-                    try:
-                        att_id = part['body']['attachmentId']
-                        att = service.users().messages().attachments().get(
-                            userId='me',
-                            messageId=message_id,
-                            id=att_id
-                        ).execute()
-                        
-                        data = base64.urlsafe_b64decode(att['data'])
-                        attachments.append({
-                            'filename': filename,
-                            'data': data
-                        })
-                        print(f"    📎 PDF encontrado: {filename}")
-                    except Exception as e:
-                        print(f"    ⚠️ Error descargando PDF {filename}: {e}")
+                    partes.append((filename, part['body']['attachmentId']))
             
             # Recursivo para parts anidados
             if 'parts' in part:
@@ -246,13 +374,66 @@ def extract_pdf_attachments(service, message_id, payload):
     
     if 'parts' in payload:
         process_parts(payload['parts'])
-    
+
+    return partes
+
+
+def download_pdf_attachments_batch(service, payloads):
+    """
+    Descarga en batch los PDFs adjuntos de varios mensajes.
+
+    Args:
+        payloads: dict msg_id → payload del mensaje
+
+    Returns:
+        dict msg_id → list de dicts con 'filename' y 'data' (bytes)
+    """
+    nombres = {}
+    requests_por_clave = {}
+    for message_id, payload in payloads.items():
+        for filename, att_id in _partes_pdf(payload):
+            clave = (message_id, att_id)
+            nombres[clave] = filename
+            requests_por_clave[clave] = (
+                lambda message_id=message_id, att_id=att_id: service.users().messages().attachments().get(
+                    userId='me', messageId=message_id, id=att_id
+                )
+            )
+
+    attachments = {message_id: [] for message_id in payloads}
+    if not requests_por_clave:
+        return attachments
+
+    resultados, errores = _ejecutar_batch(service, requests_por_clave)
+    for clave, filename in nombres.items():
+        message_id = clave[0]
+        if clave in resultados:
+            attachments[message_id].append({
+                'filename': filename,
+                'data': base64.urlsafe_b64decode(resultados[clave]['data'])
+            })
+            print(f"    📎 PDF encontrado: {filename}")
+        else:
+            print(f"    ⚠️ Error descargando PDF {filename}: {errores.get(clave)}")
+
     return attachments
 
 
+def extract_pdf_attachments(service, message_id, payload):
+    """
+    Extrae PDFs adjuntos del email (todos los del mensaje en un solo batch).
+    
+    Returns:
+        list: Lista de dicts con 'filename' y 'data' (bytes)
+    """
+    return download_pdf_attachments_batch(service, {message_id: payload})[message_id]
+
+
 def extract_text_from_pdf(pdf_data):
     """
-    Extrae texto de un PDF en memoria usando PyMuPDF (fitz).
+    Extrae texto de un PDF en memoria con el motor de utils/pdf_extractor.py
+    (pool de procesos, timeout, límite de páginas, presupuesto de Claude y
+    cache por hash del contenido).
 
     Args:
         pdf_data: bytes del PDF
@@ -260,76 +441,29 @@ def extract_text_from_pdf(pdf_data):
     Returns:
         str: Texto extraído
     """
-    try:
-        import fitz  # PyMuPDF
-        doc = fitz.open(stream=pdf_data, filetype="pdf")
-        text = ""
-        for page in doc:
-            # Intentar extracción normal primero
-            page_text = page.get_text()
-
-            # Si no hay mucho texto, intentar con OCR-like extraction
-            if len(page_text) < 100:
-                # Intentar extraer texto de bloques/dict
-                blocks = page.get_text("dict")
-                for block in blocks.get("blocks", []):
-                    if "lines" in block:
-                        for line in block["lines"]:
-                            for span in line.get("spans", []):
-                                page_text += span.get("text", "") + " "
-
-            text += page_text + "\n"
-        doc.close()
-
-        # DEBUG: Log primeras líneas para diagnóstico
-        first_lines = text[:500].replace('\n', ' | ')
-        print(f"    📄 PDF primeras líneas: {first_lines[:200]}...")
-
-        return text.strip()
-    except ImportError:
-        print("    ⚠️ PyMuPDF no instalado, intentando PyPDF2...")
-        try:
-            from PyPDF2 import PdfReader
-            reader = PdfReader(io.BytesIO(pdf_data))
-            text = ''
-            for page in reader.pages:
-                text += page.extract_text() + '\n'
-            return text.strip()
-        except Exception as e:
-            print(f"    ⚠️ Error extrayendo PDF: {e}")
-            return ''
-    except Exception as e:
-        print(f"    ⚠️ Error extrayendo PDF: {e}")
-        return ''
+    from utils.pdf_extractor import extraer_texto_pdf
+    return extraer_texto_pdf(pdf_data)
 
 
-def get_full_email_content(service, message_id, payload, subject=''):
+def get_full_email_content(service, message_id, payload, subject='', attachments=None):
     """
     Extrae todo el contenido del email: body + PDFs adjuntos.
+    attachments: PDFs ya descargados (ej: download_pdf_attachments_batch); si
+    es None se descargan acá.
     
     Returns:
         str: Texto combinado
     """
+    from utils.pdf_extractor import armar_contenido_email
+
     # Extraer body
     body_text = extract_body(payload)
     
-    # Extraer texto de PDFs adjuntos
-    pdf_texts = []
-    attachments = extract_pdf_attachments(service, message_id, payload)
+    if attachments is None:
+        attachments = extract_pdf_attachments(service, message_id, payload)
     
-    for att in attachments:
-        pdf_text = extract_text_from_pdf(att['data'])
-        if pdf_text:
-            pdf_texts.append(pdf_text)
-    
-    # Combinar
-    full_content = f"Subject: {subject}\n\n{body_text}"
-    
-    if pdf_texts:
-        full_content += "\n\n--- CONTENIDO DE PDFs ADJUNTOS ---\n\n"
-        full_content += "\n\n---\n\n".join(pdf_texts)
-    
-    return full_content[:15000]  # Limitar para Claude
+    # Body + texto de PDFs, hasta el presupuesto de Claude
+    return armar_contenido_email(subject, body_text, attachments)
 
 
 def check_duplicate(codigo, user_id):
@@ -442,40 +576,75 @@ def search_travel_emails(service, days_back=30):
         return []
 
 
+def _parsear_email(msg_id, msg):
+    """Headers, body y nombres de adjuntos de un mensaje ya descargado"""
+    payload = msg.get('payload', {})
+    headers = payload.get('headers', [])
+    data = {'id': msg_id, 'from': None, 'subject': None, 'message_id': None, 'body': '', 'attachment_names': []}
+
+    for h in headers:
+        if h['name'].lower() == 'from':
+            data['from'] = h['value']
+        elif h['name'].lower() == 'subject':
+            data['subject'] = h['value']
+        elif h['name'].lower() == 'message-id':
+            data['message_id'] = normalizar_message_id(h['value'])
+
+    body = extract_body(payload)
+    data['body'] = body[:8000]
+    data['content_hash'] = hash_contenido(data['subject'], body)
+    data['attachment_names'] = _nombres_adjuntos(payload)
+
+    return data
+
+
 def get_email_content(service, msg_id):
     """Obtiene contenido de email incluyendo nombres de adjuntos"""
     try:
         msg = service.users().messages().get(
             userId='me', id=msg_id, format='full'
         ).execute()
+        return _parsear_email(msg_id, msg)
+    except:
+        return None
 
-        payload = msg.get('payload', {})
-        headers = payload.get('headers', [])
-        data = {'id': msg_id, 'from': None, 'subject': None, 'body': '', 'attachment_names': []}
 
-        for h in headers:
-            if h['name'].lower() == 'from':
-                data['from'] = h['value']
-            elif h['name'].lower() == 'subject':
-                data['subject'] = h['value']
+def get_emails_content_batch(service, msg_ids):
+    """
+    Como get_email_content pero para varios mensajes en batch.
 
-        data['body'] = extract_body(payload)[:8000]
+    Returns:
+        dict msg_id → contenido (los que fallaron no aparecen)
+    """
+    mensajes, errores = get_messages_batch(service, msg_ids)
+    for msg_id, error in errores.items():
+        print(f"⚠️ Error obteniendo email {msg_id}: {error}")
+    return {msg_id: _parsear_email(msg_id, msg) for msg_id, msg in mensajes.items()}
 
-        # Extraer nombres de adjuntos
-        def get_attachment_names(parts):
-            for part in parts:
-                filename = part.get('filename', '')
-                if filename:
-                    data['attachment_names'].append(filename)
-                if 'parts' in part:
-                    get_attachment_names(part['parts'])
 
-        if 'parts' in payload:
-            get_attachment_names(payload['parts'])
+def filtrar_por_metadata(service, msg_ids):
+    """
+    Primera pasada: baja solo la metadata (batch, format='metadata') y
+    aplica metadata_parece_reserva.
 
-        return data
-    except:
-        return None
+    Returns:
+        (list de msg_ids candidatos en el orden original, dict msg_id → metadata)
+    """
+    mensajes, errores = get_messages_batch(service, msg_ids, format='metadata')
+    for msg_id, error in errores.items():
+        print(f"⚠️ Error obteniendo metadata de {msg_id}: {error}")
+
+    candidatos = []
+    metadata = {}
+    for msg_id in msg_ids:
+        if msg_id not in mensajes:
+            continue
+        meta = metadata[msg_id] = parsear_metadata(mensajes[msg_id])
+        if metadata_parece_reserva(meta):
+            candidatos.append(msg_id)
+        else:
+            print(f"⏭️ Email descartado por metadata: {(meta['subject'] or '(sin subject)')[:50]}")
+    return candidatos, metadata
 
 
 def scan_and_create_viajes(user_id, days_back=30):
@@ -523,10 +692,14 @@ def scan_and_create_viajes(user_id, days_back=30):
 
             emails_processed_count = 0
 
-            # Limitar para evitar timeout
-            for msg_id in msg_ids[:MAX_EMAILS_PER_SCAN]:
+            # Primera pasada solo con metadata; el contenido completo se baja
+            # solo para candidatos (limitado para evitar timeout)
+            candidatos, _ = filtrar_por_metadata(service, msg_ids)
+            candidatos = candidatos[:MAX_EMAILS_PER_SCAN]
+            emails = get_emails_content_batch(service, candidatos)
+            for msg_id in candidatos:
                 try:
-                    email = get_email_content(service, msg_id)
+                    email = emails.get(msg_id)
                     if not email:
                         continue
 
@@ -553,6 +726,18 @@ def scan_and_create_viajes(user_id, days_back=30):
                         print(f"⏭️ Email ya procesado: {subject[:50]}")
                         continue
 
+                    # Mismo email ya procesado desde otra cuenta o proveedor del usuario
+                    visto, nuevo = reclamar_email(user_id, conn.id, email['message_id'], email['content_hash'])
+                    if not nuevo:
+                        print(f"⏭️ Email ya procesado desde otra cuenta: {subject[:50]}")
+                        db.session.add(ProcessedEmail(
+                            connection_id=conn.id,
+                            message_id=msg_id,
+                            had_reservation=bool(visto.had_reservation)
+                        ))
+                        db.session.commit()
+                        continue
+
                     # Extraer con Claude
                     text = f"Subject: {email.get('subject', '')}\n\n{email.get('body', '')}"
                     vuelos = extraer_info_con_claude(text)
@@ -565,6 +750,8 @@ def scan_and_create_viajes(user_id, days_back=30):
                             had_reservation=bool(vuelos)
                         )
                         db.session.add(processed_record)
+                        if visto:
+                            visto.had_reservation = bool(vuelos)
                         db.session.commit()
                     except Exception as e:
                         print(f"⚠️ Error guardando ProcessedEmail: {e}")
@@ -654,6 +841,7 @@ def scan_and_create_viajes(user_id, days_back=30):
                             pasajeros='[]',
                             grupo_viaje=grupo
                         )
+                        actualizar_instantes_utc(viaje)
                         db.session.add(viaje)
                         results['viajes_creados'] += 1
                     
@@ -56,77 +56,98 @@ def extraer_personas_de_datos(viaje):
     return personas
 
 
+def extraer_personas(viaje):
+    """
+    Extrae todas las personas de una reserva:
+    - columna legacy pasajeros (JSON string)
+    - datos JSONB (pasajeros, huespedes, participantes)
+
+    Retorna lista de dicts con formato: [{"nombre": "APELLIDO/NOMBRE"}]
+    """
+    personas = []
+
+    if viaje.pasajeros:
+        try:
+            legacy = json.loads(viaje.pasajeros)
+        except (ValueError, TypeError):
+            legacy = []
+        # Registros legacy pueden tener un int (cantidad) en vez de lista
+        if isinstance(legacy, list):
+            for item in legacy:
+                if isinstance(item, dict) and item.get('nombre'):
+                    personas.append({'nombre': item['nombre']})
+                elif isinstance(item, str) and item:
+                    personas.append({'nombre': item})
+
+    personas.extend(extraer_personas_de_datos(viaje))
+    return personas
+
+
+def parsear_nombre_pasajero(nombre):
+    """
+    Separa un nombre de reserva en (apellido, [nombres]) normalizados.
+
+    Formatos soportados:
+    - "APELLIDO/NOMBRE1 NOMBRE2" (aerolíneas)
+    - "Nombre Apellido" (última palabra = apellido)
+    """
+    if not isinstance(nombre, str):
+        return '', []
+
+    nombre = nombre.upper()
+    if '/' in nombre:
+        parts = nombre.split('/')
+        apellido = normalize_name(parts[0])
+        nombres = normalize_name(parts[1]).split() if len(parts) > 1 else []
+    else:
+        words = nombre.split()
+        apellido = normalize_name(words[-1]) if words else ''
+        nombres = [normalize_name(w) for w in words[:-1]]
+
+    return apellido, nombres
+
+
+def nombres_coinciden(user_nombres, nombres_reserva):
+    """
+    Match de nombres: si el usuario no configuró nombres, alcanza con el apellido.
+    Si no, algún nombre del usuario debe coincidir (parcialmente) con alguno de la reserva.
+    """
+    if not user_nombres:
+        return True
+    return any(
+        user_nombre in nr or nr in user_nombre
+        for user_nombre in user_nombres
+        for nr in nombres_reserva
+    )
+
+
 def get_viajes_for_user(user, Viaje, User):
     """
     MVP7: Obtiene viajes donde el usuario:
     1. Es owner (user_id), O
     2. Aparece como pasajero (matching por nombre)
-    
+
+    El matching por pasajero está materializado en viaje_visible (se recalcula
+    al cambiar las personas de una reserva o el perfil del usuario), así que
+    esto es una sola query indexada.
+
     Args:
         user: Usuario actual
         Viaje: Modelo Viaje (pasado para evitar import circular)
         User: Modelo User (pasado para evitar import circular)
     """
-    # Query base: viajes donde soy owner
-    viajes_propios = Viaje.query.filter_by(user_id=user.id).all()
-    viajes_ids = {v.id for v in viajes_propios}
-    
-    # Si el usuario tiene apellido_pax configurado, buscar también por pasajero
-    if user.apellido_pax:
-        user_apellido = normalize_name(user.apellido_pax)
-        user_nombres = normalize_name(user.nombre_pax).split() if user.nombre_pax else []
+    return query_viajes_for_user(user, Viaje).all()
 
-        # BUG-PASSENGER-MATCH: Buscar en TODOS los viajes (no solo los que tienen pasajeros legacy)
-        todos_viajes = Viaje.query.all()
 
-        for viaje in todos_viajes:
-            if viaje.id in viajes_ids:
-                continue  # Ya lo tenemos
+def query_viajes_for_user(user, Viaje):
+    """Query (sin ejecutar) de los viajes visibles para el usuario (owner + pasajero)"""
+    from models import db, ViajeVisible
 
-            try:
-                # 1. Buscar en columna legacy pasajeros (compatibilidad)
-                pasajeros = json.loads(viaje.pasajeros) if viaje.pasajeros else []
-
-                # 2. TAMBIÉN buscar en datos JSONB (huespedes, participantes, etc.)
-                personas_datos = extraer_personas_de_datos(viaje)
-                pasajeros.extend(personas_datos)
-
-                # 3. Verificar match con cualquier persona encontrada
-                for pax in pasajeros:
-                    nombre_pax = pax.get('nombre', '').upper()
-
-                    # Parsear formato APELLIDO/NOMBRES o "Nombre Apellido"
-                    if '/' in nombre_pax:
-                        parts = nombre_pax.split('/')
-                        apellido_reserva = normalize_name(parts[0])
-                        nombres_reserva = normalize_name(parts[1]).split() if len(parts) > 1 else []
-                    else:
-                        words = nombre_pax.split()
-                        apellido_reserva = normalize_name(words[-1]) if words else ''  # Último palabra = apellido
-                        nombres_reserva = [normalize_name(w) for w in words[:-1]]
-
-                    # Match: apellido exacto + algún nombre coincide
-                    if apellido_reserva == user_apellido:
-                        if not user_nombres:
-                            # Solo apellido configurado = match
-                            viajes_propios.append(viaje)
-                            viajes_ids.add(viaje.id)
-                            break
-                        else:
-                            # Buscar match en nombres
-                            match_found = False
-                            for user_nombre in user_nombres:
-                                if any(user_nombre in nr or nr in user_nombre for nr in nombres_reserva):
-                                    viajes_propios.append(viaje)
-                                    viajes_ids.add(viaje.id)
-                                    match_found = True
-                                    break
-                            if match_found:
-                                break
-            except:
-                pass
-    
-    return viajes_propios
+    visibles = db.session.query(ViajeVisible.viaje_id).filter(ViajeVisible.user_id == user.id)
+
+    return Viaje.query.filter(
+        db.or_(Viaje.user_id == user.id, Viaje.id.in_(visibles))
+    )
 
 
 def calcular_ciudad_principal(vuelos):
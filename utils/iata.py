@@ -117,7 +117,16 @@ IATA_TO_CITY = {
 
 
 def get_ciudad_nombre(codigo_iata):
-    """Convierte código IATA a nombre de ciudad"""
+    """
+    Convierte código IATA (o ICAO) a nombre de ciudad.
+    IATA_TO_CITY tiene prioridad (nombres en castellano); si no está,
+    usa la base completa de aeropuertos.
+    """
     if not codigo_iata:
         return None
-    return IATA_TO_CITY.get(codigo_iata.upper(), codigo_iata)
+    codigo = codigo_iata.upper()
+    if codigo in IATA_TO_CITY:
+        return IATA_TO_CITY[codigo]
+
+    from utils.airports import get_ciudad
+    return get_ciudad(codigo) or codigo_iata
@@ -13,11 +13,12 @@ logger = logging.getLogger(__name__)
 
 from models import db, EmailConnection, Viaje
 from utils.gmail_scanner import (
-    extract_text_from_pdf,
     check_duplicate,
     check_duplicate_by_content,
     MAX_EMAILS_PER_SCAN
 )
+from utils.email_dedup import normalizar_message_id, hash_contenido, reclamar_email
+from utils.pdf_extractor import armar_contenido_email
 from email_processor import email_parece_reserva
 
 
@@ -131,24 +132,12 @@ def get_full_email_content_microsoft(access_token, message):
     body_text = extract_body_microsoft(message)
     message_id = message.get('id')
 
-    # Extraer texto de PDFs adjuntos
-    pdf_texts = []
+    attachments = []
     if message.get('hasAttachments'):
         attachments = extract_pdf_attachments_microsoft(access_token, message_id)
 
-        for att in attachments:
-            pdf_text = extract_text_from_pdf(att['data'])
-            if pdf_text:
-                pdf_texts.append(pdf_text)
-
-    # Combinar
-    full_content = f"Subject: {subject}\n\n{body_text}"
-
-    if pdf_texts:
-        full_content += "\n\n--- CONTENIDO DE PDFs ADJUNTOS ---\n\n"
-        full_content += "\n\n---\n\n".join(pdf_texts)
-
-    return full_content[:15000]  # Limitar para Claude
+    # Body + texto de PDFs, hasta el presupuesto de Claude
+    return armar_contenido_email(subject, body_text, attachments)
 
 
 def search_travel_emails_microsoft(access_token, days_back=30):
@@ -176,7 +165,7 @@ def search_travel_emails_microsoft(access_token, days_back=30):
                 '$filter': f'receivedDateTime ge {date_limit}',
                 '$orderby': 'receivedDateTime desc',
                 '$top': 50,  # Máximo por request
-                '$select': 'id,subject,from,receivedDateTime,hasAttachments,body'
+                '$select': 'id,internetMessageId,subject,from,receivedDateTime,hasAttachments,body'
             }
         )
 
@@ -278,21 +267,37 @@ def scan_and_create_viajes_microsoft(user_id, days_back=30):
                     results['emails_procesados'] += 1
                     emails_processed_count += 1
 
-                    # Obtener contenido completo
-                    full_content = get_full_email_content_microsoft(access_token, message)
-
-                    # Verificar si este email ya fue procesado
+                    # Verificar si este email ya fue procesado (antes de bajar adjuntos)
                     from models import ProcessedEmail
+                    subject = message.get('subject', '')
                     already_processed = ProcessedEmail.query.filter_by(
                         connection_id=conn.id,
                         message_id=message.get('id')
                     ).first()
 
                     if already_processed:
-                        subject = message.get('subject', '')
                         print(f"⏭️ Email ya procesado: {subject[:50]}")
                         continue
 
+                    # Mismo email ya procesado desde otra cuenta o proveedor del usuario
+                    visto, nuevo = reclamar_email(
+                        user_id, conn.id,
+                        normalizar_message_id(message.get('internetMessageId')),
+                        hash_contenido(subject, extract_body_microsoft(message))
+                    )
+                    if not nuevo:
+                        print(f"⏭️ Email ya procesado desde otra cuenta: {subject[:50]}")
+                        db.session.add(ProcessedEmail(
+                            connection_id=conn.id,
+                            message_id=message.get('id'),
+                            had_reservation=bool(visto.had_reservation)
+                        ))
+                        db.session.commit()
+                        continue
+
+                    # Obtener contenido completo
+                    full_content = get_full_email_content_microsoft(access_token, message)
+
                     # Extraer con Claude
                     vuelos = extraer_info_con_claude(full_content)
 
@@ -304,6 +309,8 @@ def scan_and_create_viajes_microsoft(user_id, days_back=30):
                             had_reservation=bool(vuelos)
                         )
                         db.session.add(processed_record)
+                        if visto:
+                            visto.had_reservation = bool(vuelos)
                         db.session.commit()
                     except Exception as e:
                         print(f"⚠️ Error guardando ProcessedEmail: {e}")
@@ -0,0 +1,204 @@
+"""
+Índice normalizado de pasajeros - Mi Agente Viajes
+Mantiene la tabla viaje_pasajeros para que el matching usuario ↔ pasajero
+sea un join indexado por apellido, y la tabla viaje_visible con el resultado
+materializado de ese matching (ver get_viajes_for_user).
+"""
+import time
+
+from models import db, Viaje, ViajePasajero, ViajeVisible, User
+from utils.helpers import extraer_personas, parsear_nombre_pasajero, normalize_name, nombres_coinciden
+
+
+def actualizar_indice_pasajeros(viaje, usuarios_por_apellido=None):
+    """
+    Reconstruye las filas de viaje_pasajeros de una reserva y recalcula
+    qué usuarios la ven por matching de pasajero.
+
+    Llamar cada vez que cambian las personas de la reserva
+    (pasajeros, huespedes, participantes). No hace commit.
+
+    Returns:
+        int: cantidad de personas indexadas
+    """
+    filas = []
+    vistos = set()
+
+    for persona in extraer_personas(viaje):
+        nombre = persona.get('nombre', '')
+        apellido, nombres = parsear_nombre_pasajero(nombre)
+        if not apellido:
+            continue
+
+        nombres_str = ' '.join(nombres)
+        if (apellido, nombres_str) in vistos:
+            continue
+        vistos.add((apellido, nombres_str))
+
+        filas.append(ViajePasajero(
+            nombre=nombre[:200],
+            apellido=apellido[:100],
+            nombres=nombres_str[:200]
+        ))
+
+    # delete-orphan elimina las filas anteriores al hacer flush
+    viaje.personas_index = filas
+    actualizar_visibilidad_viaje(viaje, filas, usuarios_por_apellido)
+    return len(filas)
+
+
+# Índice en memoria apellido → usuarios (por proceso), solo para
+# find_user_by_passenger. Se invalida al cambiar nombre_pax/apellido_pax; el
+# TTL cubre cambios hechos en otros workers. La visibilidad materializada
+# (viaje_visible) no lo usa: se calcula siempre contra la BD.
+INDICE_USUARIOS_TTL = 300  # segundos
+_indice_usuarios = None
+_indice_usuarios_ts = 0
+
+
+def cargar_usuarios_por_apellido(apellidos=None):
+    """
+    Mapa apellido normalizado → [(user_id, [nombres normalizados], nombre)]
+    de los usuarios con apellido_pax configurado.
+
+    Args:
+        apellidos: si se pasa, solo esos apellidos (normalizados)
+    """
+    query = db.session.query(
+        User.id, User.nombre, User.nombre_pax, User.apellido_pax_norm
+    ).filter(User.apellido_pax_norm.isnot(None))
+    if apellidos is not None:
+        if not apellidos:
+            return {}
+        # Igualdad sobre el índice de apellido_pax_norm (mismo normalize_name que la reserva)
+        query = query.filter(User.apellido_pax_norm.in_(list(apellidos)))
+
+    usuarios = {}
+    for user_id, nombre, nombre_pax, apellido in query.order_by(User.id):
+        usuarios.setdefault(apellido, []).append((user_id, normalize_name(nombre_pax).split(), nombre))
+    return usuarios
+
+
+def get_indice_usuarios():
+    """Devuelve el índice apellido → usuarios, reconstruyéndolo si expiró o fue invalidado"""
+    global _indice_usuarios, _indice_usuarios_ts
+
+    ahora = time.monotonic()
+    if _indice_usuarios is None or ahora - _indice_usuarios_ts > INDICE_USUARIOS_TTL:
+        _indice_usuarios = cargar_usuarios_por_apellido()
+        _indice_usuarios_ts = ahora
+    return _indice_usuarios
+
+
+def invalidar_indice_usuarios():
+    """Fuerza la reconstrucción del índice en el próximo acceso"""
+    global _indice_usuarios
+    _indice_usuarios = None
+
+
+def actualizar_visibilidad_viaje(viaje, filas, usuarios_por_apellido=None):
+    """
+    Recalcula las filas de viaje_visible de una reserva a partir de sus
+    personas indexadas. El owner no se materializa (lo cubre Viaje.user_id).
+    No hace commit.
+
+    Sin usuarios_por_apellido, consulta la BD solo por los apellidos de la
+    reserva (no el índice en memoria: puede tener hasta TTL de atraso y las
+    filas materializadas no se vuelven a recalcular).
+    """
+    if usuarios_por_apellido is None:
+        usuarios_por_apellido = cargar_usuarios_por_apellido({fila.apellido for fila in filas})
+
+    user_ids = set()
+    for fila in filas:
+        nombres_reserva = fila.nombres.split() if fila.nombres else []
+        for user_id, user_nombres, _ in usuarios_por_apellido.get(fila.apellido, []):
+            if user_id != viaje.user_id and nombres_coinciden(user_nombres, nombres_reserva):
+                user_ids.add(user_id)
+
+    # Diff contra lo existente para no reinsertar la misma PK
+    actuales = {v.user_id: v for v in viaje.visible_para}
+    viaje.visible_para = [v for uid, v in actuales.items() if uid in user_ids] + [
+        ViajeVisible(user_id=uid) for uid in user_ids if uid not in actuales
+    ]
+
+
+def actualizar_visibilidad_usuario(user):
+    """
+    Recalcula las filas de viaje_visible de un usuario. Llamar cuando
+    cambian nombre_pax/apellido_pax. No hace commit.
+
+    Returns:
+        int: cantidad de viajes visibles por matching de pasajero
+    """
+    invalidar_indice_usuarios()
+
+    apellido = normalize_name(user.apellido_pax) if user.apellido_pax else ''
+    user_nombres = normalize_name(user.nombre_pax).split() if user.nombre_pax else []
+
+    viaje_ids = set()
+    if apellido:
+        candidatos = db.session.query(ViajePasajero.viaje_id, ViajePasajero.nombres).join(
+            Viaje, Viaje.id == ViajePasajero.viaje_id
+        ).filter(
+            ViajePasajero.apellido == apellido,
+            Viaje.user_id != user.id
+        ).all()
+        for viaje_id, nombres in candidatos:
+            if nombres_coinciden(user_nombres, nombres.split() if nombres else []):
+                viaje_ids.add(viaje_id)
+
+    actuales = {
+        viaje_id for (viaje_id,) in db.session.query(ViajeVisible.viaje_id).filter(ViajeVisible.user_id == user.id)
+    }
+
+    sobrantes = actuales - viaje_ids
+    if sobrantes:
+        ViajeVisible.query.filter(
+            ViajeVisible.user_id == user.id,
+            ViajeVisible.viaje_id.in_(sobrantes)
+        ).delete(synchronize_session=False)
+
+    for viaje_id in viaje_ids - actuales:
+        db.session.add(ViajeVisible(user_id=user.id, viaje_id=viaje_id))
+
+    return len(viaje_ids)
+
+
+def backfill_indice_pasajeros(batch_size=500):
+    """
+    Reconstruye el índice de pasajeros y la visibilidad materializada
+    para todos los viajes existentes. Procesa por lotes de IDs y hace
+    commit por lote.
+
+    Returns:
+        dict con estadísticas
+    """
+    ultimo_id = 0
+    viajes_procesados = 0
+    personas_indexadas = 0
+    errors = []
+
+    usuarios_por_apellido = cargar_usuarios_por_apellido()
+
+    while True:
+        lote = Viaje.query.filter(Viaje.id > ultimo_id).order_by(Viaje.id).limit(batch_size).all()
+        if not lote:
+            break
+
+        for viaje in lote:
+            try:
+                personas_indexadas += actualizar_indice_pasajeros(viaje, usuarios_por_apellido)
+                viajes_procesados += 1
+            except Exception as e:
+                errors.append(f"Viaje {viaje.id}: {str(e)}")
+
+        ultimo_id = lote[-1].id
+        db.session.commit()
+        print(f"  📇 Indexados {viajes_procesados} viajes ({personas_indexadas} personas)")
+
+    return {
+        'viajes_procesados': viajes_procesados,
+        'personas_indexadas': personas_indexadas,
+        'errors': errors
+    }
@@ -0,0 +1,308 @@
+"""
+Motor de texto de documentos - Mi Agente Viajes
+Único camino para sacar texto de PDFs (adjuntos de Gmail/Microsoft, inbox
+compartido, /carga-rapida, /api/test-extraction).
+
+- Las páginas se leen de a una (generador) con PyMuPDF, o PyPDF2 si no
+  está instalado, y el texto se junta en una lista. Al llenarse el
+  presupuesto de caracteres de Claude se deja de leer: las páginas que
+  faltan ni se parsean.
+- El parseo corre en un pool de procesos, fuera de los threads de
+  gunicorn: un PDF malformado o enorme no traba un request. Cada documento
+  tiene timeout duro (si se pasa, se matan los procesos del pool y se
+  levanta uno nuevo) y límite de páginas.
+- Los resultados se cachean en memoria por sha256 del contenido, así un
+  rescan no vuelve a parsear el mismo adjunto. Los errores de parseo se
+  cachean como cualquier resultado; los timeouts y caídas del pool (que
+  pueden ser transitorios: arranque en frío, pool reiniciado por otro
+  documento) solo por PDF_CACHE_FALLA_SEGUNDOS.
+- Cada documento devuelve su tiempo de parseo (ms) junto con el texto.
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import contextlib
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+import time
+
+# Caracteres que se le mandan a Claude por email/documento
+PRESUPUESTO_CHARS = 15000
+# PDFs subidos a mano (/carga-rapida, /api/test-extraction): itinerarios largos
+# de varios tramos, se manda a Claude el documento completo salvo casos extremos
+PRESUPUESTO_CHARS_CARGA_MANUAL = 150000
+PDF_MAX_PAGINAS_CARGA_MANUAL = 200
+
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', '2'))
+PDF_TIMEOUT_SEGUNDOS = int(os.getenv('PDF_TIMEOUT_SEGUNDOS', '20'))
+PDF_MAX_PAGINAS = int(os.getenv('PDF_MAX_PAGINAS', '30'))
+# Documentos por proceso antes de reciclarlo (MuPDF retiene memoria)
+PDF_TAREAS_POR_PROCESO = 50
+# Entradas del cache de textos (LRU por proceso)
+PDF_CACHE_MAX = 256
+# Vigencia en cache de un timeout o caída del pool (no reintentar en la misma ráfaga)
+PDF_CACHE_FALLA_SEGUNDOS = 300
+
+SEPARADOR_PDFS = "\n\n--- CONTENIDO DE PDFs ADJUNTOS ---\n\n"
+SEPARADOR_ENTRE_PDFS = "\n\n---\n\n"
+
+_pool = None
+_pool_lock = threading.Lock()
+# Un documento entra al pool solo con un proceso libre: el timeout mide el parseo, no la cola
+_slots = threading.BoundedSemaphore(PDF_WORKERS)
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _paginas_pymupdf(pdf_data, max_paginas, info):
+    """Texto de cada página, de a una (solo se parsean las que se consumen)"""
+    import fitz  # PyMuPDF
+    doc = fitz.open(stream=pdf_data, filetype="pdf")
+    try:
+        info['paginas_total'] = doc.page_count
+        for numero in range(min(doc.page_count, max_paginas)):
+            page = doc.load_page(numero)
+
+            # Intentar extracción normal primero
+            page_text = page.get_text()
+
+            # Si no hay mucho texto, intentar con OCR-like extraction
+            if len(page_text) < 100:
+                # Intentar extraer texto de bloques/dict
+                blocks = page.get_text("dict")
+                spans = [
+                    span.get("text", "")
+                    for block in blocks.get("blocks", []) if "lines" in block
+                    for line in block["lines"]
+                    for span in line.get("spans", [])
+                ]
+                if spans:
+                    page_text += ' '.join(spans) + ' '
+
+            yield page_text
+    finally:
+        doc.close()
+
+
+def _paginas_pypdf2(pdf_data, max_paginas, info):
+    """Como _paginas_pymupdf, con PyPDF2 (fallback si PyMuPDF no está instalado)"""
+    from PyPDF2 import PdfReader
+    reader = PdfReader(io.BytesIO(pdf_data))
+    info['paginas_total'] = len(reader.pages)
+    for numero in range(min(len(reader.pages), max_paginas)):
+        yield reader.pages[numero].extract_text() or ''
+
+
+def _texto_documento(pdf_data, max_paginas, max_chars):
+    """
+    Extrae el texto del PDF hasta max_paginas páginas o max_chars caracteres,
+    lo que llegue primero. Corre en un proceso del pool.
+
+    Returns:
+        dict con texto, paginas (leídas), paginas_total, corte (None,
+        'presupuesto' o 'paginas'), motor, ms y error
+    """
+    inicio = time.perf_counter()
+    info = {'paginas_total': None}
+    partes = []
+    chars = 0
+    corte = None
+    error = None
+
+    try:
+        import fitz  # noqa: F401
+        motor, generador = 'pymupdf', _paginas_pymupdf(pdf_data, max_paginas, info)
+    except ImportError:
+        print("    ⚠️ PyMuPDF no instalado, usando PyPDF2...")
+        motor, generador = 'pypdf2', _paginas_pypdf2(pdf_data, max_paginas, info)
+
+    try:
+        with contextlib.closing(generador):
+            for page_text in generador:
+                partes.append(page_text)
+                chars += len(page_text) + 1
+                if chars >= max_chars:
+                    corte = 'presupuesto'
+                    break
+    except Exception as e:
+        print(f"    ⚠️ Error extrayendo PDF: {e}")
+        error = str(e)
+
+    if corte is None and info['paginas_total'] and len(partes) < info['paginas_total'] and not error:
+        corte = 'paginas'
+
+    texto = '\n'.join(partes).strip()[:max_chars]
+    ms = int((time.perf_counter() - inicio) * 1000)
+
+    # DEBUG: Log primeras líneas para diagnóstico
+    if texto:
+        print(f"    📄 PDF primeras líneas: {texto[:200].replace(chr(10), ' | ')}...")
+    print(
+        f"    📄 PDF ({motor}): {len(partes)}/{info['paginas_total']} págs, {len(texto)} chars, {ms} ms"
+        + (f" - cortado por {corte}" if corte else '')
+    )
+
+    return {
+        'texto': texto,
+        'paginas': len(partes),
+        'paginas_total': info['paginas_total'],
+        'corte': corte,
+        'motor': motor,
+        'ms': ms,
+        'error': error
+    }
+
+
+def _get_pool():
+    """Pool de procesos (lazy). spawn: el proceso de gunicorn tiene threads y fork no es seguro."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                max_tasks_per_child=PDF_TAREAS_POR_PROCESO
+            )
+        return _pool
+
+
+def _reiniciar_pool(pool):
+    """Mata los procesos del pool (timeout o proceso caído); el próximo PDF levanta uno nuevo"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    for proceso in list((getattr(pool, '_processes', None) or {}).values()):
+        proceso.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _fallido(error, ms, transitorio=False):
+    resultado = {
+        'texto': '', 'paginas': 0, 'paginas_total': None, 'corte': None,
+        'motor': None, 'ms': ms, 'error': error
+    }
+    if transitorio:
+        resultado['transitorio'] = True
+    return resultado
+
+
+def _extraer_con_timeout(pdf_data, max_chars, max_paginas):
+    inicio = time.perf_counter()
+    # Un reintento si el pool se rompió por otro documento (timeout ajeno o crash)
+    for intento in range(2):
+        with _slots:
+            try:
+                pool = _get_pool()
+                futuro = pool.submit(_texto_documento, pdf_data, max_paginas, max_chars)
+            except Exception as e:
+                print(f"    ⚠️ Pool de PDFs no disponible ({e}), extrayendo en el thread")
+                return _texto_documento(pdf_data, max_paginas, max_chars)
+
+            try:
+                return futuro.result(timeout=PDF_TIMEOUT_SEGUNDOS)
+            except FuturesTimeoutError:
+                print(f"    ⏱️ PDF cortado por timeout ({PDF_TIMEOUT_SEGUNDOS}s)")
+                _reiniciar_pool(pool)
+                return _fallido('timeout', int((time.perf_counter() - inicio) * 1000), transitorio=True)
+            except BrokenProcessPool:
+                print(f"    ⚠️ Pool de PDFs caído (intento {intento + 1})")
+                _reiniciar_pool(pool)
+    return _fallido('el proceso de extracción se cayó', int((time.perf_counter() - inicio) * 1000), transitorio=True)
+
+
+def extraer_documento(pdf_data, max_chars=PRESUPUESTO_CHARS, max_paginas=PDF_MAX_PAGINAS):
+    """
+    Texto de un PDF en memoria, hasta max_chars caracteres y max_paginas
+    páginas, extraído en el pool de procesos y cacheado por hash del contenido.
+
+    Args:
+        pdf_data: bytes del PDF
+        max_chars: presupuesto de caracteres (se deja de leer al llenarlo)
+        max_paginas: límite de páginas
+
+    Returns:
+        dict con texto, paginas, paginas_total, corte, motor, ms (tiempo de
+        parseo, 0 si salió del cache), error y cache (bool)
+    """
+    if not pdf_data or max_chars <= 0:
+        return dict(_fallido(None, 0), cache=False)
+
+    clave = hashlib.sha256(pdf_data).hexdigest()
+    with _cache_lock:
+        cacheado = _cache.get(clave)
+        if cacheado is not None and cacheado['expira'] is not None and time.monotonic() > cacheado['expira']:
+            del _cache[clave]
+            cacheado = None
+        # Sirve si leyó el documento entero o con límites al menos iguales
+        if cacheado is not None and (
+            cacheado['corte'] is None
+            or (cacheado['max_chars'] >= max_chars and cacheado['max_paginas'] >= max_paginas)
+        ):
+            _cache.move_to_end(clave)
+        else:
+            cacheado = None
+    if cacheado is not None:
+        resultado = dict(cacheado['resultado'], texto=cacheado['resultado']['texto'][:max_chars], ms=0, cache=True)
+        print(f"    ♻️ PDF ya extraído (cache): {len(resultado['texto'])} chars")
+        return resultado
+
+    resultado = _extraer_con_timeout(pdf_data, max_chars, max_paginas)
+    transitorio = resultado.pop('transitorio', False)
+
+    with _cache_lock:
+        _cache[clave] = {
+            'resultado': resultado, 'corte': resultado['corte'],
+            'max_chars': max_chars, 'max_paginas': max_paginas,
+            'expira': time.monotonic() + PDF_CACHE_FALLA_SEGUNDOS if transitorio else None
+        }
+        _cache.move_to_end(clave)
+        while len(_cache) > PDF_CACHE_MAX:
+            _cache.popitem(last=False)
+    return dict(resultado, cache=False)
+
+
+def extraer_documento_carga_manual(pdf_data):
+    """extraer_documento con los límites de PDFs subidos a mano"""
+    return extraer_documento(pdf_data, PRESUPUESTO_CHARS_CARGA_MANUAL, PDF_MAX_PAGINAS_CARGA_MANUAL)
+
+
+def extraer_texto_pdf(pdf_data, max_chars=PRESUPUESTO_CHARS):
+    """Solo el texto de extraer_documento ('' si falla o se corta por timeout)"""
+    return extraer_documento(pdf_data, max_chars)['texto']
+
+
+def armar_contenido_email(subject, body_text, attachments, max_chars=PRESUPUESTO_CHARS):
+    """
+    Texto para Claude: subject + body + texto de los PDFs adjuntos, armado
+    en una lista. Cada PDF se extrae con el presupuesto que queda; cuando se
+    llena, los PDFs siguientes ni se abren.
+
+    Args:
+        attachments: list de dicts con 'filename' y 'data' (bytes)
+
+    Returns:
+        str: Texto combinado (a lo sumo max_chars)
+    """
+    encabezado = f"Subject: {subject}\n\n{body_text}"
+    restante = max_chars - len(encabezado) - len(SEPARADOR_PDFS)
+
+    pdf_texts = []
+    for att in attachments:
+        if restante <= 0:
+            print(f"    ✂️ Presupuesto de {max_chars} chars lleno, no se lee {att['filename']}")
+            continue
+        pdf_text = extraer_texto_pdf(att['data'], max_chars=restante)
+        if pdf_text:
+            pdf_texts.append(pdf_text)
+            restante -= len(pdf_text) + len(SEPARADOR_ENTRE_PDFS)
+            print(f"    ✅ PDF procesado: {att['filename']} ({len(pdf_text)} chars)")
+
+    partes = [encabezado]
+    if pdf_texts:
+        partes.append(SEPARADOR_PDFS)
+        partes.append(SEPARADOR_ENTRE_PDFS.join(pdf_texts))
+    return ''.join(partes)[:max_chars]
@@ -6,6 +6,11 @@ import json
 from datetime import datetime
 from models import db, Viaje
 from utils.schema_helpers import get_fecha_inicio, get_fecha_fin
+from utils.passenger_index import actualizar_indice_pasajeros
+from utils.airport_timezone import actualizar_instantes_utc
+
+# Campos de datos que contienen personas (alimentan el índice viaje_pasajeros)
+CAMPOS_PERSONAS = ('pasajeros', 'huespedes', 'participantes')
 
 
 def parse_fecha(fecha_str):
@@ -105,6 +110,8 @@ def save_reservation(user_id, datos_dict, grupo_id=None, nombre_viaje=None, sour
     if codigo_aerolinea:
         viaje.add_codigo_alternativo(codigo_aerolinea)
 
+    actualizar_instantes_utc(viaje)
+    actualizar_indice_pasajeros(viaje)
     db.session.add(viaje)
 
     # Enviar push notification si no es manual Y usuario tiene preferencia activa
@@ -165,6 +172,9 @@ def update_reservation(viaje, datos_dict):
 
     viaje.actualizado = datetime.utcnow()
 
+    actualizar_instantes_utc(viaje)
+    actualizar_indice_pasajeros(viaje)
+
     return viaje
 
 
@@ -182,6 +192,7 @@ def merge_reservation_data(existing_viaje, new_datos):
     """
     datos_actuales = existing_viaje.datos or {}
     hubo_cambios = False
+    personas_cambiaron = False
 
     # Campos que NO se deben sobreescribir (identificadores únicos y de tramo)
     # Incluye campos de identidad de vuelo para evitar que ida sobrescriba vuelta
@@ -199,6 +210,7 @@ def merge_reservation_data(existing_viaje, new_datos):
             pasajeros_changed = _merge_pasajeros(valor_actual, nuevo_valor)
             if pasajeros_changed:
                 hubo_cambios = True
+                personas_cambiaron = True
             continue
 
         # Para otros campos: sobreescribir si hay valor nuevo diferente
@@ -206,6 +218,8 @@ def merge_reservation_data(existing_viaje, new_datos):
             valor_anterior = valor_actual
             datos_actuales[campo] = nuevo_valor
             hubo_cambios = True
+            if campo in CAMPOS_PERSONAS:
+                personas_cambiaron = True
             if valor_anterior:
                 print(f"  📝 Actualizado {campo}: {valor_anterior} → {nuevo_valor}")
             else:
@@ -223,6 +237,12 @@ def merge_reservation_data(existing_viaje, new_datos):
         existing_viaje.proveedor = datos_actuales.get('aerolinea') or datos_actuales.get('nombre_propiedad') or datos_actuales.get('embarcacion') or datos_actuales.get('empresa') or datos_actuales.get('nombre') or datos_actuales.get('evento') or datos_actuales.get('operador') or existing_viaje.proveedor or ''
         existing_viaje.precio = datos_actuales.get('precio') or datos_actuales.get('precio_total') or existing_viaje.precio or ''
 
+        # Puede haber llegado la hora de llegada (hora_salida es inmutable)
+        actualizar_instantes_utc(existing_viaje)
+
+        if personas_cambiaron:
+            actualizar_indice_pasajeros(existing_viaje)
+
     return hubo_cambios
 
 